@@ -1,7 +1,7 @@
 """ RESTful API for http://tuixue.online/visa/"""
 
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from datetime import datetime, timedelta, timezone
 from threading import Lock
 
@@ -12,10 +12,16 @@ from pydantic import BaseModel
 import global_var as G
 import tuixue_mongodb as DB
 from notifier import Notifier
+from cache_events import CacheEvent, CacheEventListener, connect_publisher, connect_subscriber
+from hot_window import HotWindow
+from subscription_index import SubscriptionEvent
 from tuixue_typing import VisaType, EmbassyCode
 from util import dt_to_utc, httpdate
 
 EMBASSY_LST = G.USEmbassy.get_embassy_lst()
+CACHE_EVENT_LISTENER: Optional[CacheEventListener] = None
+HOT_WINDOW: Optional[HotWindow] = None
+SUBSCRIPTION_EVENTS = None  # the publisher of the edited subscriptions to the fetchers
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -101,6 +107,130 @@ def get_meta_data(response: Response):
     return metadata
 
 
+def live_fragment_ttl(visa_type: VisaType, embassy: G.USEmbassy) -> int:
+    """ TTL of the fragments still being written: a fetch interval, or longer while the writes are
+        announced to drop them.
+    """
+    if CACHE_EVENT_LISTENER is not None and CACHE_EVENT_LISTENER.live:
+        return G.API_CACHE_LIVE_TTL
+    return G.FETCH_TIME_INTERVAL[embassy.sys][visa_type]
+
+
+def overview_fragment_ttl(key: Tuple[VisaType, EmbassyCode, datetime]) -> int:
+    """ Cache the overview of an embassy-local date while it's written, or for a long time once
+        the date is over, with an hour of margin for the writes still in flight.
+    """
+    visa_type, embassy_code, write_date = key
+    embassy = G.USEmbassy.get_embassy_by_code(embassy_code)
+    if datetime.now(embassy.timezone).replace(tzinfo=None) - write_date > timedelta(days=1, hours=1):
+        return G.API_CACHE_HISTORY_TTL
+    return live_fragment_ttl(visa_type, embassy)
+
+
+def detail_fragment_ttl(key: Tuple[VisaType, EmbassyCode, datetime]) -> Optional[int]:
+    """ Cache the 24 hours detail ending at a minute while it's written, or for a long time once
+        the minute is an hour behind.
+    """
+    visa_type, embassy_code, minute = key
+    embassy = G.USEmbassy.get_embassy_by_code(embassy_code)
+    if embassy is None:
+        return None  # the default TTL of the cache
+    if datetime.now(timezone.utc).replace(tzinfo=None) - minute > timedelta(hours=1):
+        return G.API_CACHE_HISTORY_TTL
+    return live_fragment_ttl(visa_type, embassy)
+
+
+def truncate_to_minute(dt: datetime) -> datetime:
+    """ Return the minute of a datetime as a naive UTC datetime, a naive `dt` is in UTC already."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.replace(second=0, microsecond=0)
+
+
+def invalidate_fragments(events: List[CacheEvent]) -> None:
+    """ Drop the fragments changed by the written fetch results: the overview of the embassy-local
+        date of a write, and the details of the minutes since the write.
+    """
+    overview_keys = set()
+    detail_since = {}
+    for event in events:
+        if event.available_date is None:  # nothing fetched, only the latest written status changed
+            continue
+        pair = (event.visa_type, event.embassy_code)
+        if event.overview_changed:
+            overview_keys.add((*pair, DB.VisaStatus.embassy_write_date(event.embassy_code, event.write_time)))
+        minute = truncate_to_minute(event.write_time)
+        detail_since[pair] = min(detail_since.get(pair, minute), minute)
+
+    G.OVERVIEW_CACHE.discard(overview_keys)
+    G.DETAIL_CACHE.invalidate(lambda key: key[:2] in detail_since and key[2] >= detail_since[key[:2]])
+
+
+def handle_cache_events(events: List[CacheEvent]) -> None:
+    """ Add the written fetch results to the hot window before dropping the fragments they change."""
+    if HOT_WINDOW is not None:
+        HOT_WINDOW.apply(events)
+    invalidate_fragments(events)
+
+
+def handle_cache_events_lost() -> None:
+    """ Any fragment may miss a write now: drop them all, and seed the hot window again."""
+    G.OVERVIEW_CACHE.invalidate(lambda key: True)
+    G.DETAIL_CACHE.invalidate(lambda key: True)
+    if HOT_WINDOW is not None:
+        HOT_WINDOW.seed_in_background()
+
+
+@app.on_event('startup')
+def create_indexes():
+    """ Make sure the queries of the API are served by indexes, a no-op once they exist."""
+    DB.create_indexes()
+
+
+@app.on_event('startup')
+def listen_cache_events():
+    """ Invalidate the cached fragments on the writes of the fetcher, and keep the hot window current."""
+    global CACHE_EVENT_LISTENER, HOT_WINDOW
+    subscriber = connect_subscriber(G.CACHE_EVENTS_TRANSPORT, G.CACHE_EVENTS_SOCKET_DIR)
+    if subscriber is not None:
+        if G.HOT_WINDOW_HOURS > 0:
+            HOT_WINDOW = HotWindow(G.HOT_WINDOW_HOURS)
+        CACHE_EVENT_LISTENER = CacheEventListener(
+            subscriber,
+            handle_cache_events,
+            handle_cache_events_lost,
+            silence_timeout=G.CACHE_EVENTS_SILENCE_TIMEOUT,
+        )
+        CACHE_EVENT_LISTENER.start()  # the hot window is seeded by the first datagram of the fetcher
+
+
+@app.on_event('startup')
+def publish_subscription_events():
+    """ Tell the fetchers about the edited subscriptions, they index them for the notifications."""
+    global SUBSCRIPTION_EVENTS
+    SUBSCRIPTION_EVENTS = connect_publisher(
+        G.CACHE_EVENTS_TRANSPORT, G.SUBSCRIPTION_EVENTS_SOCKET_DIR, G.CACHE_EVENTS_HEARTBEAT
+    )
+
+
+@app.on_event('startup')
+def dispatch_emails():
+    """ Post the confirmation emails from the outbox instead of the request handlers."""
+    if G.EMAIL_OUTBOX:
+        Notifier.enable_outbox()
+
+
+def subscription_changed(email: str) -> None:
+    if SUBSCRIPTION_EVENTS is not None:
+        SUBSCRIPTION_EVENTS.publish(SubscriptionEvent(email))
+
+
+@app.on_event('shutdown')
+def stop_listening_cache_events():
+    if CACHE_EVENT_LISTENER is not None:
+        CACHE_EVENT_LISTENER.stop()
+
+
 @app.get('/visastatus/overview')
 def get_visa_status_overview(
     response: Response,
@@ -119,13 +249,18 @@ def get_visa_status_overview(
         to = now
     if since > now:
         since = now
-    keys = "".join(visa_type) + "".join(list(sorted(embassy_code)))
-    cache_since, cache_to, cache_result = G.OVERVIEW_CACHE.get(keys, (None, None, None))
-    if cache_result is None or abs(to - cache_to) > timedelta(minutes=1) or abs(since - cache_since) > timedelta(minutes=1):
-        tabular_data = DB.VisaStatus.find_visa_status_overview_embtz(visa_type, embassy_code, since, to)
-        G.OVERVIEW_CACHE[keys] = (since, to, tabular_data)
-    else:
-        tabular_data = cache_result
+    # the response is assembled from one cached fragment per (visa_type, embassy_code, embassy-local date)
+    branches, local_since_by_code = DB.VisaStatus.plan_overview_query(visa_type, embassy_code, since, to)
+    fragments = G.OVERVIEW_CACHE.get_many_or_compute(
+        DB.VisaStatus.overview_fragment_keys(branches),
+        DB.VisaStatus.find_overview_fragments,
+        ttl=overview_fragment_ttl,
+    )
+    tabular_data = DB.VisaStatus.group_overview_by_utc_date(
+        ({**overview, 'write_date': write_date} for (_, _, write_date), overview in fragments.items() if overview),
+        since,
+        local_since_by_code,
+    )
 
     return {
         'visa_type': visa_type,
@@ -157,20 +292,29 @@ def get_visa_status_detail(
         dt_to_utc(timestamp, remove_second=True),
     ]
 
-    keys = visa_type + "".join(list(sorted(embassy_code)))
-    cache_timestamp, cache_result = G.DETAIL_CACHE.get(keys, (None, None))
-    if cache_result is None or abs(timestamp - cache_timestamp) > timedelta(minutes=1):
-        detail = []
-        for e in embassy_code:
-            single_result = DB.VisaStatus.find_visa_status_past24h_turning_point(visa_type, e, timestamp)
-            if single_result:
-                single_result = single_result['available_dates']
-            else:
-                single_result = [{'write_time': time_range[0], 'available_date': None}]
-            detail.append({'embassy_code': e, 'available_dates': single_result})
-        G.DETAIL_CACHE[keys] = (timestamp, detail)
-    else:
-        detail = cache_result
+    def find_detail_fragments(keys):
+        hot = HOT_WINDOW is not None and CACHE_EVENT_LISTENER.live and HOT_WINDOW.covers(timestamp)
+        source = HOT_WINDOW if hot else DB.VisaStatus
+        turning_points = source.find_visa_status_past24h_turning_point_batch(
+            visa_type, [e for _, e, _ in keys], timestamp
+        )
+        return {
+            key: turning_points[key[1]]['available_dates'] if turning_points[key[1]] else None for key in keys
+        }
+
+    # the response is assembled from one cached fragment per (visa_type, embassy_code, minute)
+    minute = truncate_to_minute(timestamp)
+    fragments = G.DETAIL_CACHE.get_many_or_compute(
+        [(visa_type, e, minute) for e in embassy_code],
+        find_detail_fragments,
+        ttl=detail_fragment_ttl,
+    )
+    detail = []
+    for e in embassy_code:
+        single_result = fragments[(visa_type, e, minute)]
+        if not single_result:
+            single_result = [{'write_time': time_range[0], 'available_date': None}]
+        detail.append({'embassy_code': e, 'available_dates': single_result})
     return {
         'visa_type': visa_type,
         'embassy_code': embassy_code,
@@ -179,6 +323,18 @@ def get_visa_status_detail(
     }
 
 
+@app.get('/visastatus/cache')
+def get_cache_stats():
+    """ Return the size and the hit/miss/eviction counters of the response caches, the number
+        of cache events received and the size of the hot window.
+    """
+    return {
+        'caches': [G.OVERVIEW_CACHE.stats(), G.DETAIL_CACHE.stats()],
+        'events': CACHE_EVENT_LISTENER.stats() if CACHE_EVENT_LISTENER is not None else None,
+        'hot_window': HOT_WINDOW.stats() if HOT_WINDOW is not None else None,
+    }
+
+
 @app.post('/email/subscription/{step}')
 def post_email_subscription(step: EmailSubsStep, subscription: EmailSubscription = Body(..., embed=True)):
     """ Post email subscription."""
@@ -198,6 +354,7 @@ def post_email_subscription(step: EmailSubsStep, subscription: EmailSubscription
 
     elif step == EmailSubsStep.subscribed:
         DB.Subscription.add_email_subscription(subscription['email'], subs_lst)
+        subscription_changed(subscription['email'])
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -224,6 +381,7 @@ def delete_email_subscription(step: EmailUnsubsStep, unsubscription: EmailUnsubs
     if len(unsubs_lst) > 0:
         unsubs_lst = [(unsubs['visa_type'], unsubs['embassy_code']) for unsubs in unsubs_lst]
         DB.Subscription.remove_email_subscription(unsubscription['email'], unsubs_lst)
+        subscription_changed(unsubscription['email'])
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -1,198 +1,61 @@
 """ WebSocket service for http://tuixue.online/visa/"""
 import typing
 import asyncio
-from datetime import datetime
-from contextlib import asynccontextmanager
+import itertools
 from fastapi.encoders import jsonable_encoder
 from starlette.concurrency import run_until_first_complete
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
 
-import tuixue_mongodb as DB
+import async_mongodb as ADB
 import global_var as G
+from broadcast import Broadcast, Subscriber
+from cache_events import CacheEventListener, connect_subscriber
+from hot_window import HotWindow
+from scheduler import LatenessTracker
 from util import dt_to_utc
 
 EMBASSY_CODES = [emb.code for emb in G.USEmbassy.get_embassy_lst()]
+LOOP_LAG_INTERVAL = 0.1  # seconds between two samples of the event loop lag
+HOT_WINDOW: typing.Optional[HotWindow] = None
+CACHE_EVENT_LISTENER: typing.Optional[CacheEventListener] = None
 app = FastAPI(root_path='/ws')
 
-
-# P.S. The broadcasting logic copy-paste a LOT of code from https://github.com/encode/broadcaster
-class VisaStatusUpdateEvent:
-    def __init__(
-        self,
-        visa_type: str,
-        embassy_code: str,
-        prev_avai_date: typing.Optional[datetime],
-        curr_avai_date: datetime
-    ) -> None:
-        self.visa_type = visa_type
-        self.embassy_code = embassy_code
-        self.prev_avai_date = prev_avai_date
-        self.curr_avai_date = curr_avai_date
-
-    def __repr__(self) -> str:
-        return 'VisaStatusUpdateEvent(\
-            visa_type={!r}, embassy_code={!r}, prev_avai_date={!r}, curr_avai_date={!r}\
-        )'.format(
-            self.visa_type,
-            self.embassy_code,
-            self.prev_avai_date,
-            self.curr_avai_date,
-        )
-
-    def to_dict(self) -> dict:
-        return {
-            'visa_type': self.visa_type,
-            'embassy_code': self.embassy_code,
-            'prev_avai_date': self.prev_avai_date,
-            'curr_avai_date': self.curr_avai_date,
-        }
-
-
-class BroadcastBackend:
-    """ An in-memory broadcaster backend.
-        Maintaining an event queue that publish every incoming event. There is no
-        channel distinguishment as there is only one channel in our case, therefore
-        no subscribe nor unsubscribe methods.
-    """
-    def __init__(self) -> None:
-        self.published_visa_status: asyncio.Queue = asyncio.Queue()
-
-    async def publish(
-        self,
-        visa_type: str,
-        embassy_code: str,
-        prev_avai_date: typing.Optional[datetime],
-        curr_avai_date: datetime,
-    ) -> None:
-        """ Publish a new visa status update."""
-        event = VisaStatusUpdateEvent(visa_type, embassy_code, prev_avai_date, curr_avai_date)
-        await self.published_visa_status.put(event)
-
-    async def next_published(self) -> VisaStatusUpdateEvent:
-        """ Listen to the visa status update event and dispatch event to the broadcaster."""
-        while True:
-            event: VisaStatusUpdateEvent = await self.published_visa_status.get()
-            # if (event.visa_type, event.embassy_code) in self.subscribed_visa_status:
-            return event
-
-
-class Broadcast:
-    default_channel = 'new_visa_status'
-
-    def __init__(self) -> None:
-        self.subscribers = {}
-        self.backend = BroadcastBackend()
-        self.connected = False
-
-    async def __aenter__(self) -> 'Broadcast':
-        self.connect()
-        return self
-
-    async def __aexit__(self, *args, **kwargs) -> None:
-        self.disconnect()
-
-    async def connect(self):
-        self.listener_task = asyncio.create_task(self.listener())
-        self.connected = True
-
-    async def disconnect(self):
-        if self.listener_task.done():
-            self.listener_task.result()
-        else:
-            self.listener_task.cancel()
-        self.connected = False
-
-    async def listener(self) -> None:
-        """ Dispatch new visa status event to all subscriber."""
-        while True:
-            event = await self.backend.next_published()
-            for queue in list(self.subscribers.get(self.default_channel, [])):
-                await queue.put(event)
-
-    async def publish(
-        self,
-        visa_type: str,
-        embassy_code: str,
-        prev_avai_date: typing.Optional[datetime],
-        curr_avai_date: datetime,
-    ) -> None:
-        """ Publish a new visa status event. Meant to be called by notifier."""
-        await self.backend.publish(visa_type, embassy_code, prev_avai_date, curr_avai_date)
-
-    @asynccontextmanager
-    async def subscribe(self):
-        queue: asyncio.Queue = asyncio.Queue()
-
-        try:
-            # subscribe at context manager entering
-            if not self.subscribers.get(self.default_channel):
-                # if there is a third party (e.g. Redis) backend here, subscribe here
-                self.subscribers[self.default_channel] = {queue}
-            else:
-                self.subscribers[self.default_channel].add(queue)
-
-            yield Subscriber(queue)
-
-            # unsubscribe at context manager exiting
-            self.subscribers[self.default_channel].remove(queue)
-            # if there are more than one channel, or a third party backend, unsubscribe here
-        finally:
-            await queue.put(None)  # End iterational wait in asyncio.Queue.get in websocket route
-
-
-class Unsubscribed(Exception):
-    pass
-
-
-class Subscriber:
-    def __init__(self, queue: asyncio.Queue):
-        self.queue: asyncio.Queue = queue
-
-    async def __aiter__(self):
-        try:
-            while True:
-                yield await self.get_event()
-        except Unsubscribed:
-            pass
-
-    async def get_event(self) -> VisaStatusUpdateEvent:
-        event = await self.queue.get()
-        if event is None:
-            raise Unsubscribed()
-        return event
-
-
-BROADCASTER = Broadcast()
+BROADCASTER = Broadcast(G.WEBSOCKET_QUEUE_SIZE, G.WEBSOCKET_OVERFLOW_POLICY)
 
 
 async def visa_status_notification_sender(websocket: WebSocket):
     """ The websocket connection from notifier.Notifier will be send a JSON string
         handled by this function. The JSON string contains new visa status update
-        which will be dispatched into the broadcast channel.
+        which will be dispatched into the broadcast channel. It is either one update, or a list
+        of them from the batching publisher of websocket_publisher.py.
     """
     async for new_visa_status in websocket.iter_json():
-        await BROADCASTER.publish(**new_visa_status)
+        for visa_status in new_visa_status if isinstance(new_visa_status, list) else [new_visa_status]:
+            await BROADCASTER.publish(**visa_status)
 
 
-async def visa_status_notification_receiver(websocket: WebSocket):
+async def visa_status_notification_receiver(websocket: WebSocket, subscriber: Subscriber):
     """ The websocket connection from frontend React app will receive a new pushed
-        JSON string via this function. Entering this function will create a new
-        subscription to the broadcasting channel. Exiting it will unsubscribe the
-        channel.
+        JSON string via this function, from its subscription to the broadcasting channel.
     """
-    async with BROADCASTER.subscribe() as subscriber:
-        async for new_visa_status in subscriber:  # get an Event object
-            ws_data = {
-                'type': 'notification',
-                'data': new_visa_status.to_dict()
-            }
-            await websocket.send_json(jsonable_encoder(ws_data))
+    async for message in subscriber:  # already serialized
+        try:
+            await asyncio.wait_for(websocket.send_text(message), G.WEBSOCKET_SEND_TIMEOUT)
+        except asyncio.TimeoutError:  # the client doesn't read
+            BROADCASTER.evict(subscriber, 'timeout')
 
 
-async def get_newest_visa_status(websocket: WebSocket):
-    """ Get the latest fetched visa status with the given query"""
+async def get_newest_visa_status(websocket: WebSocket, subscriber: Subscriber):
+    """ Get the latest fetched visa status with the given query. A query
+        `{"type": "interest", "visa_type": [...], "embassy_code": [...]}` registers the interest of
+        the client instead: it's only notified of these visa types at these embassies from then on.
+    """
     while True:
-        visa_type, embassy_code = await websocket.receive_json()
+        query = await websocket.receive_json()
+        if isinstance(query, dict) and query.get('type') == 'interest':
+            visa_type, embassy_code = query.get('visa_type'), query.get('embassy_code')
+        else:
+            visa_type, embassy_code = query
         if not isinstance(visa_type, list):
             visa_type = [visa_type]
         if not isinstance(embassy_code, list):
@@ -207,7 +70,15 @@ async def get_newest_visa_status(websocket: WebSocket):
             )
             continue
 
-        latest_written = DB.VisaStatus.find_latest_written_visa_status(visa_type, embassy_code)
+        if isinstance(query, dict):
+            BROADCASTER.set_interest(subscriber, itertools.product(visa_type, embassy_code))
+            await websocket.send_json({'type': 'interest', 'data': sorted(subscriber.interest)})
+            continue
+
+        if HOT_WINDOW is not None and CACHE_EVENT_LISTENER.live and HOT_WINDOW.ready:
+            latest_written = HOT_WINDOW.find_latest_written_visa_status(visa_type, embassy_code)
+        else:
+            latest_written = await ADB.VisaStatus.find_latest_written_visa_status(visa_type, embassy_code)
         ws_data = {
             'type': 'newest',
             'data': [{**lw, 'write_time': dt_to_utc(lw['write_time'])} for lw in latest_written]
@@ -215,6 +86,70 @@ async def get_newest_visa_status(websocket: WebSocket):
         await websocket.send_json(jsonable_encoder(ws_data))
 
 
+LOOP_LAG = LatenessTracker()
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """ Record how late the event loop wakes up a sleeping task, i.e. how long the loop was
+        blocked by the other tasks.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        due = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.record(loop.time() - due)
+
+
+@app.on_event('startup')
+async def start_monitoring_loop_lag():
+    app.state.loop_lag_task = asyncio.create_task(monitor_loop_lag())
+
+
+@app.on_event('startup')
+def start_hot_window():
+    """ Answer the latest written status from a hot window kept current by the cache events."""
+    global CACHE_EVENT_LISTENER, HOT_WINDOW
+    if G.HOT_WINDOW_HOURS <= 0:
+        return
+    subscriber = connect_subscriber(G.CACHE_EVENTS_TRANSPORT, G.CACHE_EVENTS_SOCKET_DIR)
+    if subscriber is not None:
+        HOT_WINDOW = HotWindow(G.HOT_WINDOW_HOURS)
+        CACHE_EVENT_LISTENER = CacheEventListener(
+            subscriber,
+            HOT_WINDOW.apply,
+            HOT_WINDOW.seed_in_background,
+            silence_timeout=G.CACHE_EVENTS_SILENCE_TIMEOUT,
+        )
+        CACHE_EVENT_LISTENER.start()  # the hot window is seeded by the first datagram of the fetcher
+
+
+@app.on_event('shutdown')
+def stop_hot_window():
+    if CACHE_EVENT_LISTENER is not None:
+        CACHE_EVENT_LISTENER.stop()
+
+
+@app.get('/visastatus/hot_window')
+def get_hot_window_stats():
+    """ Return the size of the hot window and the number of cache events received."""
+    return {
+        'hot_window': HOT_WINDOW.stats() if HOT_WINDOW is not None else None,
+        'events': CACHE_EVENT_LISTENER.stats() if CACHE_EVENT_LISTENER is not None else None,
+    }
+
+
+@app.get('/visastatus/broadcast')
+def get_broadcast_stats():
+    """ Return the number of subscribers by interest and of the events published and delivered."""
+    return BROADCASTER.stats()
+
+
+@app.get('/visastatus/loop_lag')
+def get_loop_lag():
+    """ Return the number of samples and the mean/p95/max lag (seconds) of the event loop."""
+    return LOOP_LAG.stats()
+
+
 @app.websocket('/visastatus/latest')
 async def get_newest_visa_status_update(websocket: WebSocket, token: str = Query('')):
     """ Implement a PUB/SUB for updating the newest visa status"""
@@ -226,9 +161,15 @@ async def get_newest_visa_status_update(websocket: WebSocket, token: str = Query
         if token == G.SECRET['websocket_token']:
             await asyncio.create_task(visa_status_notification_sender(websocket))
         else:
-            await run_until_first_complete(
-                (visa_status_notification_receiver, {'websocket': websocket}),
-                (get_newest_visa_status, {'websocket': websocket})
-            )
+            async with BROADCASTER.subscribe() as subscriber:
+                await run_until_first_complete(
+                    (visa_status_notification_receiver, {'websocket': websocket, 'subscriber': subscriber}),
+                    (get_newest_visa_status, {'websocket': websocket, 'subscriber': subscriber})
+                )
+            if subscriber.evicted is not None:
+                try:  # 1013: try again later
+                    await asyncio.wait_for(websocket.close(code=1013), G.WEBSOCKET_SEND_TIMEOUT)
+                except (asyncio.TimeoutError, RuntimeError, OSError):
+                    pass
     except WebSocketDisconnect:
         pass
@@ -0,0 +1,147 @@
+""" asyncio fetching engine, selected by `visa_status_fetcher.py --engine async`.
+    The crawler nodes are requested with aiohttp: one pooled `ClientSession` per node and at
+    most `limit_per_node` requests in flight per node, instead of one blocking request per
+    thread. The responses are handled by the same `VisaFetcher.handle_refresh_*` methods as
+    the threaded engine. They are run in a small thread pool since the database writes and
+    the notifications are blocking, so the DB writes and notifications stay the same.
+"""
+import asyncio
+import logging
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import aiohttp
+
+import global_var as G
+from scheduler import Job, LatenessTracker, ScheduleRule, interval_of
+
+
+class CrawlerNodePool:
+    """ A pooled `aiohttp.ClientSession` and a concurrency limit for every crawler node."""
+    def __init__(self, limit_per_node: int, timeout: float) -> None:
+        self.limit_per_node = limit_per_node
+        self.timeout = timeout
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get(self, node: str) -> Tuple[aiohttp.ClientSession, asyncio.Semaphore]:
+        """ Return the client session and the semaphore of a node, created on first use."""
+        if node not in self.sessions:
+            self.sessions[node] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit_per_node, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self.semaphores[node] = asyncio.Semaphore(self.limit_per_node)
+        return self.sessions[node], self.semaphores[node]
+
+    async def close(self) -> None:
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+        self.semaphores.clear()
+
+
+class AsyncFetchEngine:
+    """ Run the fetching jobs as asyncio tasks. `fetcher` is the `VisaFetcher` class and
+        `session_cache` the `SessionCache` of the running fetcher.
+    """
+    def __init__(
+        self,
+        fetcher: Any,
+        session_cache: Any,
+        rules: Sequence[ScheduleRule] = (),
+        limit_per_node: int = 32,
+        blocking_workers: int = 16,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.fetcher = fetcher
+        self.session_cache = session_cache
+        self.rules = list(rules)
+        self.limit_per_node = limit_per_node
+        self.logger = logger or logging.getLogger('async_fetcher')
+
+        self.executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix='fetched_result')
+        self.nodes: Optional[CrawlerNodePool] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.main_task: Optional[asyncio.Task] = None
+        self.fetching_tasks: Set[asyncio.Task] = set()  # keep a reference, the loop only keeps weak ones
+        self.lateness = LatenessTracker()
+
+    async def run_blocking(self, func: Callable, *args) -> Any:
+        """ Run a blocking function (database write, notification...) in the thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def fetch_visa_status(self, visa_type: str, location: str) -> None:
+        """ Fetch the latest visa status available from crawler server."""
+        now = datetime.now().strftime('%H:%M:%S')
+        try:
+            session = self.session_cache.get_session(visa_type, location)
+            if session is None:
+                self.logger.warning('%s, %s, %s, FAILED - No Session', now, visa_type, location)
+                return
+
+            endpoint = self.fetcher.refresh_endpoint(location, session)
+            node = G.value('current_crawler_node', '')
+            client, semaphore = self.nodes.get(node)
+            try:
+                async with semaphore:
+                    async with client.get(f'{node}{endpoint}') as res:
+                        status_code = res.status
+                        result = await res.json(content_type=None) if status_code == 200 else None
+            except asyncio.TimeoutError:
+                await self.run_blocking(self.fetcher.handle_refresh_timeout, visa_type, location, now)
+            except aiohttp.ClientConnectionError:
+                await self.run_blocking(self.fetcher.handle_refresh_connection_error, visa_type, location, now)
+            else:
+                await self.run_blocking(
+                    self.fetcher.handle_refresh_response,
+                    visa_type,
+                    location,
+                    session,
+                    endpoint,
+                    now,
+                    status_code,
+                    result,
+                )
+        except Exception:
+            self.logger.error(traceback.format_exc())
+
+    async def run_job(self, job: Job) -> None:
+        """ Start the job at a fixed rate, a slow fetch doesn't delay the next one."""
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        while True:
+            self.lateness.record(loop.time() - due)
+            task = asyncio.ensure_future(job.func())
+            self.fetching_tasks.add(task)
+            task.add_done_callback(self.fetching_tasks.discard)
+
+            due += interval_of(job, self.rules, datetime.now())
+            if due < loop.time():  # too late to catch up, skip the missed runs instead of bursting
+                due = loop.time() + interval_of(job, self.rules, datetime.now())
+            await asyncio.sleep(due - loop.time())
+
+    async def run(self, jobs: List[Job]) -> None:
+        """ Run all the jobs until cancelled. `job.func` must return a coroutine."""
+        self.loop = asyncio.get_running_loop()
+        self.nodes = CrawlerNodePool(self.limit_per_node, G.WAIT_TIME['refresh'])
+        self.main_task = asyncio.ensure_future(asyncio.gather(*[self.run_job(job) for job in jobs]))
+        try:
+            await self.main_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in list(self.fetching_tasks):
+                task.cancel()
+            await self.nodes.close()
+            self.executor.shutdown(wait=False)
+
+    def stop(self, wait: bool = True) -> None:
+        """ Cancel the jobs from another thread."""
+        if self.loop is not None and self.main_task is not None:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+
+    def stats(self) -> dict:
+        return {'in_flight': len(self.fetching_tasks), **self.lateness.stats()}
@@ -0,0 +1,54 @@
+""" Coroutine versions of the `tuixue_mongodb` query API for the asyncio apps."""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Sequence
+
+import tuixue_mongodb as DB
+from global_var import ASYNC_DB_WORKERS
+
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix='mongodb')
+
+
+async def run_in_db_executor(func: Callable, *args, **kwargs) -> Any:
+    """ Run a blocking database call in the thread pool of the database calls."""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+class AsyncQueryAPI:
+    """ Expose the methods `method_names` of a `tuixue_mongodb` class as coroutines. The method is
+        looked up at every call, so whatever replaces it on the class is used.
+    """
+    def __init__(self, cls: type, method_names: Sequence[str]) -> None:
+        self.cls = cls
+        self.method_names = tuple(method_names)
+        for name in self.method_names:
+            setattr(self, name, self.coroutine_of(name))
+
+    def coroutine_of(self, name: str) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(getattr(self.cls, name))
+        async def method(*args, **kwargs):
+            return await run_in_db_executor(getattr(self.cls, name), *args, **kwargs)
+        return method
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.cls.__name__})'
+
+
+# Only the methods returning plain data: a lazy cursor would still block the loop when iterated.
+VisaStatus = AsyncQueryAPI(DB.VisaStatus, [
+    'find_latest_written_visa_status',
+    'find_visa_status_overview',
+    'find_visa_status_overview_embtz',
+    'find_overview_fragments',
+    'find_visa_status_past24h',
+    'find_visa_status_past24h_turning_point',
+    'find_visa_status_past24h_turning_point_batch',
+    'find_historical_visa_status',
+])
+Subscription = AsyncQueryAPI(DB.Subscription, [
+    'get_subscriptions_by_email',
+    'get_email_list',
+    'add_email_subscription',
+    'remove_email_subscription',
+])
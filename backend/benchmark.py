@@ -0,0 +1,1103 @@
+""" Micro-benchmarks for the hot paths of the backend.
+    Each target compares the previous implementation with the current one and prints
+    the per-operation cost, run it from the backend folder so that `global_var` can
+    find the config files.
+"""
+import os
+import json
+import time
+import random
+import timeit
+import operator
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import global_var as G
+
+
+def report(name: str, total_sec: float, number: int) -> None:
+    """ Print the per-operation cost of a benchmark."""
+    print(f'{name:<48}{total_sec / number * 1e6:>12.3f} us/op')
+
+
+def benchmark_database():
+    """ Return a scratch database next to the production one, benchmarks never touch real data."""
+    import tuixue_mongodb as DB
+    DB.connect()
+    return DB.MONGO_CLIENT.get_database('{}_benchmark'.format(G.MONGO_CONFIG['database']))
+
+
+@contextmanager
+def patched(obj, **attrs):
+    """ Temporarily replace attributes of `obj`, e.g. the collections of `tuixue_mongodb.VisaStatus`."""
+    original = {name: getattr(obj, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        yield obj
+    finally:
+        for name, value in original.items():
+            setattr(obj, name, value)
+
+
+def synthetic_fetches(start: datetime, days: int, step_minutes: int = 1):
+    """ Generate minute-level fetch results whose available date drifts like a real embassy."""
+    available_date = start + timedelta(days=30)
+    for minute in range(0, days * 24 * 60, step_minutes):
+        if random.random() < 0.01:
+            available_date = max(start, available_date + timedelta(days=random.randint(-7, 7)))
+        yield {'write_time': start + timedelta(minutes=minute), 'available_date': available_date}
+
+
+@contextmanager
+def stub_crawler(delay: float):
+    """ Serve `/refresh/` and `/register/` like a crawler node that takes `delay` seconds to answer."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, so that pooled connections are reused
+
+        def do_GET(self):
+            time.sleep(delay)
+            if self.path.startswith('/register/'):
+                body = {'code': 0, 'session': 'stub', 'msg': '2021-1-1'}
+            else:
+                body = {'code': 0, 'msg': '2021-1-1'}
+            content = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def seed_overview(array, daily, visa_type: str, embassy_codes: list, start: datetime, days: int) -> None:
+    """ Write `days` days of synthetic overview into both overview layouts."""
+    for embassy_code in embassy_codes:
+        entries = [
+            {
+                'write_date': fetch['write_time'],
+                'earliest_date': fetch['available_date'],
+                'latest_date': fetch['available_date'],
+            } for fetch in synthetic_fetches(start, days, step_minutes=24 * 60)
+        ]
+        array.insert_one({'visa_type': visa_type, 'embassy_code': embassy_code, 'overview': entries})
+        daily.insert_many([{'visa_type': visa_type, 'embassy_code': embassy_code, **entry} for entry in entries])
+    print(f'{len(embassy_codes)} embassies, {days} days of overview')
+
+
+def bench_embassy_lookup(number: int) -> None:
+    """ Per-lookup cost of `USEmbassy` before (rebuild and scan) and after (indexed registry)."""
+    def legacy_embassy_lst():
+        return [G.USEmbassy(*embassy_attr) for embassy_attr in G.EMBASSY_ATTR]
+
+    def legacy_by_code(code):
+        return next((emb for emb in legacy_embassy_lst() if emb.code == code), None)
+
+    def legacy_by_loc(loc):
+        return next((emb for emb in legacy_embassy_lst() if emb.location == loc), None)
+
+    def legacy_by_crawler_code(crawler_code):
+        return [emb for emb in legacy_embassy_lst() if emb.crawler_code == crawler_code]
+
+    last = G.USEmbassy(*G.EMBASSY_ATTR[-1])  # worst case of the linear scan
+    code, loc, crawler_code = last.code, last.location, last.crawler_code
+
+    for name, legacy, current, arg in (
+        ('get_embassy_by_code', legacy_by_code, G.USEmbassy.get_embassy_by_code, code),
+        ('get_embassy_by_loc', legacy_by_loc, G.USEmbassy.get_embassy_by_loc, loc),
+        ('get_embassy_list_by_crawler_code', legacy_by_crawler_code,
+         G.USEmbassy.get_embassy_list_by_crawler_code, crawler_code),
+    ):
+        assert legacy(arg).__repr__() == current(arg).__repr__()
+        report(f'{name} (before)', timeit.timeit(lambda: legacy(arg), number=number), number)
+        report(f'{name} (after)', timeit.timeit(lambda: current(arg), number=number), number)
+
+
+def bench_visa_status_storage(number: int) -> None:
+    """ Read latency of the daily array layout against the time bucket layout over a synthetic
+        year of minute-level data for one `(visa_type, embassy_code)` pair.
+    """
+    import tuixue_mongodb as DB
+
+    db = benchmark_database()
+    daily, bucket = db.get_collection('visa_status'), db.get_collection('visa_status_bucket')
+    daily.drop()
+    bucket.drop()
+
+    visa_type, embassy_code, days = 'F', 'bj', 365
+    start = datetime(2020, 1, 1)
+    fetches = list(synthetic_fetches(start, days))
+
+    by_date = {}
+    for fetch in fetches:
+        by_date.setdefault(fetch['write_time'].replace(hour=0, minute=0), []).append(fetch)
+    daily.insert_many([
+        {'visa_type': visa_type, 'embassy_code': embassy_code, 'write_date': write_date, 'available_dates': adt}
+        for write_date, adt in by_date.items()
+    ])
+    daily.create_index([('write_date', 1)])
+    bucket.insert_many(DB.VisaStatus.bucketize(visa_type, embassy_code, fetches))
+    bucket.create_index([('visa_type', 1), ('embassy_code', 1), ('bucket_start', 1)], unique=True)
+    print(f'{len(fetches)} fetches, {daily.count_documents({})} daily documents, {bucket.count_documents({})} buckets')
+
+    timestamps = [start + timedelta(days=1, minutes=random.randrange((days - 1) * 24 * 60)) for _ in range(number)]
+    write_dates = [ts.replace(hour=0, minute=0) for ts in timestamps]
+
+    for storage in ('daily', 'bucket'):
+        with patched(DB.VisaStatus, visa_status=daily, visa_status_bucket=bucket, storage=storage):
+            elapsed = timeit.timeit(
+                lambda: [DB.VisaStatus.find_visa_status_past24h(visa_type, embassy_code, ts) for ts in timestamps],
+                number=1,
+            )
+            report(f'find_visa_status_past24h ({storage})', elapsed, number)
+            elapsed = timeit.timeit(
+                lambda: [DB.VisaStatus.find_historical_visa_status(visa_type, embassy_code, wd) for wd in write_dates],
+                number=1,
+            )
+            report(f'find_historical_visa_status ({storage})', elapsed, number)
+
+    daily.drop()
+    bucket.drop()
+
+
+def bench_overview_storage(number: int) -> None:
+    """ Read latency of `find_visa_status_overview_embtz` for 10 embassies over multi-year ranges
+        and latency of merging a fetch result, array layout against daily documents, on three
+        synthetic years of overview.
+    """
+    import tuixue_mongodb as DB
+
+    db = benchmark_database()
+    array, daily = db.get_collection('overview'), db.get_collection('overview_daily')
+    array.drop()
+    daily.drop()
+
+    visa_type, days = 'F', 3 * 365
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()[:10]]
+    start = datetime(2018, 1, 1)
+    seed_overview(array, daily, visa_type, embassy_codes, start, days)
+
+    to_utc = (start + timedelta(days=days - 1)).replace(tzinfo=timezone.utc)
+    for storage in ('array', 'daily'):
+        with patched(DB.VisaStatus, overview=array, overview_daily=daily, overview_storage=storage):
+            if storage == 'daily':
+                DB.VisaStatus.create_overview_daily_index()
+
+            for range_days in (15, 365, days):
+                since_utc = to_utc - timedelta(days=range_days - 1)
+                elapsed = timeit.timeit(
+                    lambda: DB.VisaStatus.find_visa_status_overview_embtz(visa_type, embassy_codes, since_utc, to_utc),
+                    number=number,
+                )
+                report(f'overview of {range_days} days ({storage})', elapsed, number)
+
+            ops = DB.VisaStatus.overview_ops(
+                visa_type, embassy_codes[0], to_utc.replace(tzinfo=None), start, start + timedelta(days=1)
+            )
+            elapsed = timeit.timeit(lambda: DB.VisaStatus.write_ops(ops), number=number)
+            report(f'merge a fetch result ({storage})', elapsed, number)
+
+    array.drop()
+    daily.drop()
+
+
+def legacy_overview_embtz(daily, visa_type: list, embassy_code: list, since_utc: datetime, to_utc: datetime):
+    """ `VisaStatus.find_visa_status_overview_embtz` on the daily layout before the query planner:
+        one `$facet` sub-pipeline per (visa_type, embassy_code).
+    """
+    def dt_to_date(dt):
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+    def utc_to_embtz(dt, embtz):
+        return dt_to_date(dt.astimezone(embtz))
+
+    overview_target = [
+        {
+            'visa_type': vt,
+            'embassy_code': emb.code,
+            'date_range': [
+                utc_to_embtz(since_utc, emb.timezone) + timedelta(days=d)
+                for d in range((utc_to_embtz(to_utc, emb.timezone) - utc_to_embtz(since_utc, emb.timezone)).days + 1)
+            ],
+        } for vt in visa_type for emb in [G.USEmbassy.get_embassy_by_code(ec) for ec in embassy_code]
+    ]
+    utc_date_range = [
+        dt_to_date(since_utc) + timedelta(days=d) for d in range((dt_to_date(to_utc) - dt_to_date(since_utc)).days + 1)
+    ]
+    embtz_utc_map = {tgt['embassy_code']: dict(zip(tgt['date_range'], utc_date_range)) for tgt in overview_target}
+
+    overview_embtz = daily.aggregate([
+        {
+            '$facet': {
+                '{}{}'.format(tgt['visa_type'], tgt['embassy_code']): [
+                    {
+                        '$match': {
+                            'visa_type': tgt['visa_type'],
+                            'embassy_code': tgt['embassy_code'],
+                            'write_date': {'$in': tgt['date_range']},
+                        }
+                    },
+                    {'$project': {'_id': False}},
+                ] for tgt in overview_target
+            },
+        },
+        {
+            '$project': {
+                'facet_result': {
+                    '$setUnion': ['${}{}'.format(tgt['visa_type'], tgt['embassy_code']) for tgt in overview_target]
+                }
+            },
+        },
+        {'$unwind': '$facet_result'},
+        {'$replaceRoot': {'newRoot': '$facet_result'}}
+    ])
+
+    ov_groupby_date = {}
+    for ov in overview_embtz:
+        if ov['write_date'] in embtz_utc_map[ov['embassy_code']]:
+            write_date = embtz_utc_map[ov['embassy_code']][ov.pop('write_date')]
+            ov_groupby_date.setdefault(write_date, []).append(ov)
+    return sorted(
+        [{'date': write_date, 'overview': overview} for write_date, overview in ov_groupby_date.items()],
+        key=lambda ov: ov['date'],
+        reverse=True,
+    )
+
+
+def bench_overview_query(number: int) -> None:
+    """ Latency of the 15-day overview of 1, 10 and all embassies on the daily layout: one `$facet`
+        sub-pipeline per embassy against the `$or` query of the planner.
+    """
+    import tuixue_mongodb as DB
+
+    db = benchmark_database()
+    array, daily = db.get_collection('overview'), db.get_collection('overview_daily')
+    array.drop()
+    daily.drop()
+
+    visa_type, days = 'F', 365
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()]
+    start = datetime(2020, 1, 1)
+    seed_overview(array, daily, visa_type, embassy_codes, start, days)
+
+    to_utc = (start + timedelta(days=days - 1)).replace(hour=12, tzinfo=timezone.utc)
+    since_utc = to_utc - timedelta(days=14)
+
+    def sort_rows(rows):
+        return [(row['date'], sorted(row['overview'], key=lambda ov: ov['embassy_code'])) for row in rows]
+
+    with patched(DB.VisaStatus, overview=array, overview_daily=daily, overview_storage='daily'):
+        DB.VisaStatus.create_overview_daily_index()
+        for codes in (embassy_codes[:1], embassy_codes[:10], embassy_codes):
+            current = DB.VisaStatus.find_visa_status_overview_embtz
+            assert sort_rows(legacy_overview_embtz(daily, [visa_type], codes, since_utc, to_utc)) == \
+                sort_rows(current([visa_type], codes, since_utc, to_utc))
+
+            for name, find in (('facet', functools.partial(legacy_overview_embtz, daily)), ('planner', current)):
+                elapsed = timeit.timeit(lambda: find([visa_type], codes, since_utc, to_utc), number=number)
+                report(f'overview of {len(codes)} embassies ({name})', elapsed, number)
+
+    array.drop()
+    daily.drop()
+
+
+def bench_crawler_fetch(number: int) -> None:
+    """ Throughput of `number` fetches from a stub crawler node taking 50ms per request, through the
+        fetching path of both engines: `VisaFetcher.fetch_visa_status` in a pool of threads (the
+        threaded engine) against `AsyncFetchEngine.fetch_visa_status` with its pooled aiohttp
+        connections per node. The responses go through `VisaFetcher.handle_refresh_response` in
+        both, only the session cache and the database writes are stubbed.
+    """
+    import asyncio
+    import logging
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    import visa_status_fetcher
+    from async_fetcher import AsyncFetchEngine, CrawlerNodePool
+    from session_operation import Session
+
+    workers, limit_per_node = 128, 32
+    locations = [random.choice(G.CGI_LOCATION) for _ in range(number)]
+    saved, saved_lock = [], threading.Lock()
+
+    G.assign('log_name', 'benchmark')
+    session = Session('stub', sys='cgi')
+
+    class StubSessionCache:
+        def get_session(self, visa_type, location):
+            return session
+
+        def produce_new_session_request(self, visa_type, location, session):
+            raise AssertionError('the stub sessions never expire')
+
+    class StubFetcher(visa_status_fetcher.VisaFetcher):
+        @staticmethod
+        def save_fetched_data(visa_type, location, available_visa_date):
+            with saved_lock:
+                saved.append((visa_type, location, tuple(available_visa_date)))
+
+        @staticmethod
+        def check_crawler_server_connection():
+            pass
+
+    def threaded():
+        req = requests.Session()
+        req.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda location: StubFetcher.fetch_visa_status('F', location, req), locations))
+
+    async def pooled():
+        engine = AsyncFetchEngine(StubFetcher, visa_status_fetcher.SESSION_CACHE, limit_per_node=limit_per_node)
+        engine.nodes = CrawlerNodePool(limit_per_node, G.WAIT_TIME['refresh'])
+        try:
+            await asyncio.gather(*[engine.fetch_visa_status('F', location) for location in locations])
+        finally:
+            await engine.nodes.close()
+            engine.executor.shutdown()
+
+    visa_status_fetcher.LOGGER = logging.getLogger('benchmark')
+    visa_status_fetcher.SESSION_CACHE = StubSessionCache()
+    with stub_crawler(delay=0.05) as node:
+        G.assign('current_crawler_node', node)
+        for name, run in (
+            (f'threaded engine, {workers} threads', threaded),
+            (f'async engine, {limit_per_node} connections', lambda: asyncio.run(pooled())),
+        ):
+            saved.clear()
+            start = time.monotonic()
+            run()
+            elapsed = time.monotonic() - start
+            assert sorted(saved) == sorted(('F', location, (2021, 1, 1)) for location in locations)
+            report(f'fetch ({name})', elapsed, number)
+            print(f'{"":<48}{number / elapsed:>12.1f} req/s')
+
+
+def bench_session_cache(number: int) -> None:
+    """ Throughput of `number` session cache operations (get, contain and every 10th a replace) on
+        random CGI pools from 64 threads: the global lock with list scans against striped locks
+        with the session index. The journal is not written, only the locking is compared.
+    """
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from session_operation import SessionCache, random_session
+
+    class LegacySessionCache(SessionCache):
+        def get_session(self, visa_type, location):
+            if visa_type not in G.VISA_TYPES or location not in [*G.CGI_LOCATION, *G.AIS_LOCATION]:
+                return
+            if datetime.now() < self.session_avail[visa_type][location]:
+                return
+            with G.LOCK:
+                sess_lst = self.session[visa_type][location]
+                session = sess_lst[self.session_idx[visa_type][location] % len(sess_lst)]
+                self.session_idx[visa_type][location] += 1
+            return session
+
+        def replace_session(self, visa_type, location, session, new_session):
+            if visa_type not in G.VISA_TYPES or location not in [*G.CGI_LOCATION, *G.AIS_LOCATION]:
+                return
+            with G.LOCK:
+                sess_lst = self.session[visa_type][location]
+                try:
+                    sess_idx = [sess.session for sess in sess_lst].index(session.session)
+                except ValueError:
+                    return
+                sess_lst[sess_idx] = new_session
+
+        def contain_session(self, visa_type, location, session):
+            if datetime.now() < self.session_avail[visa_type][location]:
+                return False
+            return session.session in [sess.session for sess in self.session[visa_type][location]]
+
+    threads = 64
+    pools = [(visa_type, loc) for visa_type in G.SESS_POOL_SIZE['cgi'] for loc in G.CGI_LOCATION]
+    workload = [random.choice(pools) for _ in range(number)]
+
+    def run(cache):
+        def work(offset):
+            for i in range(offset, number, threads):
+                visa_type, loc = workload[i]
+                session = cache.get_session(visa_type, loc)
+                cache.contain_session(visa_type, loc, session)
+                if i % 10 == 0:
+                    cache.replace_session(visa_type, loc, session, random_session('cgi'))
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(work, range(threads)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        G.assign('log_name', 'benchmark')
+        G.assign('target_system', 'cgi')
+        G.assign('session_file', os.path.join(tmp_dir, 'cgi-session.json'))
+        for name, cache in (
+            ('global lock, list scan', LegacySessionCache()),
+            (f'{G.SESSION_LOCK_STRIPES} lock stripes, session index', SessionCache()),
+        ):
+            with patched(cache.journal, write=lambda entries: None):
+                report(f'session cache ({name})', timeit.timeit(lambda: run(cache), number=1), number)
+
+
+def irregular_fetches(start: datetime, hours: int, interval_sec: int):
+    """ Generate fetch results with late fetches, bursts within a minute, outages and date changes,
+        at whole seconds.
+    """
+    write_time, available_date = start, start + timedelta(days=30)
+    while write_time < start + timedelta(hours=hours):
+        dice = random.random()
+        if dice < 0.02:
+            write_time += timedelta(minutes=random.randint(3, 90))
+        elif dice < 0.15:
+            write_time += timedelta(seconds=random.randint(0, 30))
+        else:
+            write_time += timedelta(seconds=random.randint(interval_sec // 2, interval_sec + 90))
+        if random.random() < 0.1:
+            available_date += timedelta(days=random.choice([-3, -1, 1, 2]))
+        yield {'write_time': write_time, 'available_date': available_date}
+
+
+def bench_turning_point(number: int) -> None:
+    """ Latency of the detail of 1 and 10 embassies: aggregating the stored fetches against a range
+        read of the `turning_point` series. Both return the same detail for random timestamps on
+        irregular series, for the last instant of a minute.
+    """
+    import tuixue_mongodb as DB
+
+    db = benchmark_database()
+    visa_status, turning_point = db.get_collection('visa_status'), db.get_collection('turning_point')
+    visa_status.drop()
+    turning_point.drop()
+
+    visa_type, hours = 'F', 72
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()][:10]
+    start = datetime(2021, 1, 1)
+    with patched(
+        DB.VisaStatus,
+        visa_status=visa_status,
+        turning_point=turning_point,
+        turning_point_state={},
+        storage='daily',
+    ):
+        DB.VisaStatus.create_turning_point_index()
+        for embassy_code in embassy_codes:
+            interval_sec = DB.VisaStatus.gap_seconds(visa_type, embassy_code) - 60
+            ops = {'visa_status': [], 'turning_point': []}
+            for fetch in irregular_fetches(start, hours, interval_sec):
+                write_time, available_date = fetch['write_time'].replace(tzinfo=timezone.utc), fetch['available_date']
+                for collection_name, op, _ in [
+                    *DB.VisaStatus.fetched_visa_status_ops(visa_type, embassy_code, write_time, available_date),
+                    *DB.VisaStatus.turning_point_ops(visa_type, embassy_code, write_time, available_date),
+                ]:
+                    if collection_name in ops:
+                        ops[collection_name].append(op)
+            visa_status.bulk_write(ops['visa_status'])
+            turning_point.bulk_write(ops['turning_point'])
+
+        minutes = [start + timedelta(minutes=random.randint(0, hours * 60 + 60)) for _ in range(number)]
+        timestamps = [minute + timedelta(seconds=59, microseconds=999000) for minute in minutes]  # BSON has ms
+        for codes in (embassy_codes[:1], embassy_codes):
+            for timestamp in timestamps[:max(1, number // 10)]:
+                with patched(DB.VisaStatus, detail_source='visa_status'):
+                    expected = DB.VisaStatus.find_visa_status_past24h_turning_point_batch(visa_type, codes, timestamp)
+                with patched(DB.VisaStatus, detail_source='turning_point'):
+                    assert DB.VisaStatus.find_visa_status_past24h_turning_point_batch(visa_type, codes, timestamp) == \
+                        expected, timestamp
+
+            for source in ('visa_status', 'turning_point'):
+                with patched(DB.VisaStatus, detail_source=source):
+                    iterator = iter(timestamps)
+                    elapsed = timeit.timeit(
+                        lambda: DB.VisaStatus.find_visa_status_past24h_turning_point_batch(
+                            visa_type, codes, next(iterator)
+                        ),
+                        number=number,
+                    )
+                    report(f'detail of {len(codes)} embassies ({source})', elapsed, number)
+
+    visa_status.drop()
+    turning_point.drop()
+
+
+def bench_websocket_query(number: int) -> None:
+    """ Event loop lag while 64 websocket clients send `number` newest visa status queries in total:
+        the blocking pymongo call inside the coroutine against the executor-backed `async_mongodb`.
+        The lag is sampled every `LOOP_LAG_INTERVAL` seconds by a task sleeping on the same loop.
+    """
+    import asyncio
+
+    from fastapi import WebSocketDisconnect
+
+    import api_websocket
+    import async_mongodb as ADB
+    import tuixue_mongodb as DB
+    from scheduler import LatenessTracker
+
+    db = benchmark_database()
+    latest_written = db.get_collection('latest_written')
+    latest_written.drop()
+    write_time = datetime.now(timezone.utc).replace(tzinfo=None)
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()]
+    latest_written.insert_many([
+        {'visa_type': vt, 'embassy_code': ec, 'write_time': write_time, 'available_date': datetime(2021, 1, 1)}
+        for vt in G.VISA_TYPES for ec in embassy_codes
+    ])
+
+    clients = 64
+    queries = [[random.choice(G.VISA_TYPES), random.sample(embassy_codes, 4)] for _ in range(number)]
+
+    class FakeWebSocket:
+        def __init__(self, queries):
+            self.queries = iter(queries)
+            self.responses = []
+
+        async def receive_json(self):
+            await asyncio.sleep(0)  # a real websocket yields to the loop while waiting for the next query
+            try:
+                return next(self.queries)
+            except StopIteration:
+                raise WebSocketDisconnect()
+
+        async def send_json(self, data):
+            self.responses.append(data)
+
+    async def run():
+        monitor = asyncio.create_task(api_websocket.monitor_loop_lag())
+        websockets = [FakeWebSocket(queries[i::clients]) for i in range(clients)]
+        await asyncio.gather(*[api_websocket.get_newest_visa_status(ws) for ws in websockets], return_exceptions=True)
+        monitor.cancel()
+        return sum(len(ws.responses) for ws in websockets)
+
+    async def blocking(visa_type, embassy_code):
+        return DB.VisaStatus.find_latest_written_visa_status(visa_type, embassy_code)
+
+    with patched(DB.VisaStatus, latest_written=latest_written):
+        for name, find in (
+            ('blocking pymongo', blocking),
+            (f'{G.ASYNC_DB_WORKERS} executor threads', ADB.VisaStatus.find_latest_written_visa_status),
+        ):
+            with patched(ADB.VisaStatus, find_latest_written_visa_status=find), \
+                    patched(api_websocket, LOOP_LAG=LatenessTracker()):
+                start = time.monotonic()
+                assert asyncio.run(run()) == number
+                report(f'websocket query ({name})', time.monotonic() - start, number)
+                lag = api_websocket.LOOP_LAG.stats()
+                print('{:<48}{:>12.3f} ms p95 loop lag, {:.3f} ms max'.format(
+                    '', lag.get('lateness_p95', 0) * 1e3, lag.get('lateness_max', 0) * 1e3
+                ))
+
+    latest_written.drop()
+
+
+def bench_hot_window(number: int) -> None:
+    """ Latency of the detail of 1 and 10 embassies and of the latest written status: the MongoDB
+        queries against the hot window of the API, seeded from the same data then fed with events.
+        The window returns the same detail as the database for the last instant of a minute. Then
+        the memory of a full 48 hours window, every pair fetched every minute.
+    """
+    import tracemalloc
+
+    import numpy as np
+
+    import tuixue_mongodb as DB
+    from cache_events import CacheEvent
+    from hot_window import FetchedSeries, HotWindow, to_epoch_minute
+
+    db = benchmark_database()
+    visa_status, latest_written = db.get_collection('visa_status'), db.get_collection('latest_written')
+    visa_status.drop()
+    latest_written.drop()
+
+    visa_type, hours = 'F', 48
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()][:10]
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    start = now - timedelta(hours=hours)
+    events = []
+    with patched(DB.VisaStatus, visa_status=visa_status, latest_written=latest_written, storage='daily'):
+        for embassy_code in embassy_codes:
+            interval_sec = DB.VisaStatus.gap_seconds(visa_type, embassy_code) - 60
+            ops = {'visa_status': [], 'latest_written': []}
+            for fetch in irregular_fetches(start, hours - 1, interval_sec):
+                write_time = fetch['write_time']
+                available_date = fetch['available_date'].replace(hour=0, minute=0)  # dates are stored at midnight
+                for collection_name, op, _ in DB.VisaStatus.fetched_visa_status_ops(
+                    visa_type, embassy_code, write_time.replace(tzinfo=timezone.utc), available_date
+                ):
+                    if collection_name in ops:
+                        ops[collection_name].append(op)
+                events.append(CacheEvent(visa_type, embassy_code, write_time, True, available_date))
+            visa_status.bulk_write(ops['visa_status'])
+            latest_written.bulk_write(ops['latest_written'])
+
+        seeded = HotWindow(hours)
+        seed_start = time.monotonic()
+        seeded.seed(now=now + timedelta(minutes=1))
+        print('{:<48}{:>12.3f} s'.format('seed from MongoDB', time.monotonic() - seed_start))
+
+        fed = HotWindow(hours)
+        fed.covered_since = to_epoch_minute(start)
+        random.shuffle(events)  # late writes
+        for i in range(0, len(events), 100):
+            fed.apply(events[i:i + 100])
+
+        minutes = [now - timedelta(minutes=random.randint(0, 24 * 60 - 1)) for _ in range(number)]
+        timestamps = [minute + timedelta(seconds=59, microseconds=999000) for minute in minutes]  # BSON has ms
+        for codes in (embassy_codes[:1], embassy_codes):
+            for timestamp in timestamps[:max(1, number // 10)]:
+                assert seeded.covers(timestamp) and fed.covers(timestamp), timestamp
+                expected = DB.VisaStatus.find_visa_status_past24h_turning_point_batch(visa_type, codes, timestamp)
+                assert seeded.find_visa_status_past24h_turning_point_batch(visa_type, codes, timestamp) == expected
+                assert fed.find_visa_status_past24h_turning_point_batch(visa_type, codes, timestamp) == expected
+
+            for name, source in (('MongoDB', DB.VisaStatus), ('hot window', fed)):
+                iterator = iter(timestamps)
+                elapsed = timeit.timeit(
+                    lambda: source.find_visa_status_past24h_turning_point_batch(visa_type, codes, next(iterator)),
+                    number=number,
+                )
+                report(f'detail of {len(codes)} embassies ({name})', elapsed, number)
+
+        expected = DB.VisaStatus.find_latest_written_visa_status(visa_type, embassy_codes)
+        key = operator.itemgetter('embassy_code')
+        assert sorted(seeded.find_latest_written_visa_status(visa_type, embassy_codes), key=key) == \
+            sorted(expected, key=key)
+        for name, source in (('MongoDB', DB.VisaStatus), ('hot window', seeded)):
+            elapsed = timeit.timeit(
+                lambda: source.find_latest_written_visa_status(visa_type, embassy_codes[:4]), number=number
+            )
+            report(f'latest written of 4 embassies ({name})', elapsed, number)
+
+    visa_status.drop()
+    latest_written.drop()
+
+    tracemalloc.start()
+    full = HotWindow(hours)
+    minutes = np.arange(to_epoch_minute(start), to_epoch_minute(now), dtype=np.int32)
+    dates = np.full(len(minutes), (now + timedelta(days=30)).toordinal(), dtype=np.int32)
+    for vt in G.VISA_TYPES:
+        for emb in G.USEmbassy.get_embassy_lst():
+            full.series[(vt, emb.code)] = FetchedSeries.from_arrays(minutes, dates, full.minutes + 60)
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = full.stats()
+    print('{:<48}{:>12.3f} MiB for {} pairs, {} fetched minutes ({:.3f} MiB traced)'.format(
+        'memory of a full window', stats['nbytes'] / 2**20, stats['pair_cnt'], stats['fetched_minute_cnt'],
+        traced / 2**20,
+    ))
+
+
+def bench_detail_batch(number: int) -> None:
+    """ Cost of the detail of 1, 10 and all embassies out of a day of fetches, every minute or
+        every few minutes: `to_turning_points` embassy by embassy against the NumPy batch. That both
+        return the same detail is checked by tests/test_detail_batch.py.
+    """
+    import tuixue_mongodb as DB
+
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()]
+    timestamp = datetime(2021, 1, 2, 12, 30, 59)
+
+    def past24h(visa_type, embassy_code):
+        interval_sec = DB.VisaStatus.gap_seconds(visa_type, embassy_code) - 60
+        fetches = DB.VisaStatus.min_per_minute(
+            [
+                {**fetch, 'available_date': fetch['available_date'].replace(hour=0, minute=0, second=0)}
+                for fetch in irregular_fetches(timestamp - timedelta(days=1), 24, interval_sec)
+            ],
+            timestamp - timedelta(days=1),
+            timestamp,
+        )
+        return {
+            'visa_type': visa_type,
+            'embassy_code': embassy_code,
+            'time_range': [timestamp - timedelta(days=1), timestamp],
+            'available_dates': fetches,
+        }
+
+    for codes in (embassy_codes[:1], embassy_codes[:10], embassy_codes):
+        batch = [past24h('F', ec) for ec in codes]
+        for name, detail in (
+            ('loop', lambda: [DB.VisaStatus.to_turning_points(vs) for vs in batch]),
+            ('NumPy', lambda: DB.VisaStatus.to_turning_points_batch(batch)),
+        ):
+            report(f'detail of {len(codes)} embassies ({name})', timeit.timeit(detail, number=number), number)
+
+
+def bench_subscription_index(number: int) -> None:
+    """ Cost of finding the effective subscribers of a new visa status among 100k subscribers:
+        the scan `Subscription.get_email_list` does (the `$elemMatch` of every document, then the
+        `till` filter) against the binary search of the in-memory index. Both find the same
+        emails for `number` random statuses first, and the index stays equal to a rebuilt one
+        after `number` random edits.
+    """
+    from subscription_index import SubscriptionIndex, pair_tills
+
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()]
+    start = datetime(2021, 1, 1)
+
+    def random_subscription():
+        return [
+            {
+                'visa_type': random.choice(G.VISA_TYPES),
+                'embassy_code': random.choice(embassy_codes),
+                'till': random.choice([datetime.max, start + timedelta(days=random.randint(0, 365))]),
+            }
+            for _ in range(random.randint(1, 5))
+        ]
+
+    documents = {f'user{i}@example.com': random_subscription() for i in range(100000)}
+
+    def scan(visa_type, embassy_code, available_date, inclusion):
+        emails = []
+        for email, subscription in documents.items():
+            till = pair_tills(subscription).get((visa_type, embassy_code))
+            if till is not None and (
+                    inclusion == 'both' or
+                    (inclusion == 'effective_only' and till >= available_date) or
+                    (inclusion == 'expired_only' and till < available_date)):
+                emails.append(email)
+        return emails
+
+    def random_status():
+        available_date = start + timedelta(days=random.randint(0, 400))
+        return random.choice(G.VISA_TYPES), random.choice(embassy_codes), available_date
+
+    index = SubscriptionIndex()
+    begin = time.perf_counter()
+    index.rebuild({'email': email, 'subscription': subs} for email, subs in documents.items())
+    report('rebuild of 100k subscribers', time.perf_counter() - begin, 1)
+
+    for _ in range(min(number, 100)):  # the scan takes a while
+        visa_type, embassy_code, available_date = status = random_status()
+        for inclusion in ('both', 'effective_only', 'expired_only'):
+            found = index.get_email_list([status], inclusion).get((visa_type, embassy_code), [])
+            assert sorted(found) == sorted(scan(visa_type, embassy_code, available_date, inclusion))
+
+    emails = list(documents)
+    begin = time.perf_counter()
+    for _ in range(number):
+        email = random.choice(emails)
+        documents[email] = random_subscription() if random.random() < 0.8 else []
+        index.update(email, documents[email])
+    report('update of one subscriber', time.perf_counter() - begin, number)
+    rebuilt = SubscriptionIndex()
+    rebuilt.rebuild({'email': email, 'subscription': subs} for email, subs in documents.items() if subs)
+    assert index.subscribers == rebuilt.subscribers and index.tills_by_email == rebuilt.tills_by_email
+
+    statuses = [random_status() for _ in range(number)]
+    lookups = iter(statuses)
+    report('effective subscribers (index)', timeit.timeit(
+        lambda: index.get_email_list([next(lookups)], 'effective_only'), number=number), number)
+    scans = min(number, 10)
+    lookups = iter(statuses)
+    report('effective subscribers (scan)', timeit.timeit(
+        lambda: scan(*next(lookups), 'effective_only'), number=scans), scans)
+
+
+def bench_email_outbox(number: int) -> None:
+    """ Cost for the fetch thread of an email to 1000 receivers: `Notifier.send_email` posting to
+        a stub relay taking 50ms, against queueing it in the outbox. Then `number` emails to random
+        receivers are dispatched through a relay failing one post out of three: every receiver
+        gets every email, in posts of at most `MAX_EMAIL_SENT` receivers, within the rate limit.
+    """
+    from urllib.parse import parse_qs
+
+    from email_outbox import EmailOutbox
+    from notifier import Notifier
+
+    posts = []
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+            time.sleep(self.server.delay)
+            with lock:
+                posts.append((time.monotonic(), form['title'][0], form['receivers'][0].split('@@@')))
+                failed = self.server.failing and len(posts) % 3 == 0
+            content = b'error' if failed else b'success'
+            self.send_response(500 if failed else 200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.delay, server.failing = 0.05, False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    relay = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    receivers = [f'user{i}@example.com' for i in range(1000)]
+
+    outbox_collection = benchmark_database().get_collection('email_outbox')
+    outbox_collection.drop()
+    outbox = EmailOutbox(outbox_collection, relay, max_receivers=G.MAX_EMAIL_SENT, rate=20, backoff=(0.05, 0.5))
+    with patched(G, SECRET={**G.SECRET, 'email': relay}):
+        report('email to 1000 receivers (send_email)', timeit.timeit(
+            lambda: Notifier.send_email('bench', 'content', receivers), number=10), 10)
+    report('email to 1000 receivers (enqueue)', timeit.timeit(
+        lambda: outbox.enqueue('bench', 'content', receivers, 'from', 'to'), number=10), 10)
+    outbox_collection.drop()
+    posts.clear()
+
+    server.delay, server.failing = 0, True
+    expected = {}
+    for i in range(number):
+        expected[f'email {i}'] = random.sample(receivers, random.randint(1, len(receivers)))
+        outbox.enqueue(f'email {i}', 'content', expected[f'email {i}'], 'from', 'to')
+
+    start = time.monotonic()
+    outbox.start()
+    while outbox.depth().keys() - {'failed'}:
+        time.sleep(0.1)
+    elapsed = time.monotonic() - start
+    outbox.close()
+    server.shutdown()
+    server.server_close()
+
+    delivered = {title: set() for title in expected}
+    for _, title, post_receivers in posts:
+        assert len(post_receivers) <= G.MAX_EMAIL_SENT
+        delivered[title].update(post_receivers)
+    assert all(delivered[title] == set(expected[title]) for title in expected)
+    assert len(posts) <= 20 * (posts[-1][0] - posts[0][0]) + 2  # the rate limit, one token of slack
+    report('dispatched message', elapsed, outbox.sent_cnt)
+    print(f'{"":<48}{len(posts)} posts, {outbox.retry_cnt} retried, {outbox.failed_cnt} failed')
+    outbox_collection.drop()
+
+
+def bench_websocket_publisher(number: int) -> None:
+    """ Cost of sending a burst of `number` status changes to a local websocket server: a new event
+        loop and connection per change (the former `Notifier.send_via_websocket`), against the
+        long-lived publisher. The server drops the publisher's connection halfway, every change
+        still arrives once and in order.
+    """
+    import asyncio
+
+    import websockets
+    from websocket_publisher import WebSocketPublisher
+
+    received, connections = [], []
+
+    async def handler(ws, path=None):
+        connections.append(ws)
+        async for message in ws:
+            data = json.loads(message)
+            received.extend(data if isinstance(data, list) else [data])
+
+    async def serve():
+        return await websockets.serve(handler, '127.0.0.1', 0)
+
+    server_loop = asyncio.new_event_loop()
+    server = server_loop.run_until_complete(serve())
+    threading.Thread(target=server_loop.run_forever, daemon=True).start()
+    url = 'ws://127.0.0.1:{}'.format(list(server.sockets)[0].getsockname()[1])
+    changes = [{'visa_type': 'F', 'embassy_code': 'bj', 'seq': i} for i in range(number)]
+
+    def wait_received(count: int) -> None:
+        while len(received) < count:
+            time.sleep(0.01)
+
+    async def send_once(data):
+        async with websockets.connect(url) as ws:
+            await ws.send(json.dumps(data))
+
+    start = time.monotonic()
+    for change in changes[:min(number, 1000)]:
+        asyncio.run(send_once(change))
+    wait_received(min(number, 1000))
+    report('change (connection per change)', time.monotonic() - start, min(number, 1000))
+    received.clear()
+    connections.clear()
+
+    publisher = WebSocketPublisher(url, max_buffer=number, reconnect_delay=(0.01, 0.1))
+    start = time.monotonic()
+    for change in changes[:number // 2]:
+        publisher.publish(change)
+    wait_received(number // 2)
+    asyncio.run_coroutine_threadsafe(connections[0].close(), server_loop).result()
+    for change in changes[number // 2:]:
+        publisher.publish(change)
+    wait_received(number)
+    report('change (publisher)', time.monotonic() - start, number)
+    publisher.close()
+
+    assert received == changes
+    print(f'{"":<48}{publisher.batch_cnt} frames, {len(connections)} connections, {publisher.stats()}')
+    server_loop.call_soon_threadsafe(server.close)
+
+
+def legacy_send_qq(base_uri: str, group_ids: list, text: str) -> None:
+    """ The former `Notifier.send_qq_tg` to QQ: a new mirai session and process pool per change."""
+    from multiprocessing import Pool
+
+    session = requests_post_json(base_uri + '/auth', {'authKey': 'key'})['session']
+    requests_post_json(base_uri + '/verify', {'sessionKey': session, 'qq': 1})
+    post_args = [
+        (base_uri + '/sendGroupMessage', json.dumps({
+            'sessionKey': session, 'target': g, 'messageChain': [{'type': 'Plain', 'text': text}]
+        }))
+        for g in group_ids
+    ]
+    with Pool(len(post_args)) as pool:
+        pool.map(post_data, post_args)
+    requests_post_json(base_uri + '/release', {'sessionKey': session, 'qq': 1})
+
+
+def requests_post_json(url: str, data: dict) -> dict:
+    import requests
+    return requests.post(url, data=json.dumps(data)).json()
+
+
+def post_data(args: tuple) -> None:
+    import requests
+    url, data = args
+    requests.post(url, data=data)
+
+
+def bench_chat_notifier(number: int) -> None:
+    """ Cost for the fetch thread of a change posted to 3 QQ groups and a Telegram channel of a
+        stub server: a new mirai session and process pool per change, against the chat notifier.
+        Then `number` changes of random embassies from 8 threads arrive as one digest per channel
+        per window, the mirai session being renewed once when the stub expires it.
+    """
+    from chat_notifier import ChatNotifier
+
+    lock = threading.Lock()
+    messages = {}  # channel -> digests
+    sessions = {'valid': set(), 'auth_cnt': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def answer(self, body: dict) -> None:
+            content = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):  # telegram
+            from urllib.parse import parse_qs, urlparse
+            query = parse_qs(urlparse(self.path).query)
+            with lock:
+                messages.setdefault(('tg', query['chat_id'][0]), []).append(query['text'][0])
+            self.answer({'ok': True})
+
+        def do_POST(self):  # mirai
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            with lock:
+                if self.path == '/auth':
+                    sessions['auth_cnt'] += 1
+                    key = f'session{sessions["auth_cnt"]}'
+                    sessions['valid'].add(key)
+                    return self.answer({'code': 0, 'session': key})
+                if self.path == '/sendGroupMessage':
+                    if data['sessionKey'] not in sessions['valid']:
+                        return self.answer({'code': 3, 'msg': 'session expired'})
+                    messages.setdefault(('qq', data['target']), []).append(data['messageChain'][0]['text'])
+                if self.path == '/release':
+                    sessions['valid'].discard(data['sessionKey'])
+            self.answer({'code': 0, 'msg': 'success'})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_uri = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    group_ids = [1, 2, 3]
+    channels = [('qq', g) for g in group_ids] + [('tg', '-100')]
+
+    legacy_number = min(number, 20)
+    report('change (session and pool per change)', timeit.timeit(
+        lambda: legacy_send_qq(base_uri, group_ids, 'bench'), number=legacy_number), legacy_number)
+    messages.clear()
+    sessions['auth_cnt'] = 0
+
+    notifier = ChatNotifier(
+        {'mirai_base_uri': base_uri, 'mirai_auth_key': 'key', 'qq_num': 1},
+        {'tg_bot_token': 'token', 'proxy': None},
+        window=0.2,
+        telegram_base_uri=base_uri,
+    )
+    embassy_codes = [emb.code for emb in G.USEmbassy.get_embassy_lst()]
+    keys = [(random.choice(G.VISA_TYPES), random.choice(embassy_codes)) for _ in range(number)]
+
+    notify_sec = [0.0] * 8
+
+    def notify_all(part: int) -> None:
+        for i, key in enumerate(keys[part::8]):
+            if part == 0 and i == len(keys) // 16:
+                with lock:
+                    sessions['valid'].clear()  # mirai restarted
+            start = time.perf_counter()
+            notifier.notify(channels, key, ' '.join(key), '/', f'{i}/1')
+            notify_sec[part] += time.perf_counter() - start
+            time.sleep(0.0005)
+
+    threads = [threading.Thread(target=notify_all, args=(part,)) for part in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report('change (chat notifier)', sum(notify_sec), number)
+    while notifier.stats()['pending_cnt'] > 0 or notifier.digest_cnt < len(channels):
+        time.sleep(0.05)
+    time.sleep(0.2)  # the digests being posted
+    notifier.close()
+    server.shutdown()
+    server.server_close()
+
+    for channel in channels:
+        labels = {line.split(':')[0] for digest in messages[channel] for line in digest.split('\n') if ' -> ' in line}
+        assert labels == {' '.join(key) for key in keys}, channel
+    assert notifier.failed_cnt == 0 and sessions['auth_cnt'] == notifier.mirai.auth_cnt == 2
+    print(f'{"":<48}{len(messages[channels[0]])} digests per channel, {notifier.stats()}')
+
+
+BENCHMARKS = {
+    'chat_notifier': bench_chat_notifier,
+    'crawler_fetch': bench_crawler_fetch,
+    'detail_batch': bench_detail_batch,
+    'email_outbox': bench_email_outbox,
+    'embassy_lookup': bench_embassy_lookup,
+    'hot_window': bench_hot_window,
+    'overview_query': bench_overview_query,
+    'overview_storage': bench_overview_storage,
+    'session_cache': bench_session_cache,
+    'subscription_index': bench_subscription_index,
+    'turning_point': bench_turning_point,
+    'visa_status_storage': bench_visa_status_storage,
+    'websocket_publisher': bench_websocket_publisher,
+    'websocket_query': bench_websocket_query,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', '-t', required=True, choices=list(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--number', '-n', type=int, default=10000, help='number of operations to time')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.target](args.number)
@@ -0,0 +1,295 @@
+""" In-memory broadcasting of the new visa status events to the websocket subscribers."""
+import json
+import typing
+import asyncio
+from datetime import datetime
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi.encoders import jsonable_encoder
+
+Pair = typing.Tuple[str, str]  # (visa_type, embassy_code)
+
+
+# P.S. The broadcasting logic copy-paste a LOT of code from https://github.com/encode/broadcaster
+class VisaStatusUpdateEvent:
+    def __init__(
+        self,
+        visa_type: str,
+        embassy_code: str,
+        prev_avai_date: typing.Optional[datetime],
+        curr_avai_date: datetime
+    ) -> None:
+        self.visa_type = visa_type
+        self.embassy_code = embassy_code
+        self.prev_avai_date = prev_avai_date
+        self.curr_avai_date = curr_avai_date
+
+    def __repr__(self) -> str:
+        return 'VisaStatusUpdateEvent(\
+            visa_type={!r}, embassy_code={!r}, prev_avai_date={!r}, curr_avai_date={!r}\
+        )'.format(
+            self.visa_type,
+            self.embassy_code,
+            self.prev_avai_date,
+            self.curr_avai_date,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'visa_type': self.visa_type,
+            'embassy_code': self.embassy_code,
+            'prev_avai_date': self.prev_avai_date,
+            'curr_avai_date': self.curr_avai_date,
+        }
+
+    def to_message(self) -> str:
+        """ The notification sent to the clients, serialized once for all of them."""
+        return json.dumps(jsonable_encoder({'type': 'notification', 'data': self.to_dict()}))
+
+
+class BroadcastBackend:
+    """ An in-memory broadcaster backend.
+        Maintaining an event queue that publish every incoming event. There is no
+        channel distinguishment as there is only one channel in our case, therefore
+        no subscribe nor unsubscribe methods.
+    """
+    def __init__(self) -> None:
+        self.published_visa_status: asyncio.Queue = asyncio.Queue()
+
+    async def publish(
+        self,
+        visa_type: str,
+        embassy_code: str,
+        prev_avai_date: typing.Optional[datetime],
+        curr_avai_date: datetime,
+    ) -> None:
+        """ Publish a new visa status update."""
+        event = VisaStatusUpdateEvent(visa_type, embassy_code, prev_avai_date, curr_avai_date)
+        await self.published_visa_status.put(event)
+
+    async def next_published(self) -> VisaStatusUpdateEvent:
+        """ Listen to the visa status update event and dispatch event to the broadcaster."""
+        while True:
+            event: VisaStatusUpdateEvent = await self.published_visa_status.get()
+            # if (event.visa_type, event.embassy_code) in self.subscribed_visa_status:
+            return event
+
+
+class Broadcast:
+    """ Dispatch the published events to the subscribers. A subscriber receives every event until
+        it registers its interest in some `(visa_type, embassy_code)`, then only the events of
+        these. The subscribers are indexed by interest, an event is only put in the queues of the
+        subscribers interested in it, and serialized once for all of them.
+    """
+    default_channel = 'new_visa_status'
+
+    def __init__(self, queue_size: int = 64, overflow_policy: str = 'coalesce') -> None:
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.subscribers: typing.Dict[str, typing.Set['Subscriber']] = {}  # without interest registered
+        self.interested: typing.Dict[Pair, typing.Set['Subscriber']] = {}
+        self.interested_cnt = 0  # subscribers with an interest registered
+        self.backend = BroadcastBackend()
+        self.connected = False
+
+        self.connected_subscribers: typing.Set['Subscriber'] = set()
+
+        # metrics
+        self.published_cnt = 0
+        self.delivered_cnt = 0
+        self.dropped_cnt = 0
+        self.coalesced_cnt = 0
+        self.evicted_cnt: typing.Dict[str, int] = {'overflow': 0, 'timeout': 0}
+
+    async def __aenter__(self) -> 'Broadcast':
+        self.connect()
+        return self
+
+    async def __aexit__(self, *args, **kwargs) -> None:
+        self.disconnect()
+
+    async def connect(self):
+        self.listener_task = asyncio.create_task(self.listener())
+        self.connected = True
+
+    async def disconnect(self):
+        if self.listener_task.done():
+            self.listener_task.result()
+        else:
+            self.listener_task.cancel()
+        self.connected = False
+
+    async def listener(self) -> None:
+        """ Dispatch new visa status event to the subscribers interested in it. Putting an event in
+            a queue never waits, a full queue is handled by the overflow policy of the subscriber.
+        """
+        while True:
+            event = await self.backend.next_published()
+            message = event.to_message()
+            pair = (event.visa_type, event.embassy_code)
+            subscribers = self.matching(*pair)
+            for subscriber in subscribers:
+                outcome = subscriber.offer(pair, message)
+                if outcome == 'dropped':
+                    self.dropped_cnt += 1
+                elif outcome == 'coalesced':
+                    self.coalesced_cnt += 1
+                elif outcome == 'overflowed':
+                    self.evict(subscriber, 'overflow')
+            self.published_cnt += 1
+            self.delivered_cnt += len(subscribers)
+            await asyncio.sleep(0)  # the receivers send it before the next event of a burst is queued
+
+    def matching(self, visa_type: str, embassy_code: str) -> typing.List['Subscriber']:
+        """ Return the subscribers to send an event of `(visa_type, embassy_code)` to."""
+        return [
+            *self.subscribers.get(self.default_channel, ()),
+            *self.interested.get((visa_type, embassy_code), ()),
+        ]
+
+    def set_interest(self, subscriber: 'Subscriber', interest: typing.Iterable[Pair]) -> None:
+        """ Only send the events of the given `(visa_type, embassy_code)` to a subscriber from now on.
+            A subscriber evicted or unsubscribed meanwhile, e.g. while its query was handled, stays out.
+        """
+        if subscriber.closed:
+            return
+        self.unindex(subscriber)
+        subscriber.interest = frozenset(interest)
+        self.index(subscriber)
+
+    def index(self, subscriber: 'Subscriber') -> None:
+        subscriber.indexed = True
+        if subscriber.interest is None:
+            self.subscribers.setdefault(self.default_channel, set()).add(subscriber)
+        else:
+            self.interested_cnt += 1
+        for pair in subscriber.interest or ():
+            self.interested.setdefault(pair, set()).add(subscriber)
+
+    def unindex(self, subscriber: 'Subscriber') -> None:
+        """ Remove a subscriber from the index, a no-op if it's not indexed."""
+        if not subscriber.indexed:
+            return
+        subscriber.indexed = False
+        if subscriber.interest is None:
+            self.subscribers.get(self.default_channel, set()).discard(subscriber)
+        else:
+            self.interested_cnt -= 1
+        for pair in subscriber.interest or ():
+            subscribers = self.interested[pair]
+            subscribers.discard(subscriber)
+            if len(subscribers) == 0:
+                del self.interested[pair]
+
+    def evict(self, subscriber: 'Subscriber', reason: str) -> None:
+        """ Stop notifying a subscriber too slow to keep up, its websocket is closed."""
+        if not subscriber.evicted:
+            self.unindex(subscriber)
+            subscriber.evicted = reason
+            subscriber.close()
+            self.evicted_cnt[reason] += 1
+
+    async def publish(
+        self,
+        visa_type: str,
+        embassy_code: str,
+        prev_avai_date: typing.Optional[datetime],
+        curr_avai_date: datetime,
+    ) -> None:
+        """ Publish a new visa status event. Meant to be called by notifier."""
+        await self.backend.publish(visa_type, embassy_code, prev_avai_date, curr_avai_date)
+
+    @asynccontextmanager
+    async def subscribe(self):
+        subscriber = Subscriber(self.queue_size, self.overflow_policy)
+
+        try:
+            # subscribe at context manager entering, to every event until an interest is registered
+            # if there is a third party (e.g. Redis) backend here, subscribe here
+            self.index(subscriber)
+            self.connected_subscribers.add(subscriber)
+
+            yield subscriber
+        finally:
+            # unsubscribe at context manager exiting
+            self.connected_subscribers.discard(subscriber)
+            self.unindex(subscriber)
+            subscriber.close()  # End iterational wait in the websocket route
+
+    def stats(self) -> dict:
+        depths = sorted(len(subscriber.messages) for subscriber in self.connected_subscribers)
+        return {
+            'subscriber_cnt': len(self.subscribers.get(self.default_channel, ())),
+            'interested_pair_cnt': len(self.interested),
+            'interested_cnt': self.interested_cnt,
+            'published_cnt': self.published_cnt,
+            'delivered_cnt': self.delivered_cnt,
+            'queued': sum(depths),
+            'queue_depth_p95': depths[int(0.95 * (len(depths) - 1))] if len(depths) > 0 else 0,
+            'queue_depth_max': depths[-1] if len(depths) > 0 else 0,
+            'dropped_cnt': self.dropped_cnt,
+            'coalesced_cnt': self.coalesced_cnt,
+            'evicted_cnt': dict(self.evicted_cnt),
+        }
+
+
+class Unsubscribed(Exception):
+    pass
+
+
+class Subscriber:
+    """ The notifications waiting to be sent to a client, at most `maxsize` of them. When the
+        queue is full, the overflow `policy` either drops the oldest notification (`'drop_oldest'`),
+        replaces the notification of the same `(visa_type, embassy_code)` if one is waiting and
+        drops the oldest otherwise (`'coalesce'`), or gives up on the client (`'disconnect'`).
+    """
+    def __init__(self, maxsize: int, policy: str = 'coalesce'):
+        if policy not in ('drop_oldest', 'coalesce', 'disconnect'):
+            raise ValueError('`policy` only accept one of \'drop_oldest\', \'coalesce\' or \'disconnect\'')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.messages: typing.Deque[typing.List] = deque()  # [pair, message]
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.evicted: typing.Optional[str] = None  # the reason
+        self.interest: typing.Optional[typing.FrozenSet[Pair]] = None  # None for every event
+        self.indexed = False  # by `Broadcast.index`
+
+    def offer(self, key: Pair, message: str) -> str:
+        """ Queue a notification without waiting, return `'queued'`, `'dropped'` (the oldest one
+            was), `'coalesced'` or `'overflowed'` when the client must be disconnected.
+        """
+        outcome = 'queued'
+        if len(self.messages) >= self.maxsize:
+            if self.policy == 'disconnect':
+                return 'overflowed'
+            if self.policy == 'coalesce':
+                for queued in reversed(self.messages):  # the latest of the key, keeping the order
+                    if queued[0] == key:
+                        queued[1] = message
+                        return 'coalesced'
+            self.messages.popleft()
+            outcome = 'dropped'
+        self.messages.append([key, message])
+        self.ready.set()
+        return outcome
+
+    def close(self) -> None:
+        self.closed = True
+        self.ready.set()
+
+    async def __aiter__(self):
+        try:
+            while True:
+                yield await self.get_message()
+        except Unsubscribed:
+            pass
+
+    async def get_message(self) -> str:
+        """ Return the next notification, serialized."""
+        while len(self.messages) == 0 and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        if self.closed:
+            raise Unsubscribed()
+        return self.messages.popleft()[1]
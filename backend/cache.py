@@ -0,0 +1,204 @@
+""" A thread-safe, size-bounded LRU cache whose entries expire after a TTL.
+    Concurrent misses of the same key are collapsed: one thread computes the value while the
+    others wait for it, instead of all of them hitting the database at once. Misses of several
+    keys can be computed together, e.g. with one batched query. A value invalidated while it's
+    being computed is returned to the computing thread but not cached, since it may reflect the
+    data as it was before the invalidation.
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, Union
+
+TTL = Union[float, Callable[[Hashable], float], None]  # seconds, or seconds by key
+
+
+class TTLCache:
+    """ Keep at most `maxsize` entries, evict the least recently used one first. An entry is
+        valid for `ttl` seconds unless another TTL is given when it's computed.
+    """
+    def __init__(self, maxsize: int, ttl: float, name: str = 'cache') -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+
+        self.lock = threading.Lock()
+        self.data: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()  # key -> (expire_at, value)
+        self.in_flight: Dict[Hashable, threading.Event] = {}
+        self.stale: Set[Hashable] = set()  # in-flight keys invalidated since their computation started
+
+        # metrics
+        self.hit_cnt = 0
+        self.miss_cnt = 0
+        self.coalesced_cnt = 0
+        self.expired_cnt = 0
+        self.eviction_cnt = 0
+        self.invalidated_cnt = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def stats(self) -> dict:
+        """ Return the size and the counters of the cache."""
+        return {
+            'name': self.name,
+            'size': len(self.data),
+            'hit_cnt': self.hit_cnt,
+            'miss_cnt': self.miss_cnt,
+            'coalesced_cnt': self.coalesced_cnt,
+            'expired_cnt': self.expired_cnt,
+            'eviction_cnt': self.eviction_cnt,
+            'invalidated_cnt': self.invalidated_cnt,
+        }
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Return the value of a key if it's cached and not expired, else `default`."""
+        with self.lock:
+            return self._get(key, default)
+
+    def _get(self, key: Hashable, default: Any) -> Any:
+        """ `get` without locking, the caller must hold `self.lock`."""
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+
+        expire_at, value = entry
+        if expire_at <= time.monotonic():
+            del self.data[key]
+            self.expired_cnt += 1
+            return default
+
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: TTL = None) -> None:
+        """ Cache a value, evicting the least recently used entries beyond `maxsize`."""
+        if callable(ttl):
+            ttl = ttl(key)
+        with self.lock:
+            self._put(key, value, ttl)
+
+    def _put(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        """ `put` without locking, the caller must hold `self.lock`."""
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.eviction_cnt += 1
+
+    def put_computed(self, key: Hashable, value: Any, ttl: TTL) -> None:
+        """ Cache a computed value unless the key was invalidated during the computation."""
+        if callable(ttl):
+            ttl = ttl(key)
+        with self.lock:
+            if key in self.stale:
+                self.stale.discard(key)
+                return
+            self._put(key, value, ttl)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any], ttl: TTL = None) -> Any:
+        """ Return the cached value of a key, or compute and cache it. Only one thread computes
+            a given key at a time. If it fails, the exception is raised in that thread and one
+            of the waiting threads tries again.
+        """
+        missing = object()
+        while True:
+            with self.lock:
+                value = self._get(key, missing)
+                if value is not missing:
+                    self.hit_cnt += 1
+                    return value
+
+                flight = self.in_flight.get(key)
+                if flight is None:
+                    flight = self.in_flight[key] = threading.Event()
+                    self.miss_cnt += 1
+                    break
+                self.coalesced_cnt += 1
+
+            flight.wait()
+
+        try:
+            value = compute()
+            self.put_computed(key, value, ttl)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                self.stale.discard(key)
+            flight.set()
+
+    def get_many_or_compute(
+        self,
+        keys: List[Hashable],
+        compute: Callable[[List[Hashable]], Dict[Hashable, Any]],
+        ttl: TTL = None,
+    ) -> Dict[Hashable, Any]:
+        """ Return the values of `keys`. The missing keys nobody else is computing are passed
+            to one `compute` call, which returns their values by key, then the keys computed by
+            other threads are waited for.
+        """
+        missing = object()
+        values = {}
+        with self.lock:
+            computing, waiting = [], []
+            for key in dict.fromkeys(keys):  # unique, in order
+                value = self._get(key, missing)
+                if value is not missing:
+                    values[key] = value
+                    self.hit_cnt += 1
+                elif key in self.in_flight:
+                    waiting.append(key)
+                    self.coalesced_cnt += 1
+                else:
+                    computing.append(key)
+                    self.in_flight[key] = threading.Event()
+                    self.miss_cnt += 1
+            flights = {key: self.in_flight[key] for key in [*computing, *waiting]}
+
+        if len(computing) > 0:
+            try:
+                computed = compute(computing)
+                for key in computing:
+                    values[key] = computed.get(key)
+                    self.put_computed(key, values[key], ttl)
+            finally:
+                with self.lock:
+                    for key in computing:
+                        del self.in_flight[key]
+                        self.stale.discard(key)
+                for key in computing:
+                    flights[key].set()
+
+        for key in waiting:
+            flights[key].wait()
+            values[key] = self.get(key, missing)
+            if values[key] is missing:  # the other thread failed, the entry is stale or gone already
+                values[key] = self.get_or_compute(key, lambda: compute([key]).get(key), ttl)
+        return values
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """ Drop the entries whose key matches `predicate`, return the number of dropped entries."""
+        with self.lock:
+            keys = [key for key in self.data if predicate(key)]
+            for key in keys:
+                del self.data[key]
+            self.stale.update(key for key in self.in_flight if predicate(key))
+            self.invalidated_cnt += len(keys)
+        return len(keys)
+
+    def discard(self, keys: Iterable[Hashable]) -> int:
+        """ Drop the entries of `keys`, return the number of dropped entries."""
+        dropped = 0
+        with self.lock:
+            for key in keys:
+                if self.data.pop(key, None) is not None:
+                    dropped += 1
+                if key in self.in_flight:
+                    self.stale.add(key)
+            self.invalidated_cnt += dropped
+        return dropped
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
@@ -0,0 +1,435 @@
+""" Cache invalidation events from the fetcher to the API processes.
+    The fetcher publishes one `CacheEvent` for every fetched result written to MongoDB, the API
+    processes listen to them and drop exactly the cached response fragments the write affects,
+    so the fragments can be cached much longer than one fetch interval.
+
+    Two transports are available:
+    - `LocalBus`: in-process queues, for a fetcher and an API living in the same process (tests,
+      benchmarks).
+    - `UnixSocketPublisher`/`UnixSocketSubscriber`: one UNIX datagram socket per API process
+      in a shared directory, the publisher sends every event to all of them. Publishing never
+      blocks the fetcher, an event that can't be delivered is dropped and the fragments only
+      expire with their TTL. The datagrams are numbered, so the subscriber counts the lost ones
+      and the listener can resynchronize whatever state is kept current by the events. An idle
+      publisher sends an empty datagram every `heartbeat_interval` seconds: a loss is noticed
+      within a heartbeat, and a listener hearing nothing knows the publisher is gone.
+
+    The first datagram of a publisher counts as a loss: the events published before it found the
+    socket are unknown, so the state kept current by the events is only loaded once it arrives.
+
+    The transports carry any event class with `to_json` and `from_json`, the subscription changes
+    of the API go the other way with the same transports, see subscription_index.py.
+"""
+import os
+import json
+import glob
+import time
+import queue
+import socket
+import logging
+import threading
+from datetime import datetime
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple, Type, Union
+
+MAX_DATAGRAM_SIZE = 32768
+
+
+class CacheEvent(NamedTuple):
+    """ A fetched result of `(visa_type, embassy_code)` written at `write_time` (naive UTC).
+        `overview_changed` is False when the overview of the embassy-local date of the write
+        is known to be unchanged, i.e. the same available date was written earlier that day.
+        `available_date` is the fetched date, None when the fetch found no date.
+    """
+    visa_type: str
+    embassy_code: str
+    write_time: datetime
+    overview_changed: bool = True
+    available_date: Optional[datetime] = None
+
+    def to_json(self) -> list:
+        available_date = None if self.available_date is None else self.available_date.isoformat()
+        return [self.visa_type, self.embassy_code, self.write_time.isoformat(), self.overview_changed, available_date]
+
+    @classmethod
+    def from_json(cls, obj: list) -> 'CacheEvent':
+        visa_type, embassy_code, write_time, overview_changed, *rest = obj  # no date from the older fetchers
+        available_date = rest[0] if len(rest) > 0 else None
+        return cls(
+            visa_type,
+            embassy_code,
+            datetime.fromisoformat(write_time),
+            overview_changed,
+            None if available_date is None else datetime.fromisoformat(available_date),
+        )
+
+
+def pack_events(events: List[CacheEvent], reserved: int = 0) -> Iterator[bytes]:
+    """ Encode the events as JSON arrays of at most `MAX_DATAGRAM_SIZE - reserved` bytes."""
+    encoded = [json.dumps(event.to_json()).encode() for event in events]
+    start, size = 0, 2 + reserved  # the brackets
+    for i, data in enumerate(encoded):
+        if i > start and size + len(data) + 1 > MAX_DATAGRAM_SIZE:
+            yield b'[' + b','.join(encoded[start:i]) + b']'
+            start, size = i, 2 + reserved
+        size += len(data) + 1
+    if start < len(encoded):
+        yield b'[' + b','.join(encoded[start:]) + b']'
+
+
+def unpack_events(data: bytes, event_type: Type = CacheEvent) -> List[Any]:
+    return [event_type.from_json(obj) for obj in json.loads(data)]
+
+
+def number_datagram(source: str, seq: int, datagram: bytes) -> bytes:
+    """ Prefix a datagram of `pack_events` with its sender and sequence number."""
+    return f'{source} {seq} '.encode() + datagram
+
+
+def unnumber_datagram(data: bytes) -> Tuple[str, int, bytes]:
+    """ Split a datagram of `number_datagram` into its sender, sequence number and events."""
+    source, seq, datagram = data.split(b' ', 2)
+    return source.decode(), int(seq), datagram
+
+
+class LocalSubscriber:
+    """ The receiving end of a `LocalBus`."""
+    def __init__(self) -> None:
+        self.queue: 'queue.Queue[CacheEvent]' = queue.Queue()
+        self.heard_at = float('-inf')  # time.monotonic() of the last event
+        self.heard = False
+        self.lost = 0
+
+    def receive(self, timeout: Optional[float] = None) -> List[CacheEvent]:
+        """ Wait at most `timeout` seconds for an event, return it with the ones already queued."""
+        try:
+            events = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        if not self.heard:  # the first event, like a new publisher
+            self.heard, self.lost = True, 1
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def take_lost(self) -> int:
+        """ Nothing is lost in a queue, only the first event counts as a loss."""
+        lost, self.lost = self.lost, 0
+        return lost
+
+    def close(self) -> None:
+        pass
+
+
+class LocalBus:
+    """ Deliver the published events to every subscriber of the same process. There are no
+        heartbeats, the subscribers only hear from the bus when events are published.
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.subscribers: List[LocalSubscriber] = []
+        self.published_cnt = 0
+
+    def subscribe(self) -> LocalSubscriber:
+        subscriber = LocalSubscriber()
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: LocalSubscriber) -> None:
+        with self.lock:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, event: CacheEvent) -> None:
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.queue.put(event)
+            subscriber.heard_at = time.monotonic()
+        self.published_cnt += 1
+
+    def stats(self) -> dict:
+        return {'subscriber_cnt': len(self.subscribers), 'published_cnt': self.published_cnt}
+
+
+class UnixSocketPublisher:
+    """ Send the events to every `*.sock` datagram socket in `socket_dir`. The directory is
+        re-listed when its modification time changes, and at least every `rescan_interval`
+        seconds, to find the API processes started since.
+
+        `publish` only queues the event, a sender thread packs the queued events into as few
+        datagrams as possible: the kernel queues only a few datagrams per socket
+        (`net.unix.max_dgram_qlen`) whatever their size. A datagram that can't be sent within
+        `send_timeout` seconds is dropped. Without events for `heartbeat_interval` seconds, an
+        empty datagram is sent.
+    """
+    def __init__(
+        self,
+        socket_dir: str,
+        rescan_interval: float = 5,
+        send_timeout: float = 0.1,
+        heartbeat_interval: float = 10,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.socket_dir = socket_dir
+        self.rescan_interval = rescan_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.logger = logger or logging.getLogger('cache_events')
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.settimeout(send_timeout)
+        self.source = f'{os.getpid()}-{int(time.time())}'  # a restarted publisher numbers from 0 again
+        self.seq = 0
+        self.paths: List[str] = []
+        self.scanned_at = float('-inf')
+        self.scanned_mtime: Optional[int] = None
+
+        self.pending: Deque[CacheEvent] = deque()
+        self.wakeup = threading.Event()
+        self.sender = threading.Thread(target=self.run, name='cache_events', daemon=True)
+        self.sender.start()
+
+        # metrics
+        self.published_cnt = 0
+        self.sent_cnt = 0
+        self.dropped_cnt = 0
+
+    def subscriber_paths(self) -> List[str]:
+        """ Return the sockets of the listening API processes."""
+        try:
+            mtime = os.stat(self.socket_dir).st_mtime_ns  # a socket was bound or removed
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.scanned_mtime or time.monotonic() - self.scanned_at > self.rescan_interval:
+            self.paths = glob.glob(os.path.join(self.socket_dir, '*.sock'))
+            self.scanned_at, self.scanned_mtime = time.monotonic(), mtime
+        return self.paths
+
+    def publish(self, event: CacheEvent) -> None:
+        self.pending.append(event)
+        self.published_cnt += 1
+        self.wakeup.set()
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait(self.heartbeat_interval)
+            self.wakeup.clear()
+            events = []
+            while len(self.pending) > 0:
+                events.append(self.pending.popleft())
+            datagrams = list(pack_events(events, reserved=64)) or [b'[]']  # room for the numbering, or a heartbeat
+            for datagram in datagrams:
+                self.send(number_datagram(self.source, self.seq, datagram))
+                self.seq += 1
+
+    def send(self, datagram: bytes) -> None:
+        """ Send a datagram to every listening API process. The same sequence number goes to
+            every process, a process that missed a datagram sees a gap in the numbers.
+        """
+        for path in list(self.subscriber_paths()):
+            try:
+                self.sock.sendto(datagram, path)
+                self.sent_cnt += 1
+            except socket.timeout:  # the receiving buffer stays full, the API is too slow to keep up
+                self.dropped_cnt += 1
+            except (ConnectionRefusedError, FileNotFoundError):  # the API process is gone
+                self.dropped_cnt += 1
+                self.paths.remove(path)
+            except OSError:
+                self.dropped_cnt += 1
+                self.logger.exception('Failed to send cache events to %s', path)
+
+    def stats(self) -> dict:
+        """ Return the number of published events and of the datagrams sent and dropped."""
+        return {
+            'subscriber_cnt': len(self.paths),
+            'pending': len(self.pending),
+            'published_cnt': self.published_cnt,
+            'sent_cnt': self.sent_cnt,
+            'dropped_cnt': self.dropped_cnt,
+        }
+
+
+class UnixSocketSubscriber:
+    """ Receive the events on a datagram socket `{socket_dir}/{pid}.sock`, and count the datagrams
+        lost by the gaps in their sequence numbers. The first datagram of a source counts as one
+        lost, the ones sent before the publisher found the socket are unknown.
+    """
+    def __init__(self, socket_dir: str, event_type: Type = CacheEvent) -> None:
+        self.event_type = event_type
+        os.makedirs(socket_dir, exist_ok=True)
+        self.path = os.path.join(socket_dir, f'{os.getpid()}.sock')
+        if os.path.exists(self.path):  # left by a dead process of the same pid
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+        self.next_seqs: Dict[str, int] = {}  # source -> expected sequence number
+        self.lost = 0  # since the last `take_lost`
+        self.lost_cnt = 0
+        self.new_source_cnt = 0
+        self.heard_at = float('-inf')  # time.monotonic() of the last datagram, events or heartbeat
+
+    def receive(self, timeout: Optional[float] = None) -> List[CacheEvent]:
+        """ Wait at most `timeout` seconds for events, return them with the ones already received."""
+        self.sock.settimeout(timeout)
+        try:
+            datagrams = [self.sock.recv(MAX_DATAGRAM_SIZE)]
+        except socket.timeout:
+            return []
+
+        self.sock.setblocking(False)
+        while True:
+            try:
+                datagrams.append(self.sock.recv(MAX_DATAGRAM_SIZE))
+            except BlockingIOError:
+                break
+        self.heard_at = time.monotonic()
+
+        events = []
+        for data in datagrams:
+            source, seq, datagram = unnumber_datagram(data)
+            next_seq = self.next_seqs.get(source)
+            if next_seq is None:  # a publisher started, or found this socket, in the meantime
+                self.lost += 1
+                self.new_source_cnt += 1
+            elif seq > next_seq:
+                self.lost += seq - next_seq
+                self.lost_cnt += seq - next_seq
+            self.next_seqs[source] = seq + 1
+            events.extend(unpack_events(datagram, self.event_type))
+        return events
+
+    def take_lost(self) -> int:
+        """ Return the number of datagrams lost since the last call."""
+        lost, self.lost = self.lost, 0
+        return lost
+
+    def close(self) -> None:
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class CacheEventListener:
+    """ Pass the received events to `handle` in batches, in a daemon thread. `on_loss` is called
+        before the events received after lost ones are handled, the first datagram of a publisher
+        included, and when nothing was heard from the publisher for `silence_timeout` seconds: the
+        writes meanwhile may be unannounced. The state `on_loss` loads is thus loaded once the
+        publisher is heard from, not before.
+    """
+    def __init__(
+        self,
+        subscriber: Union[LocalSubscriber, UnixSocketSubscriber],
+        handle: Callable[[List[CacheEvent]], None],
+        on_loss: Optional[Callable[[], None]] = None,
+        silence_timeout: Optional[float] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.subscriber = subscriber
+        self.handle = handle
+        self.on_loss = on_loss
+        self.silence_timeout = silence_timeout
+        self.logger = logger or logging.getLogger('cache_events')
+
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.silent = True  # nothing heard yet
+
+        # metrics
+        self.received_cnt = 0
+        self.batch_cnt = 0
+        self.loss_cnt = 0
+        self.silence_cnt = 0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def live(self) -> bool:
+        """ Whether the publisher was heard from within `silence_timeout` seconds, i.e. the
+            writes are announced.
+        """
+        if not self.running:
+            return False
+        if self.silence_timeout is None:
+            return True
+        return time.monotonic() - self.subscriber.heard_at <= self.silence_timeout
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name='cache_events', daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                events = self.subscriber.receive(timeout=1)
+                if self.subscriber.take_lost() > 0:
+                    self.loss_cnt += 1
+                    self.logger.warning('Cache events lost, or a new publisher')
+                    if self.on_loss is not None:
+                        self.on_loss()
+                if self.live:
+                    self.silent = False
+                elif not self.silent:
+                    self.silent = True
+                    self.silence_cnt += 1
+                    self.logger.warning('No cache events for %.0f seconds', self.silence_timeout)
+                    if self.on_loss is not None:
+                        self.on_loss()
+                if len(events) > 0:
+                    self.handle(events)
+                    self.received_cnt += len(events)
+                    self.batch_cnt += 1
+            except Exception:
+                self.logger.exception('Failed to handle cache events')
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.subscriber.close()
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'live': self.live,
+            'received_cnt': self.received_cnt,
+            'batch_cnt': self.batch_cnt,
+            'loss_cnt': self.loss_cnt,
+            'silence_cnt': self.silence_cnt,
+        }
+
+
+LOCAL_BUSES: Dict[str, LocalBus] = {}  # socket_dir -> bus, one per kind of events
+
+
+def local_bus(socket_dir: str) -> LocalBus:
+    return LOCAL_BUSES.setdefault(socket_dir, LocalBus())
+
+
+def connect_publisher(
+    transport: Optional[str],
+    socket_dir: str,
+    heartbeat_interval: float = 10,
+    logger: Optional[logging.Logger] = None,
+):
+    """ Return the publisher of a transport: `'unix'`, `'local'` or None for no events."""
+    if transport == 'unix':
+        return UnixSocketPublisher(socket_dir, heartbeat_interval=heartbeat_interval, logger=logger)
+    if transport == 'local':
+        return local_bus(socket_dir)
+    return None
+
+
+def connect_subscriber(transport: Optional[str], socket_dir: str, event_type: Type = CacheEvent):
+    """ Return the subscriber of a transport: `'unix'`, `'local'` or None for no events."""
+    if transport == 'unix':
+        return UnixSocketSubscriber(socket_dir, event_type)
+    if transport == 'local':
+        return local_bus(socket_dir).subscribe()
+    return None
@@ -0,0 +1,238 @@
+""" A sender of the digests of the status changes to the QQ groups and the Telegram channels."""
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import requests
+
+Channel = Tuple[str, Hashable]  # ('qq', group_id) or ('tg', chat_id)
+
+MIRAI_INVALID_SESSION = (3, 4)  # the session doesn't exist (any more), or isn't verified
+MESSAGE_LIMIT = 4096  # characters of a Telegram message
+
+
+class ChatPostError(Exception):
+    """ The chat service answered a post with an error."""
+
+
+def split_digest(lines: List[str], limit: int) -> List[str]:
+    """ Join the lines into as few messages of at most `limit` characters as possible, a line
+        longer than `limit` is cut.
+    """
+    messages, current = [], ''
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = ''
+        current = f'{current}\n{line}' if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+class MiraiSession:
+    """ A mirai-api-http session, authenticated on first use and again after `ttl` seconds or when
+        mirai says it's invalid.
+    """
+    def __init__(self, http: requests.Session, base_uri: str, auth_key: str, qq_num: int, ttl: float) -> None:
+        self.http = http
+        self.base_uri = base_uri
+        self.auth_key = auth_key
+        self.qq_num = qq_num
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.session_key: Optional[str] = None
+        self.authenticated_at = float('-inf')
+        self.auth_cnt = 0
+
+    def key(self) -> str:
+        with self.lock:
+            if self.session_key is None or time.monotonic() - self.authenticated_at > self.ttl:
+                self.release_locked()
+                session_key = self.post('/auth', {'authKey': self.auth_key})['session']
+                self.post('/verify', {'sessionKey': session_key, 'qq': self.qq_num})
+                self.session_key, self.authenticated_at = session_key, time.monotonic()
+                self.auth_cnt += 1
+            return self.session_key
+
+    def invalidate(self, session_key: str) -> None:
+        with self.lock:
+            if self.session_key == session_key:
+                self.session_key = None
+
+    def release(self) -> None:
+        with self.lock:
+            self.release_locked()
+
+    def release_locked(self) -> None:
+        if self.session_key is not None:
+            session_key, self.session_key = self.session_key, None
+            try:
+                self.post('/release', {'sessionKey': session_key, 'qq': self.qq_num})
+            except requests.RequestException:
+                pass  # it expires anyway
+
+    def post(self, path: str, data: dict) -> dict:
+        return self.http.post(self.base_uri + path, data=json.dumps(data), timeout=10).json()
+
+    def send_group_message(self, group_id: int, text: str) -> dict:
+        """ Send a plain text to a group, with a new session if the current one is invalid."""
+        for _ in range(2):
+            session_key = self.key()
+            res = self.post('/sendGroupMessage', {
+                'sessionKey': session_key,
+                'target': group_id,
+                'messageChain': [{'type': 'Plain', 'text': text}],
+            })
+            if res.get('code') not in MIRAI_INVALID_SESSION:
+                break
+            self.invalidate(session_key)
+        return res
+
+
+class ChatNotifier:
+    """ Post a digest of the changes of the last `window` seconds to every channel. The QQ digest
+        ends with `footer`. `qq` and `telegram` are the `SECRET` sections of the same name.
+    """
+    def __init__(
+        self,
+        qq: dict,
+        telegram: dict,
+        footer: str = '',
+        window: float = 5,
+        session_ttl: float = 1200,
+        max_workers: int = 8,
+        telegram_base_uri: str = 'https://api.telegram.org',
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.footer = footer
+        self.window = window
+        self.telegram = telegram
+        self.telegram_base_uri = telegram_base_uri
+        self.logger = logger or logging.getLogger('chat_notifier')
+
+        self.http = requests.Session()
+        self.http.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+        self.http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+        self.mirai = MiraiSession(self.http, qq['mirai_base_uri'], qq['mirai_auth_key'], qq['qq_num'], session_ttl)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat_notifier')
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = threading.Event()
+        self.pending: Dict[Channel, Dict[Hashable, List[str]]] = {}  # channel -> key -> [label, prev, curr]
+        self.deadlines: Dict[Channel, float] = {}  # the end of the window of every pending channel
+
+        # metrics
+        self.change_cnt = 0
+        self.coalesced_cnt = 0
+        self.digest_cnt = 0
+        self.failed_cnt = 0
+
+        self.thread = threading.Thread(target=self.run, name='chat_notifier', daemon=True)
+        self.thread.start()
+
+    def notify(self, channels: List[Channel], key: Hashable, label: str, prev: str, curr: str) -> None:
+        """ Record the change `label: prev -> curr` for the channels, from any thread. A later change
+            of the same `key` in the same window replaces its `curr`, keeping the first `prev`, and
+            the change is dropped if it's back to its `prev`.
+        """
+        with self.lock:
+            for channel in channels:
+                changes = self.pending.setdefault(channel, {})
+                if key in changes:
+                    changes[key][2] = curr
+                    self.coalesced_cnt += 1
+                    if changes[key][1] == curr:  # e.g. A -> B -> A, nothing changed
+                        del changes[key]
+                else:
+                    changes[key] = [label, prev, curr]
+                if len(changes) == 0:
+                    del self.pending[channel]
+                    self.deadlines.pop(channel, None)
+                else:
+                    self.deadlines.setdefault(channel, time.monotonic() + self.window)
+            self.change_cnt += 1
+        self.wakeup.set()
+
+    def run(self) -> None:
+        while not self.closed.is_set():
+            with self.lock:
+                now = time.monotonic()
+                due = [channel for channel, deadline in self.deadlines.items() if deadline <= now]
+                digests = {channel: self.pending.pop(channel) for channel in due}
+                for channel in due:
+                    del self.deadlines[channel]
+                timeout = min(self.deadlines.values(), default=now + 60) - now
+            if len(digests) > 0:
+                self.send_digests(digests)
+            else:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+
+    def send_digests(self, digests: Dict[Channel, Dict[Hashable, List[str]]]) -> None:
+        """ Post the digests of all the channels concurrently, and wait for them."""
+        futures = {
+            channel: self.executor.submit(
+                self.send_digest,
+                channel,
+                [f'{label}: {prev} -> {curr}' for label, prev, curr in changes.values()],
+            )
+            for channel, changes in digests.items()
+        }
+        for channel, future in futures.items():
+            try:
+                future.result()
+                self.digest_cnt += 1
+            except Exception:
+                self.failed_cnt += 1
+                self.logger.exception('Failed to post the digest to %s', channel)
+
+    def send_digest(self, channel: Channel, lines: List[str]) -> None:
+        """ Post the lines of a digest to a channel, in as few messages as the length limit allows."""
+        footer = self.footer if channel[0] == 'qq' else ''
+        for text in split_digest(lines, MESSAGE_LIMIT - (len(footer) + 1 if footer else 0)):
+            self.send(channel, text)
+
+    def send(self, channel: Channel, text: str) -> None:
+        """ Post a message to a channel, raise `ChatPostError` if the service rejects it."""
+        kind, target = channel
+        if kind == 'qq':
+            res = self.mirai.send_group_message(target, f'{text}\n{self.footer}' if self.footer else text)
+            if res.get('code') != 0:
+                raise ChatPostError(f'mirai code {res.get("code")}: {res.get("msg")}')
+        else:
+            proxies = dict(http=self.telegram['proxy'], https=self.telegram['proxy'])
+            res = self.http.get(
+                f'{self.telegram_base_uri}/bot{self.telegram["tg_bot_token"]}/sendMessage',
+                params={'chat_id': target, 'text': text},
+                proxies=proxies,
+                timeout=10,
+            )
+            if not res.ok:
+                raise ChatPostError(f'Telegram {res.status_code}: {res.text[:200]}')
+
+    def close(self) -> None:
+        """ Stop the worker, and release the mirai session. The pending changes are not sent."""
+        self.closed.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.executor.shutdown()
+        self.mirai.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            pending_cnt = sum(len(changes) for changes in self.pending.values())
+        return {
+            'pending_cnt': pending_cnt,
+            'change_cnt': self.change_cnt,
+            'coalesced_cnt': self.coalesced_cnt,
+            'digest_cnt': self.digest_cnt,
+            'failed_cnt': self.failed_cnt,
+            'auth_cnt': self.mirai.auth_cnt,
+        }
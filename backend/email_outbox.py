@@ -0,0 +1,231 @@
+""" A durable outbox of the notification emails in MongoDB, dispatched to the mail relays."""
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from pymongo import collection, ReturnDocument
+
+PENDING = 'pending'
+SENDING = 'sending'
+FAILED = 'failed'
+
+
+class RelayRateLimit:
+    """ A token bucket allowing `rate` posts per second in bursts of at most `burst`."""
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        """ Take a token, return the seconds to wait before it's available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class EmailOutbox:
+    """ Queue the emails in `outbox` and post them to their relay in a daemon thread. The
+        messages are `{title, content, receivers, sendfrom, sendto, relay, state, attempts,
+        next_attempt_at, claimed_at, last_error}`, deleted once sent and kept with the state
+        `'failed'` after `max_attempts` failed posts, until the TTL index of `created_at` expires
+        them, see indexes.py. A message is claimed before it's posted, and pending again
+        `stale_after` seconds after a process that died claimed it: it may be sent twice, never lost.
+    """
+    def __init__(
+        self,
+        outbox: collection.Collection,
+        default_relay: str,
+        max_receivers: int = 512,
+        rate: float = 2,
+        max_attempts: int = 8,
+        backoff: Tuple[float, float] = (5, 3600),
+        poll_interval: float = 1,
+        stale_after: float = 300,
+        timeout: float = 30,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.outbox = outbox
+        self.default_relay = default_relay
+        self.max_receivers = max_receivers
+        self.rate = rate
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger('email_outbox')
+
+        self.sessions: Dict[str, requests.Session] = {}
+        self.rate_limits: Dict[str, RelayRateLimit] = {}
+        self.wakeup = threading.Event()
+        self.closed = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+        # metrics
+        self.queued_cnt = 0
+        self.sent_cnt = 0
+        self.retry_cnt = 0
+        self.failed_cnt = 0
+        self.reclaimed_cnt = 0
+        self.last_post_latency = 0.0
+
+    def enqueue(
+        self,
+        title: str,
+        content: str,
+        receivers: List[str],
+        sendfrom: str,
+        sendto: str,
+        relay: Optional[str] = None,
+    ) -> int:
+        """ Queue an email, return the number of messages it's split into."""
+        now = datetime.utcnow()
+        messages = [
+            {
+                'title': title,
+                'content': content,
+                'receivers': receivers[i:i + self.max_receivers],
+                'sendfrom': sendfrom,
+                'sendto': sendto,
+                'relay': relay or self.default_relay,
+                'state': PENDING,
+                'attempts': 0,
+                'created_at': now,
+                'next_attempt_at': now,
+            }
+            for i in range(0, len(receivers), self.max_receivers)
+        ]
+        if len(messages) > 0:
+            self.outbox.insert_many(messages)
+            self.queued_cnt += len(messages)
+            self.wakeup.set()
+        return len(messages)
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name='email_outbox', daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.closed.set()
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self) -> None:
+        """ Post the due messages, then wait for new ones or the next retry."""
+        reclaimed_at = float('-inf')
+        while not self.closed.is_set():
+            try:
+                if time.monotonic() - reclaimed_at > self.stale_after / 2:
+                    self.reclaim_stale()
+                    reclaimed_at = time.monotonic()
+                self.dispatch_due()
+            except Exception:  # e.g. MongoDB unreachable or a malformed message, keep the dispatcher alive
+                self.logger.exception('Failed to dispatch the email outbox')
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+
+    def reclaim_stale(self) -> None:
+        """ Make the messages claimed long ago pending again, their dispatcher is gone."""
+        result = self.outbox.update_many(
+            {'state': SENDING, 'claimed_at': {'$lt': datetime.utcnow() - timedelta(seconds=self.stale_after)}},
+            {'$set': {'state': PENDING}},
+        )
+        if result.modified_count > 0:
+            self.reclaimed_cnt += result.modified_count
+            self.logger.warning('Reclaimed %d stale email messages', result.modified_count)
+
+    def claim(self) -> Optional[dict]:
+        """ Take the most overdue pending message, None when no message is due."""
+        now = datetime.utcnow()
+        return self.outbox.find_one_and_update(
+            {'state': PENDING, 'next_attempt_at': {'$lte': now}},
+            {'$set': {'state': SENDING, 'claimed_at': now}},
+            sort=[('next_attempt_at', 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def dispatch_due(self) -> int:
+        """ Post every due message, return the number sent."""
+        sent = 0
+        while not self.closed.is_set():
+            message = self.claim()
+            if message is None:
+                break
+            error = self.post(message)
+            if error is None:
+                self.outbox.delete_one({'_id': message['_id']})
+                self.sent_cnt += 1
+                sent += 1
+            else:
+                self.fail(message, error)
+        return sent
+
+    def post(self, message: dict) -> Optional[str]:
+        """ Post a message to its relay once its rate limit allows, return the error if any."""
+        relay = message['relay']
+        if relay not in self.rate_limits:
+            self.rate_limits[relay] = RelayRateLimit(self.rate)
+            self.sessions[relay] = requests.Session()
+        time.sleep(self.rate_limits[relay].reserve())
+
+        data = {
+            'title': message['title'],
+            'content': message['content'],
+            'receivers': '@@@'.join(message['receivers']),
+            'sendfrom': message['sendfrom'],
+            'sendto': message['sendto'],
+        }
+        start = time.monotonic()
+        try:
+            res = self.sessions[relay].post(relay, data=data, timeout=self.timeout)
+        except requests.RequestException as e:
+            return repr(e)
+        finally:
+            self.last_post_latency = time.monotonic() - start
+        return None if 'success' in res.text else f'{res.status_code}: {res.text[:200]}'
+
+    def retry_delay(self, attempts: int) -> float:
+        """ Seconds before the next attempt after `attempts` failed ones."""
+        first, longest = self.backoff
+        return min(longest, first * 2 ** (attempts - 1))
+
+    def fail(self, message: dict, error: str) -> None:
+        """ Schedule the retry of a message, or give up on it."""
+        attempts = message['attempts'] + 1
+        if attempts >= self.max_attempts:
+            update = {'state': FAILED, 'attempts': attempts, 'last_error': error}
+            self.failed_cnt += 1
+            self.logger.error('Gave up on the email %r to %d receivers: %s',
+                              message['title'], len(message['receivers']), error)
+        else:
+            next_attempt_at = datetime.utcnow() + timedelta(seconds=self.retry_delay(attempts))
+            update = {'state': PENDING, 'attempts': attempts, 'last_error': error, 'next_attempt_at': next_attempt_at}
+            self.retry_cnt += 1
+            self.logger.warning('Failed to send the email %r, attempt %d: %s', message['title'], attempts, error)
+        self.outbox.update_one({'_id': message['_id']}, {'$set': update})
+
+    def depth(self) -> Dict[str, int]:
+        """ Return the number of messages per state."""
+        return {
+            state['_id']: state['count']
+            for state in self.outbox.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}])
+        }
+
+    def stats(self) -> dict:
+        return {
+            'running': self.thread is not None and self.thread.is_alive(),
+            'queued_cnt': self.queued_cnt,
+            'sent_cnt': self.sent_cnt,
+            'retry_cnt': self.retry_cnt,
+            'failed_cnt': self.failed_cnt,
+            'reclaimed_cnt': self.reclaimed_cnt,
+            'last_post_latency': self.last_post_latency,
+        }
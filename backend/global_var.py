@@ -2,12 +2,13 @@
 
 import os
 import json
-from queue import Queue
 from threading import Lock
 from collections import defaultdict
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 from datetime import timedelta, timezone
 
+from cache import TTLCache
+
 DATA_PATH = os.path.join(os.curdir, 'data')  # dir stroing file-based data
 
 with open(os.path.join(os.curdir, 'config', 'secret.json')) as f:
@@ -15,9 +16,57 @@ with open(os.path.join(os.curdir, 'config', 'secret.json')) as f:
 
 MAX_EMAIL_SENT = 512  # maximum number of emails sent for one POST to email server
 
+# The emails are queued in the MongoDB collection `email_outbox` and posted by a dispatcher thread
+# of the fetchers and the API, see email_outbox.py. A failed POST is retried after
+# EMAIL_RETRY_BACKOFF[0] seconds, doubled at every attempt up to EMAIL_RETRY_BACKOFF[1], and given
+# up after EMAIL_MAX_ATTEMPTS. Every process posts at most EMAIL_RELAY_RATE times per second to a relay.
+# The messages given up on are deleted by a TTL index EMAIL_FAILED_TTL seconds after they were queued.
+EMAIL_OUTBOX = True
+EMAIL_MAX_ATTEMPTS = 8
+EMAIL_RETRY_BACKOFF = (5, 3600)
+EMAIL_RELAY_RATE = 2
+EMAIL_FAILED_TTL = 30 * 24 * 3600
+
+# The status changes are sent to the websocket service over one long-lived connection, see
+# websocket_publisher.py: at most WEBSOCKET_PUBLISHER_BATCH changes per frame, the oldest of more than
+# WEBSOCKET_PUBLISHER_BUFFER unsent changes are dropped.
+WEBSOCKET_PUBLISHER_BUFFER = 1024
+WEBSOCKET_PUBLISHER_BATCH = 128
+
+# The changes are posted to the QQ groups and Telegram channels in one digest per channel of the
+# changes of CHAT_DIGEST_WINDOW seconds, see chat_notifier.py. The mirai session is renewed after
+# CHAT_MIRAI_SESSION_TTL seconds.
+CHAT_DIGEST_WINDOW = 5
+CHAT_MIRAI_SESSION_TTL = 1200
+
+# At most WEBSOCKET_QUEUE_SIZE notifications wait for a websocket client, the overflow policy of a
+# full queue is 'drop_oldest', 'coalesce' (replace the waiting notification of the same embassy, or
+# drop the oldest) or 'disconnect'. A client that doesn't read a notification within
+# WEBSOCKET_SEND_TIMEOUT seconds is disconnected.
+WEBSOCKET_QUEUE_SIZE = 64
+WEBSOCKET_OVERFLOW_POLICY = 'coalesce'
+WEBSOCKET_SEND_TIMEOUT = 10
+
 FRONTEND_BASE_URI = "tuixue.online"
 
 MONGO_CONFIG = {'host': '127.0.0.1', 'port': 27017, 'database': 'tuixue'}
+ASYNC_DB_WORKERS = 32  # threads running the MongoDB queries of the asyncio apps, see async_mongodb.py
+
+# Layout of the fetched visa status in MongoDB. 'daily' keeps one document per UTC write date in the
+# collection `visa_status`, 'bucket' keeps fixed-size time buckets in `visa_status_bucket`.
+# Run `python3 sync_data.py -o bucket` before switching to 'bucket'.
+VISA_STATUS_STORAGE = 'daily'
+VISA_STATUS_BUCKET_MINUTES = 60  # must divide a day evenly
+
+# Layout of the overview in MongoDB. 'array' keeps one document per (visa_type, embassy_code) with an
+# array of days in the collection `overview`, 'daily' keeps one document per embassy-local date in
+# `overview_daily`. Run `python3 sync_data.py -o overview` before switching to 'daily'.
+OVERVIEW_STORAGE = 'array'
+
+# Source of the detail of the past 24 hours. 'turning_point' reads the series maintained on write in
+# `turning_point`, 'visa_status' aggregates the stored fetches on every request. Run
+# `python3 sync_data.py -o turning_point` (or let the fetcher run for a day) before switching to 'turning_point'.
+DETAIL_SOURCE = 'visa_status'
 
 CRAWLER_API = {
     'register': {
@@ -56,11 +105,6 @@ CD_LIST = [
 DEFAULT_FILTER = ['bj', 'sh', 'gz', 'sy', 'bju', 'shu', 'gzu', 'syu']
 NONDOMESTIC_DEFAULT_FILTER = ["sg", "gye", "lcy"]
 
-OVERVIEW_CACHE = {}
-DETAIL_CACHE = {}
-
-SESSION_UPDATE_QUEUE = Queue()
-
 # isn't it useless?
 COUTNRY_CODE_TO_UTC_OFFSET = {
     'ARE': 4, 'AUS': 10, 'BRB': -4, 'CAN': -5, 'CHE': 1,
@@ -181,11 +225,43 @@ AIS_MONITORING_CITY = [emb[1] for emb in EMBASSY_ATTR if emb[3] == 'ais']
 CGI_SESS_POOL_SIZE = {'F': 10, 'J': 10, 'B': 8, 'H': 5, 'O': 5, 'L': 5}
 AIS_SESS_POOL_SIZE = {visa_type: 1 for visa_type in VISA_TYPES}
 SESS_POOL_SIZE = {'cgi': CGI_SESS_POOL_SIZE, 'ais': AIS_SESS_POOL_SIZE}
+SESSION_LOCK_STRIPES = 64  # number of locks shared by the session pools of a SessionCache
+SESSION_REFRESH_PER_POOL = 2  # number of sessions of a pool refreshed at the same time
+SESSION_JOURNAL_COMPACT = 1000  # number of journaled session replacements before a new snapshot is written
 
 CGI_FETCH_TIME_INTERVAL = {'F': 60, 'J': 60, 'B': 120, 'H': 180, 'O': 180, 'L': 180}
 AIS_FETCH_TIME_INTERVAL = {visa_type: 300 for visa_type in VISA_TYPES}
 FETCH_TIME_INTERVAL = {'cgi': CGI_FETCH_TIME_INTERVAL, 'ais': AIS_FETCH_TIME_INTERVAL}
 
+# LRU caches of the API response fragments, one per (visa_type, embassy_code, date). A fragment
+# expires after the fetch interval of its (visa_type, embassy), no response is more than one fetch
+# behind, or after API_CACHE_HISTORY_TTL once its date is over. While the API listens to the cache
+# events of the fetcher, the fragments changed by a write are dropped right away and the current
+# ones live for API_CACHE_LIVE_TTL instead. The fetcher sends a heartbeat every
+# CACHE_EVENTS_HEARTBEAT seconds without writes, and the API falls back to the fetch interval
+# when it heard nothing for CACHE_EVENTS_SILENCE_TIMEOUT seconds.
+OVERVIEW_CACHE_SIZE = 65536
+DETAIL_CACHE_SIZE = 4096
+API_CACHE_HISTORY_TTL = 24 * 3600
+API_CACHE_LIVE_TTL = 3600
+CACHE_EVENTS_TRANSPORT = 'unix'  # 'unix' or 'none', see cache_events.py
+CACHE_EVENTS_SOCKET_DIR = os.path.join(os.curdir, 'cache_events')
+CACHE_EVENTS_HEARTBEAT = 10
+CACHE_EVENTS_SILENCE_TIMEOUT = min(CGI_FETCH_TIME_INTERVAL.values())
+OVERVIEW_CACHE = TTLCache(OVERVIEW_CACHE_SIZE, ttl=min(CGI_FETCH_TIME_INTERVAL.values()), name='overview')
+DETAIL_CACHE = TTLCache(DETAIL_CACHE_SIZE, ttl=min(CGI_FETCH_TIME_INTERVAL.values()), name='detail')
+
+# The API processes listening to the cache events keep the fetches of the last HOT_WINDOW_HOURS
+# in memory and answer the detail and the latest written status from it, see hot_window.py.
+# 0 disables it.
+HOT_WINDOW_HOURS = 48
+
+# The fetchers find the subscribers to notify in an in-memory index, see subscription_index.py.
+# The API tells them about the edited subscriptions with the cache events transport, in the other
+# direction. Without events, the index is rebuilt every SUBSCRIPTION_INDEX_REBUILD_INTERVAL seconds.
+SUBSCRIPTION_EVENTS_SOCKET_DIR = os.path.join(os.curdir, 'subscription_events')
+SUBSCRIPTION_INDEX_REBUILD_INTERVAL = 600
+
 ADDITIONAL_INFO = {}
 
 for lng in ['zh', 'en']:
@@ -207,24 +283,39 @@ LOCK = Lock()
 
 class USEmbassy:
     """ An abstraction represent a U.S. Embassy or Consulate"""
+    __slots__ = (
+        'name_cn', 'name_en', 'code', 'sys', 'region', 'continent',
+        'country', 'timezone', 'crawler_code', 'location',
+    )
+
     @classmethod
     def get_embassy_lst(cls) -> List['USEmbassy']:
         """ Return the list of USEmbassy objects."""
-        return [cls(*embassy_attr) for embassy_attr in EMBASSY_ATTR]
+        return list(EMBASSY_REGISTRY.embassy_lst)
 
     @classmethod
     def get_embassy_by_loc(cls, loc: str) -> Optional['USEmbassy']:
         """ Return an USEbassy object by the location property."""
-        return next((emb for emb in cls.get_embassy_lst() if emb.location == loc), None)
+        return EMBASSY_REGISTRY.by_loc.get(loc)
 
     @classmethod
     def get_embassy_by_code(cls, code: str) -> Optional['USEmbassy']:
         """ Return an USEbassy object by the code property."""
-        return next((emb for emb in cls.get_embassy_lst() if emb.code == code), None)
+        return EMBASSY_REGISTRY.by_code.get(code)
 
     @classmethod
     def get_embassy_list_by_crawler_code(cls, crawler_code: str) -> List[Optional['USEmbassy']]:
-        return [emb for emb in cls.get_embassy_lst() if emb.crawler_code == crawler_code]
+        return list(EMBASSY_REGISTRY.by_crawler_code.get(crawler_code, ()))
+
+    @classmethod
+    def get_embassy_list_by_region(cls, region: str) -> List['USEmbassy']:
+        """ Return the USEmbassy objects in a given region."""
+        return list(EMBASSY_REGISTRY.by_region.get(region, ()))
+
+    @classmethod
+    def get_embassy_list_by_country(cls, country: str) -> List['USEmbassy']:
+        """ Return the USEmbassy objects in a given country."""
+        return list(EMBASSY_REGISTRY.by_country.get(country, ()))
 
     @classmethod
     def get_region_mapping(cls) -> List[dict]:
@@ -232,15 +323,15 @@ class USEmbassy:
         return [
             {
                 'region': region,
-                'embassy_code_lst': [emb.code for emb in cls.get_embassy_lst() if emb.region == region]
-            } for region in {emb.region for emb in cls.get_embassy_lst()}
+                'embassy_code_lst': [emb.code for emb in embassy_lst]
+            } for region, embassy_lst in EMBASSY_REGISTRY.by_region.items()
         ]
 
     @classmethod
     def get_region_country_embassy_tree(cls) -> List[dict]:
         """ Return a region-country-embassy mapping"""
         rce_tree = defaultdict(lambda: defaultdict(list))
-        for emb in cls.get_embassy_lst():
+        for emb in EMBASSY_REGISTRY.embassy_lst:
             rce_tree[emb.region][emb.country].append(emb.code)
 
         return [
@@ -276,14 +367,41 @@ class USEmbassy:
         self.country = country
         self.timezone = timezone(timedelta(hours=utcoffset))
         self.crawler_code = crawler_code
+        self.location = crawler_code if sys == 'cgi' else name_en  # the location value for data storage
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(name_cn={self.name_cn}, name_en={self.name_en}, code={self.code})'
 
-    @property
-    def location(self) -> str:
-        """ Return the location value for data storage."""
-        return self.crawler_code if self.sys == 'cgi' else self.name_en
+
+class EmbassyRegistry:
+    """ All of the USEmbassy objects, built once from `EMBASSY_ATTR` and indexed by the
+        attributes we look them up with. Lookups by code and location keep the first
+        match in `EMBASSY_ATTR` order, which is what the previous linear scan returned.
+    """
+    __slots__ = ('embassy_lst', 'by_code', 'by_loc', 'by_crawler_code', 'by_region', 'by_country')
+
+    def __init__(self, embassy_attr: List[tuple]) -> None:
+        self.embassy_lst: Tuple[USEmbassy, ...] = tuple(USEmbassy(*attr) for attr in embassy_attr)
+        self.by_code: Dict[str, USEmbassy] = {}
+        self.by_loc: Dict[str, USEmbassy] = {}
+        self.by_crawler_code: Dict[str, List[USEmbassy]] = defaultdict(list)
+        self.by_region: Dict[str, List[USEmbassy]] = defaultdict(list)
+        self.by_country: Dict[str, List[USEmbassy]] = defaultdict(list)
+
+        for emb in self.embassy_lst:
+            self.by_code.setdefault(emb.code, emb)
+            self.by_loc.setdefault(emb.location, emb)
+            self.by_crawler_code[emb.crawler_code].append(emb)
+            self.by_region[emb.region].append(emb)
+            self.by_country[emb.country].append(emb)
+
+        # freeze the indexes so that a lookup miss doesn't insert an empty list
+        self.by_crawler_code = dict(self.by_crawler_code)
+        self.by_region = dict(self.by_region)
+        self.by_country = dict(self.by_country)
+
+
+EMBASSY_REGISTRY = EmbassyRegistry(EMBASSY_ATTR)
 
 
 class GlobalVar:  # Can we just define a dictionary for it?
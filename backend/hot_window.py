@@ -0,0 +1,338 @@
+""" A columnar in-memory window of the latest fetches, kept by the API processes.
+    For every `(visa_type, embassy_code)` pair, the fetched minutes of the last hours are held in two
+    NumPy arrays: the minutes since the epoch and the ordinal of the earliest available date fetched
+    in that minute, in minute order. The window is seeded from MongoDB at startup and then kept
+    current by the cache events of the fetcher (see cache_events.py), so the past 24 hours detail
+    and the latest written status are cut out of the arrays without a database round trip, the
+    detail being computed on the slices by turning_points.py.
+
+    A query is only answered from the window if the window covers it, the caller falls back to
+    the database otherwise, e.g. while the window is (re)seeded after lost events.
+"""
+import time
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+import tuixue_mongodb as DB
+from cache_events import CacheEvent
+from global_var import USEmbassy, VISA_TYPES
+from tuixue_typing import VisaType, EmbassyCode
+from turning_points import MINUTE_MS, turning_points_of_arrays
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch_minute(dt: datetime) -> int:
+    """ Return the minutes since the epoch of a datetime, a naive `dt` is in UTC."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return int((dt - EPOCH).total_seconds() // 60)
+
+
+def from_epoch_minute(minute: int) -> datetime:
+    """ Return the naive UTC datetime of a number of minutes since the epoch."""
+    return EPOCH + timedelta(minutes=int(minute))
+
+
+class FetchedSeries:
+    """ The fetched minutes of a `(visa_type, embassy_code)` pair with the ordinal of the earliest
+        date fetched in each of them, in minute order. The arrays are allocated with room to append
+        to, the minutes out of the window are only dropped when the room runs out.
+    """
+    __slots__ = ('minutes', 'dates', 'size')
+
+    def __init__(self, capacity: int) -> None:
+        self.minutes = np.empty(capacity, dtype=np.int32)
+        self.dates = np.empty(capacity, dtype=np.int32)
+        self.size = 0
+
+    @classmethod
+    def from_arrays(cls, minutes: np.ndarray, dates: np.ndarray, capacity: int) -> 'FetchedSeries':
+        """ Build a series of the minutes in ascending order, without duplicates."""
+        series = cls(max(capacity, 2 * len(minutes)))
+        series.size = len(minutes)
+        series.minutes[:series.size] = minutes
+        series.dates[:series.size] = dates
+        return series
+
+    @property
+    def nbytes(self) -> int:
+        return self.minutes.nbytes + self.dates.nbytes
+
+    def add(self, minute: int, date_ordinal: int, horizon: int) -> None:
+        """ Add a fetch, keeping the earliest date of every minute. The minutes up to `horizon`
+            may be dropped to make room.
+        """
+        if minute <= horizon:
+            return
+
+        size = self.size
+        if size > 0 and minute <= self.minutes[size - 1]:  # a late write
+            i = int(np.searchsorted(self.minutes[:size], minute))
+            if self.minutes[i] == minute:
+                self.dates[i] = min(self.dates[i], date_ordinal)
+                return
+        else:
+            i = size
+
+        self.make_room(horizon)
+        i -= size - self.size  # the dropped minutes were all before `minute`
+        self.minutes[i + 1:self.size + 1] = self.minutes[i:self.size]
+        self.dates[i + 1:self.size + 1] = self.dates[i:self.size]
+        self.minutes[i], self.dates[i] = minute, date_ordinal
+        self.size += 1
+
+    def make_room(self, horizon: int) -> None:
+        """ Make room for one more minute: drop the minutes up to `horizon`, or grow the arrays."""
+        if self.size < len(self.minutes):
+            return
+
+        start = int(np.searchsorted(self.minutes[:self.size], horizon, side='right'))
+        if start == 0:
+            self.minutes = np.concatenate([self.minutes, np.empty_like(self.minutes)])
+            self.dates = np.concatenate([self.dates, np.empty_like(self.dates)])
+            return
+
+        self.size -= start
+        self.minutes[:self.size] = self.minutes[start:start + self.size]
+        self.dates[:self.size] = self.dates[start:start + self.size]
+
+    def slice(self, since_minute: int, to_minute: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return copies of the minutes in `(since_minute, to_minute]` and of their dates."""
+        minutes = self.minutes[:self.size]
+        low, high = np.searchsorted(minutes, [since_minute, to_minute], side='right')
+        return minutes[low:high].copy(), self.dates[low:high].copy()
+
+
+class HotWindow:
+    """ The fetches of the last `hours` of every `(visa_type, embassy_code)` pair, and their latest
+        written status. `seed` loads them from MongoDB, `apply` adds the cache events of the fetcher.
+        The events received while seeding are replayed on the seeded data, the writes are idempotent.
+    """
+    def __init__(self, hours: int = 48, logger: Optional[logging.Logger] = None) -> None:
+        self.minutes = hours * 60
+        self.logger = logger or logging.getLogger('hot_window')
+
+        self.lock = threading.Lock()
+        self.series: Dict[Tuple[VisaType, EmbassyCode], FetchedSeries] = {}
+        self.latest: Dict[Tuple[VisaType, EmbassyCode], dict] = {}
+        self.covered_since: Optional[int] = None  # the window holds every fetch after this epoch minute
+        self.seeding = False
+        self.reseed_requested = False
+        self.pending: List[CacheEvent] = []  # the events received while seeding
+
+        # metrics
+        self.seed_cnt = 0
+        self.applied_cnt = 0
+        self.last_seed_latency = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self.covered_since is not None
+
+    def covers(self, timestamp: datetime, minutes: int = 1440) -> bool:
+        """ Return whether the window holds all the fetches of the `minutes` minutes up to the minute
+            of `timestamp`.
+        """
+        covered_since = self.covered_since
+        if covered_since is None:
+            return False
+        covered_since = max(covered_since, to_epoch_minute(datetime.utcnow()) - self.minutes)  # older ones are dropped
+        return to_epoch_minute(timestamp) - minutes >= covered_since
+
+    def stats(self) -> dict:
+        """ Return the size of the window and its counters."""
+        with self.lock:
+            series = list(self.series.values())
+        return {
+            'ready': self.ready,
+            'covered_since': None if self.covered_since is None else from_epoch_minute(self.covered_since),
+            'pair_cnt': len(series),
+            'fetched_minute_cnt': sum(s.size for s in series),
+            'nbytes': sum(s.nbytes for s in series),
+            'seed_cnt': self.seed_cnt,
+            'applied_cnt': self.applied_cnt,
+            'last_seed_latency': self.last_seed_latency,
+        }
+
+    def seed(self, now: Optional[datetime] = None) -> None:
+        """ Load the window from the database, again if a reseed is requested meanwhile."""
+        while True:
+            with self.lock:
+                self.seeding, self.reseed_requested, self.pending = True, False, []
+
+            seed_start = time.monotonic()
+            seed_time = now or datetime.utcnow()
+            series, latest = self.load(seed_time)
+
+            with self.lock:
+                for event in self.pending:
+                    self.apply_to(series, latest, event)
+                if self.reseed_requested:
+                    continue
+
+                self.series, self.latest = series, latest
+                self.covered_since = to_epoch_minute(seed_time - timedelta(minutes=self.minutes))
+                self.seeding, self.pending = False, []
+
+            self.seed_cnt += 1
+            self.last_seed_latency = time.monotonic() - seed_start
+            self.logger.info('Seeded the hot window in %.3f seconds', self.last_seed_latency)
+            return
+
+    def seed_in_background(self) -> None:
+        """ (Re)seed the window in a background thread, e.g. after lost events. The window
+            covers nothing until it's done.
+        """
+        with self.lock:
+            self.covered_since = None
+            if self.seeding:
+                self.reseed_requested = True
+                return
+            self.seeding = True
+        threading.Thread(target=self.seed, name='hot_window', daemon=True).start()
+
+    def load(self, now: datetime) -> Tuple[Dict[Tuple[VisaType, EmbassyCode], FetchedSeries], Dict[tuple, dict]]:
+        """ Read the fetches of the window ending at `now` and the latest written status from MongoDB."""
+        embassy_codes = [embassy.code for embassy in USEmbassy.get_embassy_lst()]
+        series = {}
+        for visa_type in VISA_TYPES:
+            past = DB.VisaStatus.find_visa_status_past24h_batch(visa_type, embassy_codes, now, minutes=self.minutes)
+            for embassy_code, visa_status in past.items():
+                if visa_status is None:
+                    continue
+                fetches = visa_status['available_dates']
+                series[(visa_type, embassy_code)] = FetchedSeries.from_arrays(
+                    np.fromiter((to_epoch_minute(f['write_time']) for f in fetches), np.int32, len(fetches)),
+                    np.fromiter((f['available_date'].toordinal() for f in fetches), np.int32, len(fetches)),
+                    self.minutes + 60,
+                )
+
+        latest = {
+            (lw['visa_type'], lw['embassy_code']): lw
+            for lw in DB.VisaStatus.find_latest_written_visa_status(list(VISA_TYPES), embassy_codes)
+        }
+        return series, latest
+
+    def apply(self, events: List[CacheEvent]) -> None:
+        """ Add the fetches written by the fetcher."""
+        with self.lock:
+            if self.seeding:
+                self.pending.extend(events)
+            for event in events:
+                self.apply_to(self.series, self.latest, event)
+        self.applied_cnt += len(events)
+
+    def apply_to(
+        self,
+        series: Dict[Tuple[VisaType, EmbassyCode], FetchedSeries],
+        latest: Dict[Tuple[VisaType, EmbassyCode], dict],
+        event: CacheEvent,
+    ) -> None:
+        pair = (event.visa_type, event.embassy_code)
+        write_time = event.write_time.replace(microsecond=event.write_time.microsecond // 1000 * 1000)  # as in MongoDB
+        if pair not in latest or latest[pair]['write_time'] <= write_time:
+            latest[pair] = {
+                'visa_type': event.visa_type,
+                'embassy_code': event.embassy_code,
+                'write_time': write_time,
+                'available_date': event.available_date,
+            }
+
+        if event.available_date is None:
+            return
+        minute = to_epoch_minute(write_time)
+        if pair not in series:
+            series[pair] = FetchedSeries(self.minutes + 60)
+        series[pair].add(minute, event.available_date.toordinal(), minute - self.minutes)
+
+    def find_visa_status_past24h(
+        self,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        timestamp: datetime,
+        minutes: int = 1440,
+    ) -> Optional[dict]:
+        """ `DB.VisaStatus.find_visa_status_past24h` of the fetches in the `minutes` minutes up to the
+            minute of `timestamp`, every fetch at the start of its minute.
+        """
+        to_minute = to_epoch_minute(timestamp)
+        since_minute = to_minute - minutes
+        with self.lock:
+            series = self.series.get((visa_type, embassy_code))
+            if series is None:
+                return None
+            fetched_minutes, dates = series.slice(since_minute, to_minute)
+
+        return {
+            'visa_type': visa_type,
+            'embassy_code': embassy_code,
+            'time_range': [from_epoch_minute(since_minute), from_epoch_minute(to_minute)],
+            'available_dates': [
+                {'write_time': EPOCH + timedelta(minutes=minute), 'available_date': datetime.fromordinal(date)}
+                for minute, date in zip(fetched_minutes.tolist(), dates.tolist())
+            ],
+        }
+
+    def find_visa_status_past24h_turning_point_batch(
+        self,
+        visa_type: VisaType,
+        embassy_code: List[EmbassyCode],
+        timestamp: datetime,
+    ) -> Dict[EmbassyCode, Optional[dict]]:
+        """ `DB.VisaStatus.find_visa_status_past24h_turning_point_batch` for the last instant of the
+            minute of `timestamp`, like the `'turning_point'` series. The slices of all the embassies
+            go through `turning_points_of_arrays` at once.
+        """
+        to_minute = to_epoch_minute(timestamp)
+        since_minute = to_minute - 1440
+        empty = np.zeros(0, dtype=np.int32)
+        with self.lock:
+            slices = [
+                self.series[(visa_type, ec)].slice(since_minute, to_minute) if (visa_type, ec) in self.series
+                else (empty, empty)
+                for ec in embassy_code
+            ]
+
+        offsets = np.zeros(len(slices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(minutes) for minutes, _ in slices])
+        available_dates = turning_points_of_arrays(
+            np.concatenate([empty, *(minutes for minutes, _ in slices)]).astype(np.int64) * MINUTE_MS,
+            np.concatenate([empty, *(dates for _, dates in slices)]),
+            offsets,
+            np.full(len(slices), since_minute * MINUTE_MS, dtype=np.int64),
+            np.full(len(slices), to_minute * MINUTE_MS, dtype=np.int64),
+            np.array([DB.VisaStatus.gap_seconds(visa_type, ec) * 1000 for ec in embassy_code], dtype=np.int64),
+            datetime.fromordinal,
+        )
+        return {
+            ec: None if adt is None else {
+                'visa_type': visa_type,
+                'embassy_code': ec,
+                'time_range': [since_minute * MINUTE_MS, to_minute * MINUTE_MS],
+                'available_dates': adt,
+            }
+            for ec, adt in zip(embassy_code, available_dates)
+        }
+
+    def find_latest_written_visa_status(
+        self,
+        visa_type: Union[VisaType, List[VisaType]],
+        embassy_code: Union[EmbassyCode, List[EmbassyCode]],
+    ) -> List[dict]:
+        """ `DB.VisaStatus.find_latest_written_visa_status`: the latest written status of the pairs
+            written today (UTC).
+        """
+        if not isinstance(visa_type, list):
+            visa_type = [visa_type]
+        if not isinstance(embassy_code, list):
+            embassy_code = [embassy_code]
+
+        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        with self.lock:
+            latest_written = [self.latest.get((vt, ec)) for vt in visa_type for ec in embassy_code]
+        return [dict(lw) for lw in latest_written if lw is not None and lw['write_time'] >= today_start]
@@ -0,0 +1,156 @@
+""" The indexes of the MongoDB collections, and the hot queries they must serve.
+    `INDEXES` declares the compound, unique and TTL indexes of every collection. `ensure_indexes`
+    creates them, which is a no-op for the ones already there, so it runs at the startup of the
+    fetcher and of the API. `explain_hot_queries` runs `explain()` on the filter of every hot
+    query (the first `$match` of the aggregations) and reports whether the winning plan scans an
+    index, see `python3 sync_data.py -o indexes`.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import pymongo
+from pymongo import collection, IndexModel
+from pymongo.errors import OperationFailure
+
+from global_var import EMAIL_FAILED_TTL
+
+
+class IndexSpec(NamedTuple):
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+    expire_after: Optional[int] = None  # seconds, a TTL index
+    partial: Optional[dict] = None  # the filter of the documents indexed
+
+    @property
+    def name(self) -> str:
+        """ The default name MongoDB gives to the index, e.g. `visa_type_1_embassy_code_1`."""
+        return '_'.join(f'{field}_{direction}' for field, direction in self.keys)
+
+    def to_model(self) -> IndexModel:
+        options = {}  # only the options set, same as the indexes created without any
+        if self.unique:
+            options['unique'] = True
+        if self.expire_after is not None:
+            options['expireAfterSeconds'] = self.expire_after
+        if self.partial is not None:
+            options['partialFilterExpression'] = self.partial
+        return IndexModel(self.keys, name=self.name, **options)
+
+
+PAIR = [('visa_type', pymongo.ASCENDING), ('embassy_code', pymongo.ASCENDING)]
+
+INDEXES: Dict[str, List[IndexSpec]] = {
+    'visa_status': [
+        IndexSpec([*PAIR, ('write_date', pymongo.ASCENDING)], unique=True),  # one daily document per pair
+        IndexSpec([('write_date', pymongo.ASCENDING)]),  # the initialization of `latest_written`
+    ],
+    'visa_status_bucket': [IndexSpec([*PAIR, ('bucket_start', pymongo.ASCENDING)], unique=True)],
+    'overview': [IndexSpec(PAIR, unique=True)],  # one array document per pair
+    'overview_daily': [IndexSpec([*PAIR, ('write_date', pymongo.ASCENDING)], unique=True)],
+    'latest_written': [IndexSpec(PAIR, unique=True)],
+    'turning_point': [IndexSpec([*PAIR, ('date', pymongo.ASCENDING)], unique=True)],
+    'email_subscription': [
+        IndexSpec([('email', pymongo.ASCENDING)], unique=True),
+        IndexSpec([('subscription.visa_type', pymongo.ASCENDING), ('subscription.embassy_code', pymongo.ASCENDING)]),
+    ],
+    'email_outbox': [
+        IndexSpec([('state', pymongo.ASCENDING), ('next_attempt_at', pymongo.ASCENDING)]),
+        # the messages given up on are deleted `EMAIL_FAILED_TTL` seconds after they were queued
+        IndexSpec([('created_at', pymongo.ASCENDING)], expire_after=EMAIL_FAILED_TTL, partial={'state': 'failed'}),
+    ],
+}
+
+
+def ensure_indexes(
+    collections: Dict[str, collection.Collection],
+    logger: Optional[logging.Logger] = None,
+) -> List[str]:
+    """ Create the declared indexes of the collections given by name, return the names of the
+        indexes created or already there. An index that can't be created, e.g. a unique index on
+        duplicated data or an index of the same name with other options, is logged and skipped.
+    """
+    logger = logger or logging.getLogger('indexes')
+    ensured = []
+    for collection_name, coll in collections.items():
+        for spec in INDEXES[collection_name]:
+            try:
+                coll.create_indexes([spec.to_model()])
+            except OperationFailure as e:
+                logger.error('Failed to create the index %s of %s: %s', spec.name, collection_name, e.details)
+            else:
+                ensured.append(f'{collection_name}.{spec.name}')
+    return ensured
+
+
+def hot_queries(visa_type: str, embassy_code: str, email: str, now: datetime) -> Iterator[Tuple[str, str, dict]]:
+    """ Yield the `(name, collection_name, filter)` of the hot queries for sample values, the filters
+        are the ones built by `tuixue_mongodb`.
+    """
+    today = datetime.combine(now.date(), datetime.min.time())
+    yesterday = today - timedelta(days=1)
+    pairs = {'visa_type': {'$in': [visa_type]}, 'embassy_code': {'$in': [embassy_code]}}
+
+    yield 'latest written status', 'latest_written', {**pairs, 'write_time': {'$gte': today, '$lte': now}}
+    yield 'latest written upsert', 'latest_written', {'visa_type': visa_type, 'embassy_code': embassy_code}
+    yield 'past 24 hours (daily)', 'visa_status', {
+        'visa_type': visa_type, 'embassy_code': {'$in': [embassy_code]}, 'write_date': {'$in': [yesterday, today]}
+    }
+    yield 'past 24 hours (bucket)', 'visa_status_bucket', {
+        'visa_type': visa_type,
+        'embassy_code': {'$in': [embassy_code]},
+        'bucket_start': {'$gte': yesterday, '$lt': now},
+    }
+    yield 'overview (array)', 'overview', pairs
+    yield 'overview (daily)', 'overview_daily', {
+        '$or': [{**pairs, 'write_date': {'$gte': yesterday - timedelta(days=14), '$lte': today}}]
+    }
+    yield 'detail series', 'turning_point', {
+        'visa_type': visa_type, 'embassy_code': {'$in': [embassy_code]}, 'date': {'$gte': yesterday, '$lte': today}
+    }
+    yield 'subscriptions of an email', 'email_subscription', {'email': email}
+    yield 'subscribers of a pair', 'email_subscription', {
+        'subscription': {'$elemMatch': {'visa_type': visa_type, 'embassy_code': embassy_code}}
+    }
+
+
+def plan_stages(plan: dict) -> Iterator[dict]:
+    """ Yield the stages of a query plan, the root first."""
+    if 'queryPlan' in plan:  # slot based execution
+        plan = plan['queryPlan']
+    yield plan
+    for child in [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+def explain_query(coll: collection.Collection, query: dict) -> dict:
+    """ Return the stages and the index of the winning plan of a query, whether it scans an index
+        and no collection, and how many keys and documents were examined for how many results.
+    """
+    explained = coll.find(query).explain()
+    stages = list(plan_stages(explained['queryPlanner']['winningPlan']))
+    stage_names = [stage['stage'] for stage in stages]
+    stats = explained.get('executionStats', {})
+    return {
+        'stages': stage_names,
+        'indexes': sorted({stage['indexName'] for stage in stages if 'indexName' in stage}),
+        'ixscan': 'IXSCAN' in stage_names and 'COLLSCAN' not in stage_names,
+        'empty': stage_names == ['EOF'],  # the collection doesn't exist
+        'keys_examined': stats.get('totalKeysExamined'),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'returned': stats.get('nReturned'),
+    }
+
+
+def explain_hot_queries(
+    collections: Dict[str, collection.Collection],
+    visa_type: str,
+    embassy_code: str,
+    email: str = 'someone@example.com',
+    now: Optional[datetime] = None,
+) -> List[dict]:
+    """ `explain_query` of every hot query, see `hot_queries`."""
+    return [
+        {'name': name, 'collection': collection_name, **explain_query(collections[collection_name], query)}
+        for name, collection_name, query in hot_queries(visa_type, embassy_code, email, now or datetime.utcnow())
+    ]
@@ -1,17 +1,21 @@
 """ Functionality for sending notification for visa status change as well as
     confirmation for email subscription.
 """
-import json
-import asyncio
+import logging
 import requests
-import websockets
 import tuixue_mongodb as DB
 from datetime import datetime
-from multiprocessing import Pool
+from threading import Lock
 from tuixue_typing import VisaType
 from typing import Any, Dict, List, Optional
 from fastapi.encoders import jsonable_encoder
 from global_var import USEmbassy, VISA_TYPE_DETAILS, SECRET, FRONTEND_BASE_URI, NONDOMESTIC_DEFAULT_FILTER, DEFAULT_FILTER
+from global_var import MAX_EMAIL_SENT, EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_BACKOFF, EMAIL_RELAY_RATE
+from global_var import WEBSOCKET_PUBLISHER_BUFFER, WEBSOCKET_PUBLISHER_BATCH
+from global_var import CHAT_DIGEST_WINDOW, CHAT_MIRAI_SESSION_TTL
+from chat_notifier import ChatNotifier
+from email_outbox import EmailOutbox
+from websocket_publisher import WebSocketPublisher
 from url import URL
 
 
@@ -88,16 +92,54 @@ UNSUBSCRIPTION_EMPTY_SUBS_CONTENT = """
 """
 
 
-def qq_group_post_wrapper(args: tuple) -> None:
-    url, data = args
-    requests.post(url, data=data)
-
-
 class Notifier:
     """ A class that contains methods for sending notifications visa emails
         and other social media platforms.
     """
     email_request = requests.Session()
+    outbox: Optional[EmailOutbox] = None
+    websocket_publisher: Optional[WebSocketPublisher] = None
+    websocket_lock = Lock()
+    chat_notifier: Optional[ChatNotifier] = None
+    chat_lock = Lock()
+
+    @classmethod
+    def enable_outbox(cls, logger: Optional[logging.Logger] = None) -> EmailOutbox:
+        """ Queue the emails in MongoDB from now on, and start posting them in the background."""
+        if cls.outbox is None:
+            cls.outbox = EmailOutbox(
+                DB.Subscription.outbox,
+                SECRET['email'],
+                max_receivers=MAX_EMAIL_SENT,
+                rate=EMAIL_RELAY_RATE,
+                max_attempts=EMAIL_MAX_ATTEMPTS,
+                backoff=EMAIL_RETRY_BACKOFF,
+                logger=logger,
+            )
+            cls.outbox.start()
+        return cls.outbox
+
+    @classmethod
+    def queue_email(
+        cls,
+        title: str,
+        content: str,
+        receivers: List[str],
+        sendfrom: str = 'dean@tuixue.online',
+        sendto: str = 'pending@tuixue.online',
+        attempts: int = 1,
+    ) -> bool:
+        """ Queue an email in the outbox, which retries it until it's sent. Without the outbox,
+            send it right away, `attempts` times at most. Return whether it's queued or sent.
+        """
+        if cls.outbox is not None:
+            cls.outbox.enqueue(title, content, receivers, sendfrom, sendto)
+            return True
+
+        for _ in range(attempts):
+            if cls.send_email(title, content, receivers, sendfrom, sendto):
+                return True
+        return False
 
     @classmethod
     def send_subscription_confirmation(cls, email: str, subs_lst: List[DB.EmailSubscription]):
@@ -112,7 +154,7 @@ class Notifier:
         subscription_str = '<ul>\n{}\n</ul>'.format(
             '\n'.join(['<li>{} Visa at {} till {}.</li>'.format(
                 VISA_TYPE_DETAILS[vt],
-                next((e.name_en for e in USEmbassy.get_embassy_lst() if e.code == ec), 'None'),
+                getattr(USEmbassy.get_embassy_by_code(ec), 'name_en', 'None'),
                 tl.strftime('%Y/%m/%d') if tl != datetime.max else 'FOREVER',
             ) for vt, ec, tl in subs_lst])
         )
@@ -124,37 +166,25 @@ class Notifier:
             confirmation_url=confirmation_url,
         )
 
-        for _ in range(10):  # for robust
-            sent = cls.send_email(
-                title=SUBSCRIPTION_CONFIRMATION_TITLE.format(email=email),
-                content=content,
-                receivers=[email]
-            )
-            if sent:
-                break
-        else:
-            sent = False
-
-        return sent
+        return cls.queue_email(
+            title=SUBSCRIPTION_CONFIRMATION_TITLE.format(email=email),
+            content=content,
+            receivers=[email],
+            attempts=10,  # for robust
+        )
 
     @classmethod
     def send_unsubscription_confirmation(cls, email: str):
         """ Send the email for confirmation of email unsubscription. """
         subs_lst_by_email = DB.Subscription.get_subscriptions_by_email(email)
         if len(subs_lst_by_email) == 0:  # If the user has no subscription/email doesn't exist
-            for _ in range(10):
-                sent = cls.send_email(
-                    title=UNSUBSCRIPTION_EMPTY_SUBS_TITLE.format(email=email),
-                    content=UNSUBSCRIPTION_EMPTY_SUBS_CONTENT.format(
-                        user=email.split('@')[0], email=email, base_uri=FRONTEND_BASE_URI),
-                    receivers=[email],
-                )
-                if sent:
-                    break
-            else:
-                sent = False
-
-            return sent
+            return cls.queue_email(
+                title=UNSUBSCRIPTION_EMPTY_SUBS_TITLE.format(email=email),
+                content=UNSUBSCRIPTION_EMPTY_SUBS_CONTENT.format(
+                    user=email.split('@')[0], email=email, base_uri=FRONTEND_BASE_URI),
+                receivers=[email],
+                attempts=10,
+            )
 
         unsubs_url = URL(f'https://{FRONTEND_BASE_URI}/visa/email/unsubscription')  # Unsubscription confirmation url
         unsubs_url.query_param.set('email', email)
@@ -175,7 +205,7 @@ class Notifier:
         unsubscription_str = '{}'.format(
             '\n'.join(['<li>{} Visa at {} {} on {}: click <a href="{}">this link</a> to unsubscribe.</li>'.format(
                 VISA_TYPE_DETAILS[vt],
-                next((e.name_en for e in USEmbassy.get_embassy_lst() if e.code == ec), 'None'),
+                getattr(USEmbassy.get_embassy_by_code(ec), 'name_en', 'None'),
                 'expired' if exp else 'expiring',
                 tl.strftime('%Y/%m/%d') if tl.year < 9999 else 'FOREVER',
                 url,
@@ -189,27 +219,27 @@ class Notifier:
             unsubscribe_all_url=unsubs_all_url,
         )
 
-        for _ in range(10):
-            sent = cls.send_email(
-                title=UNSUBSCRIPTION_CONFIRMATION_TITLE,
-                content=content,
-                receivers=[email]
-            )
-
-            if sent:
-                break
-        else:
-            sent = False
-
-        return sent
+        return cls.queue_email(
+            title=UNSUBSCRIPTION_CONFIRMATION_TITLE,
+            content=content,
+            receivers=[email],
+            attempts=10,
+        )
 
     @classmethod
-    async def send_via_websocket(cls, data: Dict[str, Any]) -> None:
-        """ Send an object in JSON string visa websocket."""
-        ws_url, ws_token = SECRET['websocket_url'], SECRET['websocket_token']
-        async with websockets.connect(f'{ws_url}?token={ws_token}') as ws:
-            data_str = json.dumps(jsonable_encoder(data))
-            await ws.send(data_str)
+    def send_via_websocket(cls, data: Dict[str, Any]) -> None:
+        """ Queue an object for the websocket service, sent as JSON over the long-lived
+            connection of the publisher, see websocket_publisher.py.
+        """
+        with cls.websocket_lock:
+            if cls.websocket_publisher is None:
+                ws_url, ws_token = SECRET['websocket_url'], SECRET['websocket_token']
+                cls.websocket_publisher = WebSocketPublisher(
+                    f'{ws_url}?token={ws_token}',
+                    max_buffer=WEBSOCKET_PUBLISHER_BUFFER,
+                    batch_size=WEBSOCKET_PUBLISHER_BATCH,
+                )
+        cls.websocket_publisher.publish(jsonable_encoder(data))
 
     @classmethod
     def send_email(
@@ -240,7 +270,9 @@ class Notifier:
         curr: Optional[datetime],
         visa_type: str,
     ) -> bool:
-        """ Send notification to QQ group and Telegram channel."""
+        """ Send notification to QQ group and Telegram channel. The change is posted in the
+            next digest of the chat notifier, see chat_notifier.py.
+        """
         def converter(d: Optional[datetime]) -> str:
             if d is None:
                 return "/"
@@ -248,46 +280,34 @@ class Notifier:
                 return f'{d.month}/{d.day}'
             return f'{d.year}/{d.month}/{d.day}'
 
-        prev, curr = converter(prev), converter(curr)
-        content = f"{embassy.name_cn} {visa_type}: {prev} -> {curr}"
-        # qq
-        extra = SECRET["qq"]
-        base_uri = extra["mirai_base_uri"]
-        auth_key = extra["mirai_auth_key"]
-        qq_num = extra["qq_num"]
+        qq, telegram = SECRET['qq'], SECRET['telegram']
+        channels = []
         if embassy.code in DEFAULT_FILTER:
-            group_id = extra["qq_group_id"]["domestic"]
+            channels.extend(('qq', group_id) for group_id in qq['qq_group_id']['domestic'])
         elif embassy.code in NONDOMESTIC_DEFAULT_FILTER:
-            group_id = extra["qq_group_id"]["non_domestic"]
-        else:
-            group_id = []
-        if group_id:
-            r = requests.post(base_uri + "/auth",
-                              data=json.dumps({"authKey": auth_key})).json()
-            session = r["session"]
-            requests.post(base_uri + "/verify",
-                          data=json.dumps({"sessionKey": session, "qq": qq_num}))
-            post_args = []
-            for g in group_id:
-                data = json.dumps(
-                    {"sessionKey": session, "target": g, "messageChain": [{
-                        "type": "Plain",
-                        "text": f"{content}\n详情: https://{FRONTEND_BASE_URI}/visa/"
-                    }]})
-                post_args.append((base_uri + "/sendGroupMessage", data))
-            Pool(len(post_args)).map(qq_group_post_wrapper, post_args)
-            requests.post(base_uri + "/release",
-                          data=json.dumps({"sessionKey": session, "qq": qq_num}))
-        # tg
-        extra = SECRET["telegram"]
-        bot_token = extra["tg_bot_token"]
-        if embassy.region == "DOMESTIC":
-            chat_id = extra["tg_chat_id"]["domestic"]
+            channels.extend(('qq', group_id) for group_id in qq['qq_group_id']['non_domestic'])
+        if embassy.region == 'DOMESTIC':
+            channels.append(('tg', telegram['tg_chat_id']['domestic']))
         else:
-            chat_id = extra["tg_chat_id"]["non_domestic"]
-        proxies = dict(http=extra['proxy'], https=extra['proxy'])
-        r = requests.get("https://api.telegram.org/bot%s/sendMessage?chat_id=%s&text=%s" %
-                         (bot_token, chat_id, content), proxies=proxies).json()
+            channels.append(('tg', telegram['tg_chat_id']['non_domestic']))
+
+        with cls.chat_lock:
+            if cls.chat_notifier is None:
+                cls.chat_notifier = ChatNotifier(
+                    qq,
+                    telegram,
+                    footer=f'详情: https://{FRONTEND_BASE_URI}/visa/',
+                    window=CHAT_DIGEST_WINDOW,
+                    session_ttl=CHAT_MIRAI_SESSION_TTL,
+                )
+        cls.chat_notifier.notify(
+            channels,
+            (visa_type, embassy.code),
+            f'{embassy.name_cn} {visa_type}',
+            converter(prev),
+            converter(curr),
+        )
+        return True
 
     @classmethod
     def notify_visa_status_change(
@@ -323,7 +343,7 @@ class Notifier:
                     old_status = '/' if last_available_date is None else last_available_date.strftime('%Y/%m/%d')
                     new_status = available_date.strftime('%Y/%m/%d')
 
-                    cls.send_email(
+                    cls.queue_email(
                         title=VISA_STATUS_CHANGE_TITLE.format(visa_detail=VISA_TYPE_DETAILS[visa_type]),
                         content=VISA_STATUS_CHANGE_CONTENT.format(
                             send_time=datetime.now().astimezone(embassy.timezone).strftime('%Y/%m/%d %H:%M:%S'),
@@ -341,10 +361,7 @@ class Notifier:
                 'prev_avai_date': last_available_date,
                 'curr_avai_date': available_date
             }
-            try:
-                asyncio.run(cls.send_via_websocket(ws_data))
-            except:
-                pass
+            cls.send_via_websocket(ws_data)
 
             # QQ/TG, need async
             if visa_type in ["F", "J"]:
@@ -0,0 +1,175 @@
+""" A heap-based scheduler for the periodic fetching jobs.
+    One dispatcher thread pops the due jobs from a priority queue ordered by due time and
+    hands them to a bounded worker pool, instead of one `threading.Timer` thread per job
+    per tick. Jobs run at a fixed rate, and the interval of a job can be overridden by
+    declarative `ScheduleRule`s. The lateness of every run against its due time is kept.
+    A run is skipped while the previous run of the same job is still queued or running, so the
+    runs of a job don't pile up in the pool when the workers are saturated.
+"""
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Optional, Sequence, Set, Tuple
+
+
+class Job:
+    """ A function to be called every `interval_sec` seconds. `attrs` carries whatever the
+        schedule rules need to match the job, e.g. visa type and location.
+    """
+    def __init__(self, name: str, func: Callable[[], Any], interval_sec: float, **attrs) -> None:
+        self.name = name
+        self.func = func
+        self.interval_sec = interval_sec
+        self.attrs = attrs
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(name={self.name}, interval_sec={self.interval_sec})'
+
+
+class ScheduleRule:
+    """ Run the jobs accepted by `match` every `interval_sec` seconds while `active` returns
+        True for the current local time.
+    """
+    def __init__(
+        self,
+        name: str,
+        interval_sec: float,
+        match: Callable[[Job], bool],
+        active: Callable[[datetime], bool],
+    ) -> None:
+        self.name = name
+        self.interval_sec = interval_sec
+        self.match = match
+        self.active = active
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(name={self.name}, interval_sec={self.interval_sec})'
+
+
+class LatenessTracker:
+    """ Keep how late (in seconds) the recent runs started against their due time."""
+    def __init__(self, window: int = 1024) -> None:
+        self.lateness: Deque[float] = deque(maxlen=window)
+        self.run_cnt = 0
+
+    def record(self, lateness: float) -> None:
+        self.lateness.append(lateness)
+        self.run_cnt += 1
+
+    def stats(self) -> dict:
+        """ Return the number of runs and the mean/p95/max lateness of the recent runs."""
+        lateness = sorted(self.lateness)
+        if len(lateness) == 0:
+            return {'run_cnt': self.run_cnt}
+
+        return {
+            'run_cnt': self.run_cnt,
+            'lateness_mean': sum(lateness) / len(lateness),
+            'lateness_p95': lateness[int(0.95 * (len(lateness) - 1))],
+            'lateness_max': lateness[-1],
+        }
+
+
+def interval_of(job: Job, rules: Sequence[ScheduleRule], now: datetime) -> float:
+    """ Return the interval until the next run of a job, the first active rule wins."""
+    for rule in rules:
+        if rule.active(now) and rule.match(job):
+            return rule.interval_sec
+    return job.interval_sec
+
+
+class Scheduler:
+    """ Dispatch due jobs to a pool of `max_workers` threads."""
+    def __init__(
+        self,
+        max_workers: int,
+        rules: Sequence[ScheduleRule] = (),
+        logger: Optional[logging.Logger] = None,
+        lateness_window: int = 1024,
+    ) -> None:
+        self.rules = list(rules)
+        self.logger = logger or logging.getLogger('scheduler')
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetching')
+
+        self.heap: List[Tuple[float, int, Job]] = []
+        self.seq = itertools.count()  # tie breaker, jobs themselves are not comparable
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.dispatcher: Optional[threading.Thread] = None
+        self.in_flight: Set[Job] = set()  # queued or running
+
+        self.lateness = LatenessTracker(lateness_window)
+        self.skipped_cnt = 0
+
+    def add_job(self, job: Job, delay: float = 0) -> None:
+        """ Schedule the first run of a job `delay` seconds from now."""
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), job))
+            self.cond.notify()
+
+    def start(self) -> None:
+        """ Start the dispatcher thread."""
+        self.dispatcher = threading.Thread(target=self.run, name='scheduler')
+        self.dispatcher.start()
+
+    def stop(self, wait: bool = True) -> None:
+        """ Stop dispatching, running jobs are allowed to finish if `wait`."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.executor.shutdown(wait=wait)
+
+    def run(self) -> None:
+        """ Pop the due jobs, re-arm them and submit them to the worker pool."""
+        while True:
+            with self.cond:
+                while not self.stopped and (len(self.heap) == 0 or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(None if len(self.heap) == 0 else self.heap[0][0] - time.monotonic())
+                if self.stopped:
+                    return
+
+                due, _, job = heapq.heappop(self.heap)
+                now = time.monotonic()
+                next_due = due + interval_of(job, self.rules, datetime.now())
+                if next_due < now:  # too late to catch up, skip the missed runs instead of bursting
+                    next_due = now + interval_of(job, self.rules, datetime.now())
+                heapq.heappush(self.heap, (next_due, next(self.seq), job))
+
+                if job in self.in_flight:  # the previous run waits for a worker or is still running
+                    self.skipped_cnt += 1
+                    self.logger.debug('Skip %s, its previous run is not finished', job.name)
+                    continue
+                self.in_flight.add(job)
+
+            try:
+                self.executor.submit(self.execute, job, due)
+            except RuntimeError:  # the pool is shut down by `stop` in the meantime
+                return
+
+    def execute(self, job: Job, due: float) -> None:
+        """ Run a job in the worker pool and record how late it started."""
+        lateness = time.monotonic() - due
+        self.lateness.record(lateness)
+        self.logger.debug('Run %s, %.3f seconds late', job.name, lateness)
+
+        try:
+            job.func()
+        except Exception:
+            self.logger.exception('Job %s raised an exception', job.name)
+        finally:
+            with self.cond:
+                self.in_flight.discard(job)
+
+    def stats(self) -> dict:
+        """ Return the number of scheduled jobs, the runs skipped and the lateness of the recent runs."""
+        return {
+            'scheduled_jobs': len(self.heap),
+            'in_flight_jobs': len(self.in_flight),
+            'skipped_cnt': self.skipped_cnt,
+            **self.lateness.stats(),
+        }
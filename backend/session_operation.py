@@ -1,6 +1,8 @@
-""" Definition of 3 classes:
+""" Definition of 4 classes:
     1. Session: Object used to store the session string retrieved from crawler server.
-    2. SessionCache: Container that cache the session by visa_type and places, along with
+    2. SessionJournal: Persist the session cache as a snapshot plus an append-only journal.
+    3. SessionUpdateQueue: Prioritized queue of the expired sessions waiting for a new one.
+    4. SessionCache: Container that cache the session by visa_type and places, along with
         method for manipulating the session.
 
     Refactored out from ../global/crawler/lite_visa.py
@@ -11,13 +13,15 @@ import util
 import random
 import string
 import logging
-from queue import Queue
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
-from typing import DefaultDict, List, Optional, Sequence, Tuple, Union
+from typing import Callable, DefaultDict, Deque, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
 import global_var as G
 
+LOCATIONS = frozenset([*G.CGI_LOCATION, *G.AIS_LOCATION])
+
 
 class Session:
     """ Store the session from CGI/AIS systems.
@@ -76,9 +80,191 @@ def random_session(sys: str) -> Session:
     return Session(session=sess, sys=sys)
 
 
+class SessionJournal:
+    """ Persist the session cache without rewriting the whole file on every replacement.
+        The snapshot is the session file itself, in the same format as before. Every replacement
+        is queued as one JSON line under the lock of the cache, so that the journal keeps the
+        order of the replacements, and appended to `{session_file}.journal` outside of it. Once
+        `compact_every` lines are journaled, a new snapshot is written to a temporary file and
+        moved over the old one, then the journal is truncated. Startup replays the snapshot
+        plus the journal.
+    """
+    def __init__(self, session_file: str, compact_every: int = G.SESSION_JOURNAL_COMPACT) -> None:
+        self.session_file = session_file
+        self.journal_file = f'{session_file}.journal'
+        self.compact_every = compact_every
+        self.logger = logging.getLogger(G.GlobalVar.var_dct['log_name'])
+
+        self.pending: Deque[dict] = deque()
+        self.io_lock = threading.Lock()  # one writer at a time, so the lines are written in order
+        self.journal_len = 0
+
+    def append(self, visa_type: str, location: str, slot: int, session: Session) -> None:
+        """ Queue a replacement. Must be called under the lock guarding the session slot."""
+        self.pending.append({'visa_type': visa_type, 'location': location, 'slot': slot, 'session': session.to_json()})
+
+    def drain(self) -> List[dict]:
+        """ Take all the queued replacements."""
+        entries = []
+        while len(self.pending) > 0:
+            entries.append(self.pending.popleft())
+        return entries
+
+    def write(self, entries: List[dict]) -> None:
+        """ Append the entries to the journal, the caller must hold `io_lock`."""
+        if len(entries) == 0:
+            return
+        with open(self.journal_file, 'a') as f:
+            f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+        self.journal_len += len(entries)
+
+    def flush(self) -> None:
+        """ Write the queued replacements into the journal."""
+        with self.io_lock:
+            self.write(self.drain())
+
+    @property
+    def need_compaction(self) -> bool:
+        return self.journal_len >= self.compact_every
+
+    def compact(self, snapshot: Callable[[], Tuple[dict, List[dict]]]) -> None:
+        """ Replace the snapshot and truncate the journal. `snapshot` returns the serialized
+            cache along with the drained queue, both taken under the lock of the cache.
+        """
+        with self.io_lock:
+            session_json, entries = snapshot()
+            # journal the drained entries first: if we crash before truncating, replaying the
+            # complete journal on top of the new snapshot ends up in the same state
+            self.write(entries)
+
+            tmp_file = f'{self.session_file}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(session_json, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.session_file)
+
+            open(self.journal_file, 'w').close()
+            self.journal_len = 0
+
+        self.logger.debug('Write session cache into disk: %s', self.session_file)
+
+    def load_snapshot(self) -> dict:
+        """ Return the serialized session cache of the snapshot, empty if there isn't a valid one."""
+        if not os.path.exists(self.session_file):
+            return {}
+
+        with open(self.session_file) as f:
+            try:
+                session_json = json.load(f)
+                if not isinstance(session_json, dict):
+                    raise TypeError()
+            except json.decoder.JSONDecodeError:
+                self.logger.debug('%s is empty or borken written', self.session_file)
+            except TypeError:
+                self.logger.debug('%s doesn\'t store a dictionary.', self.session_file)
+            else:
+                return session_json
+        return {}
+
+    def replay(self) -> Iterator[dict]:
+        """ Yield the journaled replacements in order."""
+        if not os.path.exists(self.journal_file):
+            return
+
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.decoder.JSONDecodeError:  # torn line written by a crashed process
+                    self.logger.debug('Skip broken journal line: %s', line.strip())
+
+
+class SessionUpdateQueue:
+    """ The expired sessions waiting for a new session from the crawler server.
+        `get` returns a session of the pool closest to being fully expired, counting the
+        sessions queued or being refreshed, ties go to the visa type fetched most often.
+        At most `max_in_flight` sessions of a pool are refreshed at the same time, so the
+        consumers don't all wait on one slow pool while the others starve.
+        A session already queued or being refreshed is not queued again until `done`.
+    """
+    def __init__(self, sys: str, max_in_flight: int = G.SESSION_REFRESH_PER_POOL) -> None:
+        self.sys = sys
+        self.max_in_flight = max_in_flight
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.queued: DefaultDict[Tuple[str, str], Deque[Tuple[int, Session]]] = defaultdict(deque)
+        self.pending: Set[Tuple[str, str, str]] = set()  # queued or in flight
+        self.pending_cnt: DefaultDict[Tuple[str, str], int] = defaultdict(int)
+        self.in_flight: DefaultDict[Tuple[str, str], int] = defaultdict(int)
+        self.dedup_cnt = 0
+
+    def qsize(self) -> int:
+        return sum(len(sess_queue) for sess_queue in self.queued.values())
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.qsize(),
+            'pending': len(self.pending),
+            'in_flight': sum(self.in_flight.values()),
+            'dedup_cnt': self.dedup_cnt,
+        }
+
+    def priority(self, visa_type: str, location: str) -> Tuple[float, int]:
+        """ Return the priority of a pool, lower goes first."""
+        expired_ratio = self.pending_cnt[(visa_type, location)] / G.SESS_POOL_SIZE[self.sys][visa_type]
+        return -expired_ratio, G.FETCH_TIME_INTERVAL[self.sys][visa_type]
+
+    def put(self, visa_type: str, location: str, session: Session) -> bool:
+        """ Queue an expired session, return False if it's already queued or being refreshed."""
+        key = (visa_type, location, session.session)
+        with self.cond:
+            if key in self.pending:
+                self.dedup_cnt += 1
+                return False
+
+            self.pending.add(key)
+            self.pending_cnt[(visa_type, location)] += 1
+            self.queued[(visa_type, location)].append((self.seq, session))
+            self.seq += 1
+            self.cond.notify()
+        return True
+
+    def get(self) -> Tuple[str, str, Session]:
+        """ Block until a session of a pool below `max_in_flight` refreshes is queued, and return
+            the most urgent one. The caller must call `done` once the session is refreshed.
+        """
+        with self.cond:
+            while True:
+                pools = [pool for pool in self.queued if self.in_flight[pool] < self.max_in_flight]
+                if len(pools) > 0:
+                    break
+                self.cond.wait()
+
+            visa_type, location = min(pools, key=lambda pool: (*self.priority(*pool), self.queued[pool][0][0]))
+            sess_queue = self.queued[(visa_type, location)]
+            _, session = sess_queue.popleft()
+            if len(sess_queue) == 0:
+                del self.queued[(visa_type, location)]
+            self.in_flight[(visa_type, location)] += 1
+        return visa_type, location, session
+
+    def done(self, visa_type: str, location: str, session: Session) -> None:
+        """ Mark a session returned by `get` as refreshed, whether it succeeded or not."""
+        with self.cond:
+            self.pending.discard((visa_type, location, session.session))
+            self.pending_cnt[(visa_type, location)] -= 1
+            self.in_flight[(visa_type, location)] -= 1
+            if (visa_type, location) in self.queued:  # a consumer may wait for this pool
+                self.cond.notify()
+
+
 class SessionCache:
     """ A container that store all the sessions by visa_type and places, along
         with thread safe methods to manipulate it.
+        A session pool is guarded by one of `lock_stripes` locks picked by the hash of its
+        (visa_type, location), so that fetching threads of different embassies don't wait
+        for each other. `session_slot` maps the session strings of a pool to their index.
     """
     @staticmethod
     def inititae_session_cache(
@@ -100,9 +286,12 @@ class SessionCache:
                     session_idx[visa_type][loc] = 0
         return session, session_idx
 
-    def __init__(self) -> None:
+    def __init__(self, lock_stripes: int = G.SESSION_LOCK_STRIPES) -> None:
         self.session = defaultdict(lambda: defaultdict(list))
         self.session_idx = defaultdict(lambda: defaultdict(int))
+        self.session_slot: DefaultDict[str, DefaultDict[str, Dict[str, int]]] = defaultdict(lambda: defaultdict(dict))
+        self.locks = [threading.Lock() for _ in range(lock_stripes)]
+        self.update_queue = SessionUpdateQueue(G.value('target_system', None))
         now = datetime.now()
         self.session_avail = defaultdict(lambda: defaultdict(lambda: now))
         self.logger = logging.getLogger(G.GlobalVar.var_dct['log_name'])
@@ -114,53 +303,67 @@ class SessionCache:
             self.logger.error('Not target system given')
             raise ValueError('The target system is not set!')
 
-        if os.path.exists(session_file):
-            with open(session_file) as f:
-                try:
-                    old_session = json.load(f)
-                    if not isinstance(old_session, dict):
-                        raise TypeError()
-                except json.decoder.JSONDecodeError:
-                    self.logger.debug('session.json is empty or borken written')
-                except TypeError:
-                    self.logger.debug('session.json doesn\'t store a dictionary.')
-                else:
-                    for visa_type, loc_sess_lst in old_session.items():
-                        for loc, sess_lst in loc_sess_lst.items():
-                            self.session[visa_type][loc] = [Session(**session) for session in sess_lst]
-                            self.session_idx[visa_type][loc] = 0  # set currently used index to 0
+        self.journal = SessionJournal(session_file)
+        for visa_type, loc_sess_lst in self.journal.load_snapshot().items():
+            for loc, sess_lst in loc_sess_lst.items():
+                self.session[visa_type][loc] = [Session(**session) for session in sess_lst]
+                self.session_idx[visa_type][loc] = 0  # set currently used index to 0
+
         self.session, self.session_idx = self.inititae_session_cache(sys, self.session, self.session_idx)
-        self.save()
 
-    def save(self):
-        """ Write the current session into disk."""
-        session_file = G.value('session_file', 'session.json')
-        with G.LOCK:
+        replayed = 0
+        for entry in self.journal.replay():
+            sess_lst = self.session[entry['visa_type']][entry['location']]
+            if entry['slot'] < len(sess_lst):  # the pool size may have shrunk since
+                sess_lst[entry['slot']] = Session(**entry['session'])
+                replayed += 1
+        self.logger.debug('Replay %d session replacements from %s', replayed, self.journal.journal_file)
+
+        for visa_type, loc_sess_dct in self.session.items():
+            for loc, sess_lst in loc_sess_dct.items():
+                for slot, sess in enumerate(sess_lst):
+                    self.session_slot[visa_type][loc].setdefault(sess.session, slot)
+        self.save()
 
-            session_json = defaultdict(lambda: defaultdict(list))
-            for visa_type, loc_sess_dct in self.session.items():
-                for loc, sess_lst in loc_sess_dct.items():
-                    session_json[visa_type][loc] = [session.to_json() for session in sess_lst]
+    def lock_of(self, visa_type: str, location: str) -> threading.Lock:
+        """ Return the lock guarding the session pool of (visa_type, location)."""
+        return self.locks[hash((visa_type, location)) % len(self.locks)]
 
-            with open(session_file, 'w') as f:
-                json.dump(dict(session_json), f, indent=4, ensure_ascii=False)
+    def to_json(self) -> dict:
+        """ Return serializable object from the cached sessions, the caller must hold the lock."""
+        return {
+            visa_type: {loc: [session.to_json() for session in sess_lst] for loc, sess_lst in loc_sess_dct.items()}
+            for visa_type, loc_sess_dct in self.session.items()
+        }
+
+    def snapshot(self) -> Tuple[dict, List[dict]]:
+        """ Return the serialized sessions and the journal entries not written yet, at the same instant."""
+        for lock in self.locks:  # always in the same order, a thread holds at most one stripe otherwise
+            lock.acquire()
+        try:
+            return self.to_json(), self.journal.drain()
+        finally:
+            for lock in self.locks:
+                lock.release()
 
-            self.logger.debug('Write session cache into disk: %s', session_file)
+    def save(self):
+        """ Write a snapshot of the current session into disk and truncate the journal."""
+        self.journal.compact(self.snapshot)
 
     def get_session(self, visa_type: str, location: str) -> Session:
         """ Return the cached session object by visa_type and location."""
-        if visa_type not in G.VISA_TYPES or location not in [*G.CGI_LOCATION, *G.AIS_LOCATION]:
+        if visa_type not in G.VISA_TYPES or location not in LOCATIONS:
             return
         if datetime.now() < self.session_avail[visa_type][location]:
             return
 
-        with G.LOCK:  # is locking here necessary?
+        with self.lock_of(visa_type, location):
             sess_lst = self.session[visa_type][location]
             sess_idx = self.session_idx[visa_type][location]
             session = sess_lst[sess_idx % len(sess_lst)]
-            self.logger.debug('get session %s', session)
             self.session_idx[visa_type][location] += 1
 
+        self.logger.debug('get session %s', session)
         return session
 
     def replace_session(
@@ -171,47 +374,48 @@ class SessionCache:
         new_session: Session,
     ) -> None:
         """ Replace session immediately with a new session object provided.
-            Every time the sesssion is update, write to the file.
+            Every time the sesssion is update, append it to the journal.
         """
-        if visa_type not in G.VISA_TYPES or location not in [*G.CGI_LOCATION, *G.AIS_LOCATION]:
+        if visa_type not in G.VISA_TYPES or location not in LOCATIONS:
             return
 
-        with G.LOCK:  # is locking here necessary?
-            sess_lst = self.session[visa_type][location]
-
-            try:
-                sess_idx = [sess.session for sess in sess_lst].index(session.session)
-            except ValueError:
+        with self.lock_of(visa_type, location):
+            session_slot = self.session_slot[visa_type][location]
+            sess_idx = session_slot.pop(session.session, None)
+            if sess_idx is None:
                 self.logger.debug('Error: given session is not in the session list.')
                 return
-            else:
-                self.session[visa_type][location][sess_idx] = new_session
-                self.logger.debug('Replace session | OLD: %s | NEW: %s', session, new_session)
 
-        self.save()
+            self.session[visa_type][location][sess_idx] = new_session
+            session_slot.setdefault(new_session.session, sess_idx)
+            self.journal.append(visa_type, location, sess_idx, new_session)
+
+        self.logger.debug('Replace session | OLD: %s | NEW: %s', session, new_session)
+
+        self.journal.flush()
+        if self.journal.need_compaction:
+            self.save()
 
     def produce_new_session_request(
         self,
         visa_type: str,
         location: str,
         session: Session,
-        task_queue: Queue = G.SESSION_UPDATE_QUEUE
     ) -> None:
         """ Put the session to be replaced in the task queue for visa fetched to update."""
-        self.logger.debug(
-            'Produce session update event for %s-%s | Current queue size: %d',
-            visa_type,
-            location,
-            task_queue.qsize()
-        )
-        task_queue.put((visa_type, location, session))
+        if self.update_queue.put(visa_type, location, session):
+            self.logger.debug(
+                'Produce session update event for %s-%s | Current queue size: %d',
+                visa_type,
+                location,
+                self.update_queue.qsize()
+            )
 
     def contain_session(self, visa_type: str, location: str, session: Session) -> bool:
         """ For a given session, return whether or not the session is in the cache"""
         if datetime.now() < self.session_avail[visa_type][location]:
             return False
-        sess_str_lst = [sess.session for sess in self.session[visa_type][location]]
-        return session.session in sess_str_lst
+        return session.session in self.session_slot[visa_type][location]
 
     def mark_unavailable(
         self, visa_type: str, location: str, cd: timedelta = timedelta(hours=G.CD_HOURS)
@@ -219,7 +423,7 @@ class SessionCache:
         if f'{visa_type}-{location}' not in G.CD_LIST:
             return
         self.logger.warning(f"mark {visa_type} {location} unavailable for {cd.seconds}s")
-        with G.LOCK:
+        with self.lock_of(visa_type, location):
             self.session_avail[visa_type][location] = datetime.now() + cd
 
 
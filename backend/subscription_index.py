@@ -0,0 +1,114 @@
+""" In-memory index of the email subscriptions by `(visa_type, embassy_code)` for the fetcher."""
+import bisect
+import logging
+import threading
+from datetime import datetime
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from tuixue_typing import VisaType, EmbassyCode
+
+Pair = Tuple[VisaType, EmbassyCode]
+
+
+class SubscriptionEvent(NamedTuple):
+    """ The subscriptions of `email` were changed."""
+    email: str
+
+    def to_json(self) -> list:
+        return [self.email]
+
+    @classmethod
+    def from_json(cls, obj: list) -> 'SubscriptionEvent':
+        return cls(*obj)
+
+
+def pair_tills(subscription: List[dict]) -> Dict[Pair, datetime]:
+    """ The `till` of every pair of a subscription list. Like the `subscription.$` projection of
+        `get_email_list`, only the first subscription of a pair subscribed twice counts.
+    """
+    tills: Dict[Pair, datetime] = {}
+    for subs in subscription:
+        tills.setdefault((subs['visa_type'], subs['embassy_code']), subs['till'])
+    return tills
+
+
+class SubscriptionIndex:
+    """ `(visa_type, embassy_code)` -> `[(till, email)]` in ascending order, built from the
+        subscriber documents of the `email_subscription` collection.
+    """
+    def __init__(self, logger: Optional[logging.Logger] = None) -> None:
+        self.logger = logger or logging.getLogger('subscription_index')
+        self.lock = threading.Lock()
+        self.subscribers: Dict[Pair, List[Tuple[datetime, str]]] = {}
+        self.tills_by_email: Dict[str, Dict[Pair, datetime]] = {}
+
+        # metrics
+        self.lookup_cnt = 0
+        self.update_cnt = 0
+        self.rebuild_cnt = 0
+
+    def rebuild(self, documents: Iterable[dict]) -> None:
+        """ Replace the whole index with the subscriber documents."""
+        subscribers = defaultdict(list)
+        tills_by_email = {}
+        for document in documents:
+            tills = pair_tills(document.get('subscription', []))
+            if len(tills) == 0:  # like `update`, an email without subscriptions isn't indexed
+                continue
+            tills_by_email[document['email']] = tills
+            for pair, till in tills.items():
+                subscribers[pair].append((till, document['email']))
+        for entries in subscribers.values():
+            entries.sort()
+
+        with self.lock:
+            self.subscribers = dict(subscribers)
+            self.tills_by_email = tills_by_email
+        self.rebuild_cnt += 1
+        self.logger.info('Subscription index rebuilt: %d subscribers', len(tills_by_email))
+
+    def update(self, email: str, subscription: List[dict]) -> None:
+        """ Replace the subscriptions of an email, an empty list removes the email."""
+        tills = pair_tills(subscription)
+        with self.lock:
+            for pair, till in self.tills_by_email.pop(email, {}).items():
+                entries = self.subscribers[pair]
+                del entries[bisect.bisect_left(entries, (till, email))]
+                if len(entries) == 0:
+                    del self.subscribers[pair]
+            for pair, till in tills.items():
+                bisect.insort(self.subscribers.setdefault(pair, []), (till, email))
+            if len(tills) > 0:
+                self.tills_by_email[email] = tills
+        self.update_cnt += 1
+
+    def get_email_list(
+        self,
+        new_visa_status: List[Tuple[VisaType, EmbassyCode, datetime]],
+        inclusion: str = 'both',
+    ) -> Dict[Pair, List[str]]:
+        """ Same as `Subscription.get_email_list`, the emails of a pair being in `till` order."""
+        email_list = {}
+        with self.lock:
+            for visa_type, embassy_code, available_date in new_visa_status:
+                entries = self.subscribers.get((visa_type, embassy_code), [])
+                if inclusion == 'both':
+                    selected = entries
+                else:
+                    # `(till, email) >= (available_date,)` exactly when `till >= available_date`
+                    split = bisect.bisect_left(entries, (available_date,))
+                    selected = entries[split:] if inclusion == 'effective_only' else entries[:split]
+                if len(selected) > 0:
+                    email_list.setdefault((visa_type, embassy_code), []).extend(email for _, email in selected)
+        self.lookup_cnt += 1
+        return email_list
+
+    def stats(self) -> dict:
+        return {
+            'subscriber_cnt': len(self.tills_by_email),
+            'pair_cnt': len(self.subscribers),
+            'lookup_cnt': self.lookup_cnt,
+            'update_cnt': self.update_cnt,
+            'rebuild_cnt': self.rebuild_cnt,
+        }
@@ -56,6 +56,46 @@ def initiate_database(since: str):
     DB.VisaStatus.initiate_collections_tz(since_date)
 
 
+def migrate_to_bucket():
+    """ Rewrite the daily `visa_status` documents into the time bucket layout.
+        Switch `VISA_STATUS_STORAGE` to 'bucket' after the migration finishes.
+    """
+    DB.VisaStatus.migrate_to_bucket()
+
+
+def migrate_overview():
+    """ Rewrite the `overview` arrays into one `overview_daily` document per embassy-local date.
+        Switch `OVERVIEW_STORAGE` to 'daily' after the migration finishes.
+    """
+    DB.VisaStatus.migrate_overview_to_daily()
+
+
+def migrate_turning_point():
+    """ Build the `turning_point` series of the detail from the stored fetches. Stop the fetchers
+        first, switch `DETAIL_SOURCE` to 'turning_point' after the migration finishes.
+    """
+    DB.VisaStatus.migrate_turning_points()
+
+
+def report_indexes():
+    """ Create the missing indexes, then print the plan of every hot query: the winning plan must
+        scan an index (IXSCAN), never the whole collection (COLLSCAN).
+    """
+    for index in DB.create_indexes():
+        print(f'Index: {index}')
+
+    for plan in DB.explain_hot_queries():
+        if plan['empty']:
+            verdict = 'EMPTY'
+        else:
+            verdict = 'IXSCAN' if plan['ixscan'] else 'NO INDEX'
+        print(
+            f"{verdict:<8} | {plan['collection']:<18} | {plan['name']:<26} | {' > '.join(plan['stages'])}"
+            f" | index: {', '.join(plan['indexes']) or '-'}"
+            f" | keys/docs examined: {plan['keys_examined']}/{plan['docs_examined']}, returned: {plan['returned']}"
+        )
+
+
 def infinite_fetch(since: str):
     """ Incase the connection drop or something..."""
     while True:
@@ -73,7 +113,8 @@ if __name__ == "__main__":
         '--operation', '-o',
         required=True,
         type=str,
-        choices=['fetch', 'write', 'email'], help='Choose what function to run'
+        choices=['fetch', 'write', 'email', 'bucket', 'overview', 'turning_point', 'indexes'],
+        help='Choose what function to run'
     )
     parser.add_argument(
         '--since', '-s',
@@ -100,3 +141,11 @@ if __name__ == "__main__":
         initiate_database(args.since)  # havn't fetched all data before 2020/9/16
     elif args.operation == 'email':
         DB.Subscription.initiate_email(args.email_path)
+    elif args.operation == 'bucket':
+        migrate_to_bucket()
+    elif args.operation == 'overview':
+        migrate_overview()
+    elif args.operation == 'turning_point':
+        migrate_turning_point()
+    elif args.operation == 'indexes':
+        report_indexes()
@@ -0,0 +1,59 @@
+""" Make the backend modules importable by the tests, wherever pytest is run from, and share
+    the helpers of the tests: `wait_until` and a local stub HTTP server.
+"""
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def wait_until(condition, timeout=5):
+    """ Return whether `condition()` came true within `timeout` seconds, it's evaluated until then."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ A quiet handler keeping the connections alive, the stubs implement `do_GET`/`do_POST`."""
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self, content: bytes, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """ Start a server of the given handler on a free local port, with the given attributes for the
+        handler to read and write through `self.server`. It's shut down after the test.
+    """
+    servers = []
+
+    def start(handler, **attributes):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        server.base_uri = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        for name, value in attributes.items():
+            setattr(server, name, value)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,86 @@
+""" The subscribers of the broadcast under the overflow policies, and their interest once evicted."""
+import asyncio
+
+import pytest
+
+from broadcast import Broadcast, Subscriber, Unsubscribed
+
+BJ, SH, GZ = ('F', 'bj'), ('F', 'sh'), ('F', 'gz')
+
+
+def drain(subscriber: Subscriber):
+    return [message for _, message in subscriber.messages]
+
+
+def test_drop_oldest():
+    subscriber = Subscriber(2, 'drop_oldest')
+    assert [subscriber.offer(BJ, 'a'), subscriber.offer(BJ, 'b'), subscriber.offer(BJ, 'c')] == \
+        ['queued', 'queued', 'dropped']
+    assert drain(subscriber) == ['b', 'c']
+
+
+def test_coalesce():
+    subscriber = Subscriber(3, 'coalesce')
+    for pair, message in [(BJ, 'a'), (SH, 'b'), (BJ, 'c')]:
+        assert subscriber.offer(pair, message) == 'queued'
+    assert subscriber.offer(BJ, 'd') == 'coalesced'  # replaces the latest of the pair, in place
+    assert drain(subscriber) == ['a', 'b', 'd']
+    assert subscriber.offer(GZ, 'e') == 'dropped'  # nothing to coalesce with
+    assert drain(subscriber) == ['b', 'd', 'e']
+
+
+def test_disconnect():
+    subscriber = Subscriber(1, 'disconnect')
+    assert subscriber.offer(BJ, 'a') == 'queued'
+    assert subscriber.offer(SH, 'b') == 'overflowed'
+    assert drain(subscriber) == ['a']
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Subscriber(1, 'block')
+
+
+def test_closed_subscriber_stops_iterating():
+    async def run():
+        subscriber = Subscriber(2)
+        subscriber.offer(BJ, 'a')
+        assert await subscriber.get_message() == 'a'
+        waiting = asyncio.create_task(subscriber.get_message())
+        await asyncio.sleep(0)
+        subscriber.close()
+        with pytest.raises(Unsubscribed):
+            await waiting
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('prior_interest', [None, [BJ, SH]])
+def test_interest_of_an_evicted_subscriber_is_ignored(prior_interest):
+    async def run():
+        broadcast = Broadcast(1, 'disconnect')
+        async with broadcast.subscribe() as subscriber:
+            if prior_interest is not None:
+                broadcast.set_interest(subscriber, prior_interest)
+            broadcast.evict(subscriber, 'overflow')
+            assert broadcast.matching(*BJ) == []
+
+            broadcast.set_interest(subscriber, [BJ, GZ])  # its query was handled meanwhile
+            assert broadcast.matching(*BJ) == [] and broadcast.matching(*GZ) == []
+        stats = broadcast.stats()
+        assert (stats['subscriber_cnt'], stats['interested_pair_cnt'], stats['interested_cnt']) == (0, 0, 0)
+        assert stats['evicted_cnt'] == {'overflow': 1, 'timeout': 0}
+    asyncio.run(run())
+
+
+def test_unsubscribed_subscriber_is_unindexed():
+    async def run():
+        broadcast = Broadcast()
+        async with broadcast.subscribe() as every:
+            async with broadcast.subscribe() as interested:
+                broadcast.set_interest(interested, [BJ])
+                assert set(broadcast.matching(*BJ)) == {every, interested}
+                assert broadcast.matching(*SH) == [every]
+            assert broadcast.matching(*BJ) == [every]
+            assert broadcast.stats()['interested_cnt'] == 0
+        assert broadcast.matching(*BJ) == []
+    asyncio.run(run())
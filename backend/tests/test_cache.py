@@ -0,0 +1,193 @@
+""" The TTL cache: single-flight computations, invalidation while computing, expiry and eviction."""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import cache
+from cache import TTLCache
+from conftest import wait_until
+
+
+class Computation:
+    """ A `compute` blocked until `release`, which sets `started` once called and records its calls."""
+    def __init__(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.started, self.released = threading.Event(), threading.Event()
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        self.started.set()
+        assert self.released.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def release(self):
+        self.released.set()
+
+
+class Call(threading.Thread):
+    """ Call a function in another thread, keep what it returned or raised."""
+    def __init__(self, function, *args):
+        super().__init__(daemon=True)
+        self.function, self.args = function, args
+        self.result = self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def outcome(self):
+        self.join(5)
+        assert not self.is_alive()
+        return self.result, self.error
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ The time of the cache, only moving forward when the test says so."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_concurrent_misses_compute_once():
+    ttl_cache = TTLCache(8, ttl=60)
+    compute = Computation('value')
+    first = Call(ttl_cache.get_or_compute, 'key', compute)
+    assert compute.started.wait(5)
+
+    other = Computation('other')
+    second = Call(ttl_cache.get_or_compute, 'key', other)
+    assert wait_until(lambda: ttl_cache.coalesced_cnt == 1)
+    compute.release()
+
+    assert first.outcome() == ('value', None) and second.outcome() == ('value', None)
+    assert len(compute.calls) == 1 and other.calls == []
+    assert ttl_cache.get('key') == 'value'
+    assert (ttl_cache.miss_cnt, ttl_cache.coalesced_cnt, ttl_cache.hit_cnt) == (1, 1, 1)
+
+
+def test_waiting_thread_computes_when_the_computing_one_fails():
+    ttl_cache = TTLCache(8, ttl=60)
+    failing = Computation(error=RuntimeError('database down'))
+    first = Call(ttl_cache.get_or_compute, 'key', failing)
+    assert failing.started.wait(5)
+
+    second = Call(ttl_cache.get_or_compute, 'key', lambda: 'value')
+    assert wait_until(lambda: ttl_cache.coalesced_cnt == 1)
+    failing.release()
+
+    assert isinstance(first.outcome()[1], RuntimeError)
+    assert second.outcome() == ('value', None)
+    assert ttl_cache.get('key') == 'value' and ttl_cache.in_flight == {}
+
+
+def test_many_keys_wait_for_the_ones_computed_elsewhere():
+    ttl_cache = TTLCache(8, ttl=60)
+    ttl_cache.put('a', 'cached')
+    compute = Computation('b computed elsewhere')
+    first = Call(ttl_cache.get_or_compute, 'b', compute)
+    assert compute.started.wait(5)
+
+    computed = []
+
+    def compute_many(keys):
+        computed.append(keys)
+        return {key: key.upper() for key in keys}
+
+    second = Call(ttl_cache.get_many_or_compute, ['a', 'b', 'c', 'c'], compute_many)
+    assert wait_until(lambda: ttl_cache.get('c') == 'C')  # computed without waiting for 'b'
+    compute.release()
+
+    assert second.outcome() == ({'a': 'cached', 'b': 'b computed elsewhere', 'c': 'C'}, None)
+    assert first.outcome() == ('b computed elsewhere', None)
+    assert computed == [['c']]
+
+
+def test_many_keys_fall_back_to_computing_when_the_other_thread_fails():
+    ttl_cache = TTLCache(8, ttl=60)
+    failing = Computation(error=RuntimeError('database down'))
+    first = Call(ttl_cache.get_or_compute, 'b', failing)
+    assert failing.started.wait(5)
+
+    computed = []
+
+    def compute_many(keys):
+        computed.append(keys)
+        return {key: key.upper() for key in keys}
+
+    second = Call(ttl_cache.get_many_or_compute, ['a', 'b'], compute_many)
+    assert wait_until(lambda: ttl_cache.get('a') == 'A')
+    failing.release()
+
+    assert isinstance(first.outcome()[1], RuntimeError)
+    assert second.outcome() == ({'a': 'A', 'b': 'B'}, None)
+    assert computed == [['a'], ['b']]
+
+
+@pytest.mark.parametrize('drop', [
+    lambda ttl_cache: ttl_cache.invalidate(lambda key: key[0] == 'F'),
+    lambda ttl_cache: ttl_cache.discard([('F', 'bj')]),
+])
+def test_value_invalidated_while_computed_is_not_cached(drop):
+    ttl_cache = TTLCache(8, ttl=60)
+    compute = Computation('before the write')
+    first = Call(ttl_cache.get_or_compute, ('F', 'bj'), compute)
+    assert compute.started.wait(5)
+
+    drop(ttl_cache)  # a write lands while the value is read
+    compute.release()
+    assert first.outcome() == ('before the write', None)  # to the thread that computed it
+    assert ttl_cache.get(('F', 'bj')) is None and ttl_cache.stale == set()
+
+    assert ttl_cache.get_or_compute(('F', 'bj'), lambda: 'after the write') == 'after the write'
+    assert ttl_cache.get(('F', 'bj')) == 'after the write'
+
+
+def test_many_keys_invalidated_while_computed_are_not_cached():
+    ttl_cache = TTLCache(8, ttl=60)
+    compute = Computation({'a': 1, 'b': 2})
+    first = Call(ttl_cache.get_many_or_compute, ['a', 'b'], compute)
+    assert compute.started.wait(5)
+
+    ttl_cache.discard(['a'])
+    compute.release()
+    assert first.outcome() == ({'a': 1, 'b': 2}, None)
+    assert ttl_cache.get('a') is None and ttl_cache.get('b') == 2
+
+
+def test_entry_expires_after_its_ttl(clock):
+    ttl_cache = TTLCache(8, ttl=10)
+    ttl_cache.put('default', 1)
+    ttl_cache.put('short', 2, ttl=5)
+    ttl_cache.get_or_compute('by key', lambda: 3, ttl=lambda key: 20)
+
+    clock.now += 5
+    assert ttl_cache.get('short') is None
+    assert ttl_cache.get('default') == 1
+    clock.now += 5
+    assert ttl_cache.get('default') is None
+    assert ttl_cache.get('by key') == 3
+    clock.now += 10
+    assert ttl_cache.get_or_compute('by key', lambda: 4) == 4
+    assert ttl_cache.expired_cnt == 3 and len(ttl_cache) == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    ttl_cache = TTLCache(2, ttl=60)
+    ttl_cache.put('a', 1)
+    ttl_cache.put('b', 2)
+    assert ttl_cache.get('a') == 1  # 'b' is now the least recently used
+    ttl_cache.put('c', 3)
+    assert ttl_cache.get('b') is None
+    assert (ttl_cache.get('a'), ttl_cache.get('c')) == (1, 3)
+
+    ttl_cache.get_many_or_compute(['d', 'e'], lambda keys: {key: key for key in keys})
+    assert list(ttl_cache.data) == ['d', 'e']
+    assert ttl_cache.stats()['eviction_cnt'] == 3
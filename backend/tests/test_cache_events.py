@@ -0,0 +1,106 @@
+""" Test the heartbeats of the cache events, and how a listener notices a silent or lossy publisher."""
+import time
+from datetime import datetime
+
+from cache_events import (
+    CacheEvent,
+    CacheEventListener,
+    LocalBus,
+    UnixSocketPublisher,
+    UnixSocketSubscriber,
+    number_datagram,
+    pack_events,
+)
+from conftest import wait_until
+
+
+def test_idle_publisher_sends_heartbeats(tmp_path):
+    subscriber = UnixSocketSubscriber(str(tmp_path))
+    publisher = UnixSocketPublisher(str(tmp_path), rescan_interval=0, heartbeat_interval=0.05)
+    try:
+        assert subscriber.receive(timeout=1) == []  # a heartbeat carries no event
+        assert subscriber.heard_at > time.monotonic() - 1
+        assert subscriber.receive(timeout=1) == []
+        assert subscriber.take_lost() == 1  # the first datagram of a publisher, nothing lost since
+
+        event = CacheEvent('F', 'pp', datetime(2021, 1, 1, 8, 0))
+        publisher.publish(event)
+        assert wait_until(lambda: event in subscriber.receive(timeout=0.2))
+    finally:
+        subscriber.close()
+
+
+def test_listener_is_live_while_it_hears_from_the_publisher(tmp_path):
+    subscriber = UnixSocketSubscriber(str(tmp_path))
+    losses = []
+    listener = CacheEventListener(subscriber, lambda events: None, lambda: losses.append(time.monotonic()),
+                                  silence_timeout=0.3)
+    listener.start()
+    publisher = UnixSocketPublisher(str(tmp_path), rescan_interval=0, heartbeat_interval=0.05)
+    try:
+        assert wait_until(lambda: listener.live)
+        assert wait_until(lambda: len(losses) == 1)  # the state is loaded once the publisher is heard
+
+        publisher.heartbeat_interval = 3600  # the publisher goes quiet, e.g. the fetcher is down
+        time.sleep(0.1)
+        publisher.wakeup.set()  # apply the new interval
+        assert wait_until(lambda: not listener.live)
+        assert wait_until(lambda: len(losses) == 2, timeout=2)  # the live fragments are dropped once
+        assert listener.stats()['silence_cnt'] == 1
+    finally:
+        listener.stop()
+
+
+def test_listener_without_publisher_is_not_live(tmp_path):
+    listener = CacheEventListener(UnixSocketSubscriber(str(tmp_path)), lambda events: None, silence_timeout=0.3)
+    listener.start()
+    try:
+        time.sleep(0.1)
+        assert listener.running and not listener.live
+    finally:
+        listener.stop()
+
+
+def test_dropped_datagram_is_noticed_by_the_next_heartbeat(tmp_path):
+    subscriber = UnixSocketSubscriber(str(tmp_path))
+    publisher = UnixSocketPublisher(str(tmp_path), rescan_interval=0, heartbeat_interval=3600)
+    try:
+        event = CacheEvent('F', 'pp', datetime(2021, 1, 1, 8, 0))
+        publisher.send(number_datagram('fetcher', 0, next(pack_events([event]))))
+        # the datagram 1 is dropped, the heartbeat 2 follows
+        publisher.send(number_datagram('fetcher', 2, b'[]'))
+        assert wait_until(lambda: subscriber.receive(timeout=0.2) == [] and subscriber.lost_cnt > 0)
+        assert subscriber.take_lost() == 2  # the first datagram of the source, and the dropped one
+    finally:
+        subscriber.close()
+
+
+def test_socket_bound_after_the_scan_gets_every_event(tmp_path):
+    publisher = UnixSocketPublisher(str(tmp_path), rescan_interval=3600, heartbeat_interval=3600)
+    publisher.publish(CacheEvent('F', 'pp', datetime(2021, 1, 1, 8, 0)))  # scanned, nobody listens
+    assert wait_until(lambda: publisher.stats()['pending'] == 0)
+
+    subscriber = UnixSocketSubscriber(str(tmp_path))
+    try:
+        events = [CacheEvent('F', 'pp', datetime(2021, 1, 1, 8, minute)) for minute in range(1, 6)]
+        for event in events:
+            publisher.publish(event)
+        received = []
+        assert wait_until(lambda: received.extend(subscriber.receive(timeout=0.2)) or len(received) == 5)
+        assert received == events
+        assert subscriber.take_lost() == 1  # a new source, what it sent before is unknown
+    finally:
+        subscriber.close()
+
+
+def test_local_subscriber_counts_its_first_event_as_a_loss():
+    bus = LocalBus()
+    subscriber = bus.subscribe()
+    event = CacheEvent('F', 'pp', datetime(2021, 1, 1, 8, 0))
+    bus.publish(event)
+    bus.publish(event)
+    assert subscriber.receive(timeout=1) == [event, event]
+    assert subscriber.take_lost() == 1
+    bus.publish(event)
+    assert subscriber.receive(timeout=1) == [event]
+    assert subscriber.take_lost() == 0
@@ -0,0 +1,91 @@
+""" The chat notifier posting to a local stub of mirai-api-http and the Telegram bot API."""
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from chat_notifier import ChatNotifier, MESSAGE_LIMIT, split_digest
+from conftest import StubHandler, wait_until
+
+QQ, TG = ('qq', 1), ('tg', '@channel')
+
+
+class ChatServer(StubHandler):
+    """ Answer mirai on POST and Telegram on GET, keep the texts posted per channel. The posts fail
+        while the server is `failing`.
+    """
+    def answer(self, body: dict, status: int = 200):
+        super().answer(json.dumps(body).encode(), status)
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        if self.server.failing:
+            return self.answer({'ok': False, 'description': 'Bad Request: chat not found'}, 400)
+        self.server.texts[('tg', query['chat_id'][0])].append(query['text'][0])
+        self.answer({'ok': True})
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/auth':
+            return self.answer({'code': 0, 'session': 'key'})
+        if self.path == '/sendGroupMessage':
+            if self.server.failing:
+                return self.answer({'code': 10, 'msg': 'no permission'})
+            self.server.texts[('qq', data['target'])].append(data['messageChain'][0]['text'])
+        self.answer({'code': 0, 'msg': 'success'})
+
+
+@pytest.fixture
+def server(stub_server):
+    return stub_server(ChatServer, texts={QQ: [], TG: []}, failing=False)
+
+
+@pytest.fixture
+def notifier(server):
+    notifier = ChatNotifier(
+        {'mirai_base_uri': server.base_uri, 'mirai_auth_key': 'auth', 'qq_num': 1},
+        {'tg_bot_token': 'token', 'proxy': None},
+        footer='footer',
+        window=0.05,
+        telegram_base_uri=server.base_uri,
+    )
+    yield notifier
+    notifier.close()
+
+
+def test_change_back_to_its_prev_is_dropped(server, notifier):
+    notifier.notify([QQ, TG], 'bj', 'F bj', '2021/1/1', '2021/2/1')
+    notifier.notify([QQ, TG], 'bj', 'F bj', '2021/2/1', '2021/1/1')
+    assert notifier.stats()['pending_cnt'] == 0
+
+    notifier.notify([QQ, TG], 'sh', 'F sh', '2021/1/1', '2021/3/1')
+    notifier.notify([QQ, TG], 'sh', 'F sh', '2021/3/1', '2021/4/1')
+    assert wait_until(lambda: notifier.digest_cnt == 2)
+    assert server.texts == {QQ: ['F sh: 2021/1/1 -> 2021/4/1\nfooter'], TG: ['F sh: 2021/1/1 -> 2021/4/1']}
+
+
+def test_long_digest_is_split(server, notifier):
+    notifier.window = 1  # all the changes in one window
+    lines = [f'F embassy {i:04d}: 2021/1/1 -> 2021/2/1' for i in range(400)]
+    for i, line in enumerate(lines):
+        label, change = line.split(': ')
+        notifier.notify([QQ, TG], i, label, *change.split(' -> '))
+    assert wait_until(lambda: notifier.digest_cnt == 2)
+
+    assert len(server.texts[TG]) > 1
+    assert all(len(text) <= MESSAGE_LIMIT for texts in server.texts.values() for text in texts)
+    assert all(text.endswith('\nfooter') for text in server.texts[QQ])
+    assert '\n'.join(server.texts[TG]).split('\n') == lines
+
+
+def test_rejected_posts_are_counted_as_failed(server, notifier):
+    server.failing = True
+    notifier.notify([QQ, TG], 'bj', 'F bj', '2021/1/1', '2021/2/1')
+    assert wait_until(lambda: notifier.failed_cnt == 2)
+    assert notifier.digest_cnt == 0
+
+
+def test_split_digest():
+    assert split_digest([], 10) == []
+    assert split_digest(['abc', 'def', 'ghi'], 7) == ['abc\ndef', 'ghi']
+    assert split_digest(['abcdefghijkl', 'x'], 5) == ['abcde', 'x']
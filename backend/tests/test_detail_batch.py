@@ -0,0 +1,68 @@
+""" The detail computed on NumPy arrays against the reference, on random batches."""
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import turning_points
+
+TIMESTAMP = datetime(2021, 1, 2, 12, 30, 59)
+
+
+def random_past24h(rng: random.Random, tzinfo=None, size=None):
+    """ A result of `VisaStatus.find_visa_status_past24h`: at most one fetch per minute, at whole
+        seconds, with late fetches, outages and date changes.
+    """
+    ts_start = TIMESTAMP - timedelta(days=1)
+    write_time, available_date = ts_start, datetime(2021, 2, 1)
+    available_dates = []
+    while size is None or len(available_dates) < size:
+        dice = rng.random()
+        if dice < 0.02:
+            write_time += timedelta(minutes=rng.randint(3, 90))
+        else:
+            write_time += timedelta(seconds=rng.randint(60, 300))
+        if write_time > TIMESTAMP:
+            break
+        if rng.random() < 0.1:
+            available_date += timedelta(days=rng.choice([-3, -1, 1, 2]))
+        available_dates.append({'write_time': write_time.replace(tzinfo=tzinfo), 'available_date': available_date})
+
+    return {
+        'visa_type': rng.choice('BFHOL'),
+        'embassy_code': rng.choice(['bj', 'sh', 'gz', 'sy', 'hk']),
+        'time_range': [ts_start.replace(tzinfo=tzinfo), TIMESTAMP.replace(tzinfo=tzinfo)],
+        'available_dates': available_dates,
+    }
+
+
+def check_batch(batch, gap_ms):
+    assert turning_points.to_turning_points_batch(batch, gap_ms) == \
+        [turning_points.to_turning_points(vs, gap) for vs, gap in zip(batch, gap_ms)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_batch_matches_reference(seed):
+    rng = random.Random(seed)
+    tzinfo = rng.choice([None, timezone.utc, timezone(timedelta(hours=8))])
+    batch = [random_past24h(rng, tzinfo) for _ in range(rng.randint(1, 10))]
+    batch.insert(rng.randint(0, len(batch)), None)
+    check_batch(batch, [rng.choice([120, 180, 360]) * 1000 for _ in batch])
+
+
+def test_short_and_empty_series():
+    rng = random.Random(0)
+    batch = [
+        random_past24h(rng, size=1),
+        random_past24h(rng, size=0),
+        None,
+        random_past24h(rng, size=2),
+        random_past24h(rng),
+    ]
+    check_batch(batch, [180000] * len(batch))
+    assert turning_points.to_turning_points_batch(batch[1:3], [180000] * 2) == [None, None]
+
+
+def test_empty_batch():
+    assert turning_points.to_turning_points_batch([], []) == []
+    assert turning_points.to_turning_points_batch([None], [0]) == [None]
@@ -0,0 +1,72 @@
+""" The email outbox posting to a local stub relay."""
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import pytest
+
+from conftest import StubHandler, wait_until
+from email_outbox import EmailOutbox, FAILED, PENDING, SENDING
+
+mongomock = pytest.importorskip('mongomock')
+
+
+class Relay(StubHandler):
+    """ Answer 'success' to every post unless the server is `failing`, keep the posted forms."""
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.posts.append(form)
+        if self.server.failing:
+            return self.answer(b'error', 500)
+        self.answer(b'success')
+
+
+@pytest.fixture
+def relay(stub_server):
+    return stub_server(Relay, posts=[], failing=False)
+
+
+@pytest.fixture
+def outbox(relay):
+    outbox = EmailOutbox(
+        mongomock.MongoClient().db.email_outbox,
+        relay.base_uri + '/',
+        max_receivers=2,
+        rate=1000,
+        max_attempts=2,
+        backoff=(0.01, 0.01),
+        poll_interval=0.01,
+    )
+    yield outbox
+    outbox.close()
+
+
+def test_every_receiver_gets_the_email(relay, outbox):
+    receivers = [f'user{i}@example.com' for i in range(5)]
+    assert outbox.enqueue('title', 'content', receivers, 'from', 'to') == 3
+    outbox.start()
+
+    assert wait_until(lambda: outbox.depth() == {})
+    assert sorted(r for form in relay.posts for r in form['receivers'][0].split('@@@')) == receivers
+    assert all(form['title'] == ['title'] for form in relay.posts)
+    assert outbox.stats()['sent_cnt'] == 3
+
+
+def test_failed_post_is_retried_then_given_up(relay, outbox):
+    relay.failing = True
+    outbox.enqueue('title', 'content', ['user@example.com'], 'from', 'to')
+    outbox.start()
+
+    assert wait_until(lambda: outbox.depth() == {FAILED: 1})
+    assert len(relay.posts) == 2
+    assert outbox.stats()['retry_cnt'] == 1 and outbox.stats()['failed_cnt'] == 1
+    assert outbox.outbox.find_one()['last_error'].startswith('500')
+
+
+def test_dispatcher_outlives_a_malformed_message(relay, outbox):
+    outbox.outbox.insert_one({'state': PENDING, 'next_attempt_at': datetime.utcnow()})  # no relay nor title
+    outbox.start()
+    assert wait_until(lambda: outbox.depth() == {SENDING: 1})
+
+    outbox.enqueue('title', 'content', ['user@example.com'], 'from', 'to')
+    assert wait_until(lambda: len(relay.posts) == 1)
+    assert outbox.stats()['running'] and outbox.stats()['sent_cnt'] == 1
@@ -0,0 +1,60 @@
+""" Test that the runs of a job don't pile up in the worker pool of `Scheduler`."""
+import time
+import threading
+
+from scheduler import Job, Scheduler
+
+
+def test_run_is_skipped_while_the_previous_one_is_running():
+    release = threading.Event()
+    runs = []
+
+    def slow():
+        runs.append(time.monotonic())
+        release.wait(5)
+
+    scheduler = Scheduler(max_workers=1)
+    scheduler.add_job(Job('slow', slow, interval_sec=0.01))
+    scheduler.start()
+    try:
+        time.sleep(0.3)
+        assert len(runs) == 1
+        assert scheduler.executor._work_queue.qsize() == 0  # nothing waits for the busy worker
+        assert scheduler.stats()['skipped_cnt'] > 10
+        assert scheduler.stats()['in_flight_jobs'] == 1
+
+        release.set()
+        time.sleep(0.1)
+        assert len(runs) > 1  # back to its interval once the slow run is over
+    finally:
+        release.set()
+        scheduler.stop()
+        scheduler.dispatcher.join()
+
+
+def test_queued_run_is_not_submitted_twice():
+    release = threading.Event()
+    runs = {'blocker': 0, 'other': 0}
+
+    def blocker():
+        runs['blocker'] += 1
+        release.wait(5)
+
+    def other():
+        runs['other'] += 1
+
+    scheduler = Scheduler(max_workers=1)
+    scheduler.add_job(Job('blocker', blocker, interval_sec=60))
+    scheduler.add_job(Job('other', other, interval_sec=0.2), delay=0.05)
+    scheduler.start()
+    try:
+        time.sleep(0.5)  # `other` is due 3 times while it waits for the only worker
+        assert scheduler.executor._work_queue.qsize() == 1
+        assert scheduler.stats()['skipped_cnt'] >= 1
+        release.set()
+        time.sleep(0.05)
+        assert runs['other'] == 1  # the missed runs don't execute back to back
+    finally:
+        release.set()
+        scheduler.stop()
+        scheduler.dispatcher.join()
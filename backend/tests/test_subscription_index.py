@@ -0,0 +1,94 @@
+""" The subscription index against the semantics of the query of `Subscription.get_email_list`."""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from subscription_index import SubscriptionIndex
+
+PAIRS = [(visa_type, embassy_code) for visa_type in 'FB' for embassy_code in ('bj', 'sh', 'gz')]
+TILLS = [datetime(2021, 1, 1) + timedelta(days=d) for d in range(5)]  # few, so that they collide
+
+
+def query_email_list(documents, new_visa_status, inclusion):
+    """ What the `$elemMatch` query with the `subscription.$` projection returns: the first
+        subscription of the pair in every document, filtered by its `till` in Python.
+    """
+    email_list = {}
+    for visa_type, embassy_code, available_date in new_visa_status:
+        for document in documents:
+            matched = [
+                subs for subs in document['subscription']
+                if subs['visa_type'] == visa_type and subs['embassy_code'] == embassy_code
+            ]
+            if len(matched) == 0:
+                continue
+            till = matched[0]['till']
+            if (inclusion == 'both' or
+                    (inclusion == 'effective_only' and till >= available_date) or
+                    (inclusion == 'expired_only' and till < available_date)):
+                email_list.setdefault((visa_type, embassy_code), []).append(document['email'])
+    return email_list
+
+
+def random_subscription(rng: random.Random):
+    """ Subscriptions with some pairs subscribed twice, with another `till`."""
+    return [
+        {'visa_type': visa_type, 'embassy_code': embassy_code, 'till': rng.choice(TILLS)}
+        for visa_type, embassy_code in rng.choices(PAIRS, k=rng.randint(0, 4))
+    ]
+
+
+def check(index, documents):
+    new_visa_status = [(*pair, available_date) for pair in PAIRS for available_date in TILLS]  # at every `till`
+    for inclusion in ('both', 'effective_only', 'expired_only'):
+        expected = query_email_list(documents, new_visa_status, inclusion)
+        email_list = index.get_email_list(new_visa_status, inclusion)
+        assert {pair: sorted(emails) for pair, emails in email_list.items()} == \
+            {pair: sorted(emails) for pair, emails in expected.items()}, inclusion
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_rebuilt_index_matches_the_query(seed):
+    rng = random.Random(seed)
+    documents = [{'email': f'user{i}@example.com', 'subscription': random_subscription(rng)} for i in range(50)]
+    index = SubscriptionIndex()
+    index.rebuild(documents)
+    check(index, documents)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_updated_index_matches_the_query(seed):
+    rng = random.Random(seed)
+    documents = {f'user{i}@example.com': random_subscription(rng) for i in range(50)}
+    index = SubscriptionIndex()
+    index.rebuild([{'email': email, 'subscription': subscription} for email, subscription in documents.items()])
+
+    for _ in range(200):
+        email = f'user{rng.randrange(60)}@example.com'  # some are new
+        documents[email] = [] if rng.random() < 0.2 else random_subscription(rng)
+        index.update(email, documents[email])
+        if len(documents[email]) == 0:
+            del documents[email]
+    check(index, [{'email': email, 'subscription': subscription} for email, subscription in documents.items()])
+    assert index.stats()['subscriber_cnt'] == sum(1 for subscription in documents.values() if len(subscription) > 0)
+
+
+def test_till_boundary():
+    till = datetime(2021, 1, 3)
+    index = SubscriptionIndex()
+    index.rebuild([
+        {'email': 'a', 'subscription': [{'visa_type': 'F', 'embassy_code': 'bj', 'till': till}]},
+        {'email': 'b', 'subscription': [
+            {'visa_type': 'F', 'embassy_code': 'bj', 'till': till - timedelta(days=1)},
+            {'visa_type': 'F', 'embassy_code': 'bj', 'till': till + timedelta(days=1)},  # the first one counts
+        ]},
+    ])
+    status = [('F', 'bj', till)]
+    assert index.get_email_list(status, 'effective_only') == {('F', 'bj'): ['a']}  # `till` itself is effective
+    assert index.get_email_list(status, 'expired_only') == {('F', 'bj'): ['b']}
+    assert index.get_email_list(status, 'both') == {('F', 'bj'): ['b', 'a']}  # in `till` order
+
+    index.update('a', [])
+    assert index.get_email_list(status, 'effective_only') == {}
+    assert index.get_email_list([('F', 'sh', till)]) == {}
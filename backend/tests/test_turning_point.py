@@ -0,0 +1,136 @@
+""" The `'turning_point'` series against the reference detail, on random fetch series built in memory."""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import turning_points
+
+GAP_SECONDS = 180  # a fetch interval of 2 minutes with 1 minute of tolerance
+START = datetime(2021, 1, 1, 20, 0)  # the series spans two UTC midnights
+HOURS = 30
+
+
+def random_fetches(rng: random.Random):
+    """ Fetches at whole seconds with late fetches, bursts within a minute, outages and date changes."""
+    write_time, available_date = START, START + timedelta(days=30)
+    while write_time < START + timedelta(hours=HOURS):
+        dice = rng.random()
+        if dice < 0.02:
+            write_time += timedelta(minutes=rng.randint(3, 90))
+        elif dice < 0.15:
+            write_time += timedelta(seconds=rng.randint(0, 30))
+        else:
+            write_time += timedelta(seconds=rng.randint(60, 210))
+        if rng.random() < 0.1:
+            available_date += timedelta(days=rng.choice([-3, -1, 1, 2]))
+        yield {'write_time': write_time, 'available_date': available_date}
+
+
+def apply_update(doc: dict, update: dict) -> None:
+    """ Apply the `$bit` and `$push` of `turning_points.series_update` like MongoDB does."""
+    for field, op in update['$bit'].items():
+        word = field.split('.')[1]
+        doc['fetched'][word] = doc['fetched'].get(word, 0) | op['or']
+    if '$push' in update:
+        doc['points'].extend(update['$push']['points']['$each'])
+
+
+def build_series(fetches) -> dict:
+    """ The `'turning_point'` documents of the fetches, by date, as the fetcher writes them."""
+    docs, state = {}, None
+    for fetch in fetches:
+        minute = fetch['write_time'].replace(second=0)
+        state, points = turning_points.series_step(state, minute, fetch['available_date'], GAP_SECONDS)
+        minute = state[0]
+        date = minute.replace(hour=0, minute=0)
+        doc = docs.setdefault(date, {'date': date, 'fetched': {}, 'points': []})
+        apply_update(doc, turning_points.series_update(minute, points))
+    return docs
+
+
+def reference_detail(fetches, timestamp: datetime):
+    """ What `VisaStatus.find_visa_status_past24h_turning_point` returns: the earliest date of every
+        minute of the past 24 hours, turned into the detail by the reference implementation.
+    """
+    ts_start = timestamp - timedelta(days=1)
+    per_minute = {}
+    for fetch in fetches:
+        minute = fetch['write_time'].replace(second=0)
+        if minute in per_minute:
+            per_minute[minute]['available_date'] = min(per_minute[minute]['available_date'], fetch['available_date'])
+        else:
+            per_minute[minute] = dict(fetch)
+    available_dates = [fetch for fetch in per_minute.values() if ts_start <= fetch['write_time'] <= timestamp]
+    if len(available_dates) == 0:
+        return None
+
+    visa_status = {
+        'visa_type': 'F',
+        'embassy_code': 'bj',
+        'time_range': [ts_start, timestamp],
+        'available_dates': available_dates,
+    }
+    return turning_points.to_turning_points(visa_status, GAP_SECONDS * 1000)
+
+
+def series_detail(docs: dict, timestamp: datetime):
+    """ What `VisaStatus.find_turning_point_series_batch` returns, read from the documents in memory."""
+    to_minute = timestamp.replace(second=0, microsecond=0)
+    since_minute = to_minute - timedelta(minutes=1440)
+    since_date = since_minute.replace(hour=0, minute=0)
+    dates = [since_date + timedelta(days=d) for d in range((to_minute - since_date).days + 1)]
+    range_docs = [docs[date] for date in dates if date in docs]
+    return turning_points.series_to_turning_points('F', 'bj', range_docs, since_minute, to_minute, GAP_SECONDS)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_series_matches_reference(seed):
+    rng = random.Random(seed)
+    fetches = list(random_fetches(rng))
+    docs = build_series(fetches)
+
+    minutes = [START + timedelta(minutes=rng.randint(0, (HOURS + 1) * 60)) for _ in range(30)]
+    midnight = START.replace(hour=0) + timedelta(days=1)
+    minutes += [midnight + timedelta(minutes=delta) for delta in (-1, 0, 1)]  # the day boundary
+    minutes += [midnight + timedelta(days=1, minutes=delta) for delta in (-1, 0, 1)]
+    for minute in minutes:
+        timestamp = minute + timedelta(seconds=59, microseconds=999000)  # the last instant of the minute
+        assert series_detail(docs, timestamp) == reference_detail(fetches, timestamp), timestamp
+
+
+def test_gaps_and_date_changes():
+    date_a, date_b = datetime(2021, 3, 1), datetime(2021, 2, 1)
+    fetches = [
+        {'write_time': datetime(2021, 1, 1, 23, 56, 10), 'available_date': date_a},
+        {'write_time': datetime(2021, 1, 1, 23, 58, 5), 'available_date': date_a},
+        {'write_time': datetime(2021, 1, 1, 23, 58, 40), 'available_date': date_b},  # earlier date in the minute
+        {'write_time': datetime(2021, 1, 2, 0, 0, 30), 'available_date': date_b},  # across midnight
+        {'write_time': datetime(2021, 1, 2, 0, 30, 0), 'available_date': date_a},  # after a gap
+        {'write_time': datetime(2021, 1, 2, 0, 32, 0), 'available_date': date_a},
+    ]
+    docs = build_series(fetches)
+    assert sorted(docs) == [datetime(2021, 1, 1), datetime(2021, 1, 2)]
+
+    timestamp = datetime(2021, 1, 2, 1, 0, 59, 999000)  # the series ends in a gap
+    detail = series_detail(docs, timestamp)
+    assert detail == reference_detail(fetches, timestamp)
+    assert [point['available_date'] for point in detail['available_dates']] == \
+        [None, date_a, date_b, None, date_a, None]
+
+
+def test_no_fetch_in_range():
+    fetches = [{'write_time': datetime(2021, 1, 1, 12, 0, 0), 'available_date': datetime(2021, 3, 1)}]
+    docs = build_series(fetches)
+    timestamp = datetime(2021, 1, 3, 12, 0, 59, 999000)
+    assert series_detail(docs, timestamp) is None
+    assert reference_detail(fetches, timestamp) is None
+
+
+def test_lone_fetch_in_range():
+    fetches = [{'write_time': datetime(2021, 1, 1, 12, 0, 0), 'available_date': datetime(2021, 3, 1)}]
+    docs = build_series(fetches)
+    timestamp = datetime(2021, 1, 1, 12, 1, 59, 999000)
+    detail = series_detail(docs, timestamp)
+    assert detail == reference_detail(fetches, timestamp)
+    assert [point['available_date'] for point in detail['available_dates']] == [None]
@@ -0,0 +1,102 @@
+""" Test the flush of `WriteBehindQueue` when MongoDB rejects an operation or can't be reached."""
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from write_behind import WriteBehindQueue
+
+
+class FakeCollection:
+    """ Record the written operations, reject the ones in `rejected` like an ordered `bulk_write`."""
+    def __init__(self, rejected=(), unreachable=0):
+        self.written = []
+        self.rejected = set(rejected)
+        self.unreachable = unreachable  # number of bulk writes failing before any operation is written
+
+    def bulk_write(self, ops, ordered=True):
+        if self.unreachable > 0:
+            self.unreachable -= 1
+            raise AutoReconnect('unreachable')
+        for idx, op in enumerate(ops):
+            if op in self.rejected:
+                self.rejected.discard(op)
+                raise BulkWriteError({'writeErrors': [{'index': idx, 'code': 11000, 'errmsg': 'duplicate key'}]})
+            self.written.append(op)
+
+
+def make_queue(coll):
+    return WriteBehindQueue(lambda collection_name: coll)
+
+
+def test_flush_writes_in_order_and_calls_back():
+    coll = FakeCollection()
+    queue = make_queue(coll)
+    called = []
+    for op in range(5):
+        queue.put('visa_status', op, tag=op)
+    queue.call_after_flush(lambda: called.append('done'), tag=0)
+    queue.flush()
+    assert coll.written == [0, 1, 2, 3, 4]
+    assert called == ['done']
+    assert queue.depth == 0
+
+
+def test_rejected_op_requeues_the_rest_of_the_batch():
+    coll = FakeCollection(rejected=['b'])
+    queue = make_queue(coll)
+    called = []
+    for op, tag in [('a', 'F-pp'), ('b', 'F-pp'), ('c', 'B-bj'), ('d', 'B-bj')]:
+        queue.put('visa_status', op, tag=tag)
+    queue.call_after_flush(lambda: called.append('F-pp'), tag='F-pp')
+    queue.call_after_flush(lambda: called.append('B-bj'), tag='B-bj')
+    queue.call_after_flush(lambda: called.append('untagged'))
+
+    queue.flush()
+    assert coll.written == ['a']
+    assert queue.depth == 2  # 'c' and 'd' wait for the next flush
+    assert called == []
+
+    queue.put('visa_status', 'e', tag='B-bj')
+    queue.flush()
+    assert coll.written == ['a', 'c', 'd', 'e']
+    assert called == ['B-bj', 'untagged']  # the write of 'b' never happened
+    assert queue.stats()['failed_cnt'] == 1
+    assert queue.stats()['written_cnt'] == 4
+
+
+def test_rejected_last_op_calls_back_the_other_tags():
+    coll = FakeCollection(rejected=['b'])
+    queue = make_queue(coll)
+    called = []
+    queue.put('visa_status', 'a', tag='B-bj')
+    queue.put('visa_status', 'b', tag='F-pp')
+    queue.call_after_flush(lambda: called.append('B-bj'), tag='B-bj')
+    queue.call_after_flush(lambda: called.append('F-pp'), tag='F-pp')
+    queue.flush()
+    assert coll.written == ['a']
+    assert queue.depth == 0
+    assert called == ['B-bj']
+
+
+def test_unreachable_server_keeps_the_batch_ahead():
+    coll = FakeCollection(unreachable=1)
+    queue = make_queue(coll)
+    called = []
+    queue.put('visa_status', 'a')
+    queue.call_after_flush(lambda: called.append('a'))
+    queue.flush()
+    assert coll.written == [] and called == []
+
+    queue.put('visa_status', 'b')
+    queue.flush()
+    assert coll.written == ['a', 'b']
+    assert called == ['a']
+
+
+def test_coalesced_op_keeps_its_position():
+    coll = FakeCollection()
+    queue = make_queue(coll)
+    queue.put('latest_written', 'F-pp 1', coalesce_key='F-pp')
+    queue.put('latest_written', 'B-bj 1', coalesce_key='B-bj')
+    queue.put('latest_written', 'F-pp 2', coalesce_key='F-pp')
+    queue.flush()
+    assert coll.written == ['F-pp 2', 'B-bj 1']
+    assert queue.stats()['coalesced_cnt'] == 1
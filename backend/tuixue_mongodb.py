@@ -6,14 +6,20 @@ import os
 import util
 import pymongo
 import logging
-from util import dt_to_utc, init_logger
+import indexes
+import turning_points
+from threading import Lock
+from util import init_logger
 from collections import defaultdict, namedtuple
 from tuixue_typing import VisaType, EmbassyCode
-from datetime import datetime, timedelta, timezone
-from typing import Union, List, Tuple, Optional, Dict
-from global_var import USEmbassy, VISA_TYPES, MONGO_CONFIG
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Union, List, Tuple, Optional, Dict, Iterable
+from global_var import USEmbassy, VISA_TYPES, MONGO_CONFIG, VISA_STATUS_STORAGE, VISA_STATUS_BUCKET_MINUTES
+from global_var import OVERVIEW_STORAGE, DETAIL_SOURCE
 from global_var import AIS_FETCH_TIME_INTERVAL, CGI_FETCH_TIME_INTERVAL
-from pymongo import database, collection, monitoring, event_loggers
+from pymongo import database, collection, monitoring, event_loggers, ReplaceOne, UpdateOne
+from write_behind import WriteBehindQueue, WriteOp
+from subscription_index import SubscriptionIndex
 
 EmailSubscription = NewVisaStatus = Tuple[VisaType, EmbassyCode, datetime]
 EmailSubscriptionNoDate = NewVisaStatusNoDate = Tuple[VisaType, EmbassyCode]  # seeking for a better name...
@@ -21,6 +27,8 @@ EmailSubscriptionNoDate = NewVisaStatusNoDate = Tuple[VisaType, EmbassyCode]  #
 MONGO_CLIENT = None
 DATABASE = None
 
+TURNING_POINT_WORD_BITS = turning_points.WORD_BITS  # minutes per word of the `'turning_point'` bitmaps
+
 ServerStatus = namedtuple(
     'ServerStatus',
     [
@@ -120,6 +128,27 @@ class VisaStatus:
         }
         ```
 
+        When `VISA_STATUS_STORAGE` is `'bucket'`, the successfully fetched visa status is stored in
+        Mongo collection `'visa_status_bucket'` instead, one document per `VISA_STATUS_BUCKET_MINUTES`
+        of UTC time. `available_dates` of a bucket is kept in `write_time` order on write so that a
+        range read only needs to concatenate the buckets in `bucket_start` order. The schema is:
+
+        ```python
+        {
+            'visa_type': str,
+            'embassy_code': str,
+            'bucket_start': datetime,
+            'first_write_time': datetime,
+            'last_write_time': datetime,
+            'earliest_date': datetime,
+            'latest_date': datetime,
+            'count': int,
+            'available_dates': [
+                {'write_time': datetime, 'available_date': datetime},
+            ]
+        }
+        ```
+
         The schema of documents for `'overview'` is as follow:
 
         ```python
@@ -132,6 +161,39 @@ class VisaStatus:
         }
         ```
 
+        When `OVERVIEW_STORAGE` is `'daily'`, the overview is stored in Mongo collection `'overview_daily'`
+        instead, one document per embassy-local `write_date` with a unique index on
+        `(visa_type, embassy_code, write_date)`. The schema is:
+
+        ```python
+        {
+            'visa_type': str,
+            'embassy_code': str,
+            'write_date': datetime,
+            'earliest_date': datetime,
+            'latest_date': datetime,
+        }
+        ```
+
+        The detail of the past 24 hours is read from Mongo collection `'turning_point'` when
+        `DETAIL_SOURCE` is `'turning_point'`. It's maintained on write, one document per UTC `date`:
+        `fetched` is a bitmap of the minutes of the date with a successful fetch, `TURNING_POINT_WORD_BITS`
+        minutes per word keyed by the word index, and `points` the changes of the per-minute earliest
+        available date and the gaps (`available_date` is None) in `write_time` order, see
+        `cls.turning_point_step`. The schema is:
+
+        ```python
+        {
+            'visa_type': str,
+            'embassy_code': str,
+            'date': datetime,
+            'fetched': {'0': int, '1': int},
+            'points': [
+                {'write_time': datetime, 'available_date': Optional[datetime]},
+            ]
+        }
+        ```
+
         The schema of documents for `'latest_written'` is as follow:
 
         ```python
@@ -144,8 +206,115 @@ class VisaStatus:
         ```
     """
     visa_status = get_collection('visa_status')
+    visa_status_bucket = get_collection('visa_status_bucket')
     overview = get_collection('overview')
+    overview_daily = get_collection('overview_daily')
     latest_written = get_collection('latest_written')
+    turning_point = get_collection('turning_point')
+    storage = VISA_STATUS_STORAGE
+    overview_storage = OVERVIEW_STORAGE
+    detail_source = DETAIL_SOURCE
+    write_behind: Optional[WriteBehindQueue] = None
+    # (visa_type, embassy_code) -> latest_written document, single key assignment is atomic so no lock is needed
+    latest_written_table: Dict[NewVisaStatusNoDate, dict] = {}
+    # (visa_type, embassy_code) -> (minute, earliest available date) of the last successful fetch
+    turning_point_state: Dict[NewVisaStatusNoDate, Tuple[datetime, datetime]] = {}
+    turning_point_lock = Lock()
+
+    @staticmethod
+    def get_bucket_start(write_time_utc: datetime) -> datetime:
+        """ Return the start of the time bucket a UTC write time falls in."""
+        minute_of_day = write_time_utc.hour * 60 + write_time_utc.minute
+        bucket_minute = minute_of_day - minute_of_day % VISA_STATUS_BUCKET_MINUTES
+        return write_time_utc.replace(hour=bucket_minute // 60, minute=bucket_minute % 60, second=0, microsecond=0)
+
+    @classmethod
+    def bucketize(cls, visa_type: VisaType, embassy_code: EmbassyCode, available_dates: List[dict]) -> List[dict]:
+        """ Group fetch results `{'write_time': datetime, 'available_date': datetime}` of one
+            `(visa_type, embassy_code)` pair into `'visa_status_bucket'` documents.
+        """
+        buckets = {}
+        for fetch in sorted(available_dates, key=lambda adt: adt['write_time']):
+            bucket_start = cls.get_bucket_start(fetch['write_time'])
+            if bucket_start not in buckets:
+                buckets[bucket_start] = {
+                    'visa_type': visa_type,
+                    'embassy_code': embassy_code,
+                    'bucket_start': bucket_start,
+                    'first_write_time': fetch['write_time'],
+                    'earliest_date': fetch['available_date'],
+                    'latest_date': fetch['available_date'],
+                    'count': 0,
+                    'available_dates': [],
+                }
+            bucket = buckets[bucket_start]
+            bucket['last_write_time'] = fetch['write_time']
+            bucket['earliest_date'] = min(bucket['earliest_date'], fetch['available_date'])
+            bucket['latest_date'] = max(bucket['latest_date'], fetch['available_date'])
+            bucket['count'] += 1
+            bucket['available_dates'].append(fetch)
+
+        return list(buckets.values())
+
+    @classmethod
+    def find_fetched_visa_status(
+        cls,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        since_utc: datetime,
+        to_utc: datetime,
+    ) -> Optional[List[dict]]:
+        """ Return the fetch results of `[since_utc, to_utc)` in `write_time` order from
+            `'visa_status_bucket'`, or None if there is no bucket in the range. Only the buckets
+            overlapping the range are read and nothing is sorted but the index.
+        """
+        cursor = cls.visa_status_bucket.find(
+            {
+                'visa_type': visa_type,
+                'embassy_code': embassy_code,
+                'bucket_start': {'$gte': cls.get_bucket_start(since_utc), '$lt': to_utc},
+            },
+            projection={'_id': False, 'available_dates': True},
+            sort=[('bucket_start', pymongo.ASCENDING)],
+        )
+
+        available_dates = None
+        for bucket in cursor:
+            if available_dates is None:
+                available_dates = []
+            available_dates.extend(bucket['available_dates'])
+
+        return available_dates
+
+    @classmethod
+    def migrate_to_bucket(cls) -> None:
+        """ Rewrite the `'visa_status'` collection into `'visa_status_bucket'`. The daily
+            documents are streamed one by one, a bucket never spans two UTC dates so every
+            daily document can be converted on its own.
+        """
+        if 24 * 60 % VISA_STATUS_BUCKET_MINUTES != 0:
+            raise ValueError(f'VISA_STATUS_BUCKET_MINUTES must divide a day, get {VISA_STATUS_BUCKET_MINUTES}')
+
+        cls.visa_status_bucket.drop()
+        indexes.ensure_indexes({'visa_status_bucket': cls.visa_status_bucket})
+
+        migrated = 0
+        for daily in cls.visa_status.find({}, projection={'_id': False}, no_cursor_timeout=True, batch_size=64):
+            buckets = cls.bucketize(daily['visa_type'], daily['embassy_code'], daily['available_dates'])
+            if len(buckets) > 0:
+                cls.visa_status_bucket.insert_many(buckets, ordered=False)
+
+            migrated += len(daily['available_dates'])
+            print(
+                'Migrated: {}-{}-{}\t{} records in total'.format(
+                    daily['visa_type'],
+                    daily['embassy_code'],
+                    daily['write_date'].strftime('%Y/%m/%d'),
+                    migrated,
+                ),
+                end='\r'
+            )
+        print()
 
     @classmethod
     def restore_overview(cls) -> None:
@@ -153,6 +322,8 @@ class VisaStatus:
             `tuixue.visa_status` collection is restored.
         """
         cls.drop('overview')
+        if cls.overview_storage == 'daily':
+            cls.create_overview_daily_index()
         embassy_lst = USEmbassy.get_embassy_lst()
 
         for visa_type in VISA_TYPES:
@@ -160,7 +331,8 @@ class VisaStatus:
                 print()
                 avai_dt_cache = defaultdict(list)
 
-                all_avai_dt = cls.visa_status.aggregate([
+                fetched = cls.visa_status_bucket if cls.storage == 'bucket' else cls.visa_status
+                all_avai_dt = fetched.aggregate([
                     {'$match': {'visa_type': visa_type, 'embassy_code': emb.code}},
                     {'$unwind': '$available_dates'},
                     {
@@ -184,19 +356,7 @@ class VisaStatus:
                 for write_date, avai_dt_arr in avai_dt_cache.items():
                     if len(avai_dt_arr) > 0:
                         earliest_dt, latest_dt = min(avai_dt_arr), max(avai_dt_arr)
-                        cls.overview.update_one(
-                            {'visa_type': visa_type, 'embassy_code': emb.code},
-                            {
-                                '$push': {
-                                    'overview': {
-                                        'write_date': write_date,
-                                        'earliest_date': earliest_dt,
-                                        'latest_date': latest_dt,
-                                    }
-                                }
-                            },
-                            upsert=True,
-                        )
+                        cls.write_ops(cls.overview_ops(visa_type, emb.code, write_date, earliest_dt, latest_dt))
                         print(
                             'Update tuixue.overview: {}\t{}\t\t\t{}'.format(
                                 visa_type,
@@ -257,7 +417,7 @@ class VisaStatus:
 
     @classmethod
     def initiate_latest_written_sequential(cls, sys: str, backtrack_hr: int = 12) -> None:
-        """ Initate latest_written in sequentail order."""
+        """ Initate latest_written in sequentail order. And load it into `cls.latest_written_table`."""
         embassy_code_lst = [emb.code for emb in USEmbassy.get_embassy_lst() if emb.sys == sys]
 
         now = datetime.now()
@@ -265,6 +425,29 @@ class VisaStatus:
         end = datetime.combine(now.date(), datetime.min.time())
         dates = [start + timedelta(days=d) for d in range((end - start).days + 1)]
 
+        if cls.storage == 'bucket':
+            last_effective_fetch = cls.visa_status_bucket.aggregate([
+                {'$match': {'bucket_start': {'$gte': start}}},
+                {'$sort': {'bucket_start': pymongo.DESCENDING}},
+                {
+                    '$group': {
+                        '_id': {'visa_type': '$visa_type', 'embassy_code': '$embassy_code'},
+                        'available_date': {'$first': {'$arrayElemAt': ['$available_dates.available_date', -1]}},
+                    },
+                },
+            ], allowDiskUse=True)
+
+            for fetch in last_effective_fetch:
+                if fetch['_id']['embassy_code'] not in embassy_code_lst:
+                    continue
+                cls.latest_written.update_one(
+                    fetch['_id'],
+                    {'$set': {'write_time': datetime.now(timezone.utc), 'available_date': fetch['available_date']}},
+                    upsert=True,
+                )
+            cls.load_latest_written_table(sys)
+            return
+
         query_param = cls.visa_status.aggregate([
             {'$match': {'write_date': {'$in': dates}}},
             {
@@ -296,6 +479,20 @@ class VisaStatus:
             for last_effective_fetch in cursor:
                 cls.latest_written.update_one(query, {'$set': last_effective_fetch}, upsert=True)
 
+        cls.load_latest_written_table(sys)
+
+    @classmethod
+    def load_latest_written_table(cls, sys: Optional[str] = None) -> None:
+        """ Load the `'latest_written'` collection of a system (or all of them) into
+            `cls.latest_written_table`, which is then kept up to date by `cls.save_fetched_visa_status`.
+        """
+        match = {}
+        if sys is not None:
+            match['embassy_code'] = {'$in': [emb.code for emb in USEmbassy.get_embassy_lst() if emb.sys == sys]}
+
+        for latest_written in cls.latest_written.find(match, projection={'_id': False}):
+            cls.latest_written_table[(latest_written['visa_type'], latest_written['embassy_code'])] = latest_written
+
     @classmethod
     def initiate_collections_tz(cls, since: datetime) -> None:
         """ Initiate the database with following handling of datetime object regarding timezone.
@@ -321,6 +518,8 @@ class VisaStatus:
 
         cls.drop()
         cls.visa_status.create_index([('write_date', pymongo.ASCENDING)])
+        if cls.overview_storage == 'daily':
+            cls.create_overview_daily_index()
 
         for vt in VISA_TYPES:
             for emb in embassy_lst:
@@ -329,14 +528,14 @@ class VisaStatus:
                 avai_dt_cache_utc = defaultdict(list)
                 avai_dt_cache_emb = defaultdict(list)
 
-                for date in date_range:
-                    file_path = util.construct_data_file_path(vt, emb.location, date.strftime('%Y/%m/%d'))
+                for day in date_range:
+                    file_path = util.construct_data_file_path(vt, emb.location, day.strftime('%Y/%m/%d'))
                     if not os.path.exists(file_path):
                         continue
 
                     with open(file_path) as f:
                         available_dates_arr = [
-                            {'write_time': datetime.combine(date.date(), wt), 'available_date': avai_dt}
+                            {'write_time': datetime.combine(day.date(), wt), 'available_date': avai_dt}
                             for wt, avai_dt in [util.file_line_to_dt(ln) for ln in f.readlines()]
                         ]
 
@@ -355,7 +554,7 @@ class VisaStatus:
                         avai_dt_cache_emb[write_date_emb].append(available_date)
 
                         print(' ' * 150, end='\r')  # erase previous print
-                        print('Reading: {}-{}-{}'.format(vt, emb.location, date.strftime('%Y/%m/%d')), end='\t\t')
+                        print('Reading: {}-{}-{}'.format(vt, emb.location, day.strftime('%Y/%m/%d')), end='\t\t')
                         print(
                             'UTC\t{}: {}'.format(
                                 write_date_utc.strftime('%Y/%m/%d'),
@@ -393,19 +592,7 @@ class VisaStatus:
                 for write_date, avai_dt_arr in avai_dt_cache_emb.items():
                     if len(avai_dt_arr) > 0:
                         earliest_dt, latest_dt = min(avai_dt_arr), max(avai_dt_arr)
-                        cls.overview.update_one(
-                            {'visa_type': vt, 'embassy_code': emb.code},
-                            {
-                                '$push': {
-                                    'overview': {
-                                        'write_date': write_date,
-                                        'earliest_date': earliest_dt,
-                                        'latest_date': latest_dt,
-                                    }
-                                }
-                            },
-                            upsert=True,
-                        )
+                        cls.write_ops(cls.overview_ops(vt, emb.code, write_date, earliest_dt, latest_dt))
 
     @classmethod
     def initiate_collections(cls, since: datetime) -> None:
@@ -418,20 +605,22 @@ class VisaStatus:
 
         cls.drop()
         cls.visa_status.create_index([('write_date', pymongo.ASCENDING)])
+        if cls.overview_storage == 'daily':
+            cls.create_overview_daily_index()
 
         for vt in VISA_TYPES:
             for emb in embassy_lst:
                 print()
                 accumulated_inserted = 0
-                for date in date_range:
-                    file_path = util.construct_data_file_path(vt, emb.location, date.strftime('%Y/%m/%d'))
+                for day in date_range:
+                    file_path = util.construct_data_file_path(vt, emb.location, day.strftime('%Y/%m/%d'))
                     if not os.path.exists(file_path):
                         continue
 
                     with open(file_path) as f:
                         fetched_result_lst = [util.file_line_to_dt(ln) for ln in f.readlines()]
                         available_dates_arr = [
-                            {'write_time': datetime.combine(date.date(), wt), 'available_date': avai_dt}
+                            {'write_time': datetime.combine(day.date(), wt), 'available_date': avai_dt}
                             for wt, avai_dt in fetched_result_lst
                         ]
 
@@ -439,7 +628,7 @@ class VisaStatus:
                         {
                             'visa_type': vt,
                             'embassy_code': emb.code,
-                            'write_date': date,
+                            'write_date': day,
                             'available_dates': available_dates_arr
                         }
                     )
@@ -447,23 +636,11 @@ class VisaStatus:
                     if len(available_dates_arr) > 0:
                         earliest_dt = min([d['available_date'] for d in available_dates_arr])
                         latest_dt = max([d['available_date'] for d in available_dates_arr])
-                        cls.overview.update_one(
-                            {'visa_type': vt, 'embassy_code': emb.code},
-                            {
-                                '$push': {
-                                    'overview': {
-                                        'write_date': date,
-                                        'earliest_date': earliest_dt,
-                                        'latest_date': latest_dt,
-                                    }
-                                }
-                            },
-                            upsert=True,
-                        )
+                        cls.write_ops(cls.overview_ops(vt, emb.code, day, earliest_dt, latest_dt))
 
                     accumulated_inserted += len(available_dates_arr)
                     print(
-                        f'Inserted: {vt}-{emb.location}-{date.year}/{date.month}/{date.day}\
+                        f'Inserted: {vt}-{emb.location}-{day.year}/{day.month}/{day.day}\
                             \t\t{len(available_dates_arr)}\trecords |\t{accumulated_inserted} in total',
                         end='\r'
                     )
@@ -482,60 +659,242 @@ class VisaStatus:
         if collection in ('latest_written', 'all'):
             cls.latest_written.drop()
         if collection in ('overview', 'all'):
-            cls.overview.drop()
+            (cls.overview_daily if cls.overview_storage == 'daily' else cls.overview).drop()
 
     @classmethod
-    def save_fetched_visa_status(
+    def fetched_visa_status_ops(
         cls,
         visa_type: VisaType,
         embassy_code: EmbassyCode,
         write_time: datetime,
         available_date: Optional[datetime],
-    ) -> None:
-        """ The method called when a new fetched result is obtained from crawler backend. The
-            `'latest_written'` collection will always be modified, whereas the `'available_dates'`
-            collection will only be modified when available date is not None
+    ) -> List[WriteOp]:
+        """ Return the write operations of a new fetched result as `(collection_name, operation, coalesce_key)`
+            tuples. Operations of the same collection must be executed in order. The ones with a
+            `coalesce_key` are overwritten by a later operation of the same key when they are queued.
+
+            None of them needs a read, see `cls.overview_ops` for the overview.
         """
-        embassy = USEmbassy.get_embassy_by_code(embassy_code)
         write_time_utc = write_time.astimezone(tz=None).astimezone(tz=timezone.utc)
         write_date_utc = write_time_utc.replace(hour=0, minute=0, second=0, microsecond=0)
-        write_date_emb = write_time_utc.astimezone(embassy.timezone)\
-            .replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        write_date_emb = cls.embassy_write_date(embassy_code, write_time_utc)
 
         query = {'visa_type': visa_type, 'embassy_code': embassy_code}
         visa_status_query = {**query, 'write_date': write_date_utc}
-        overview_query = {**query, 'overview.write_date': write_date_emb}
 
         new_fetch = {'write_time': write_time_utc, 'available_date': available_date}
 
         # udpate document if exists, otherwise insert a new document
-        cls.latest_written.update_one(query, {'$set': new_fetch}, upsert=True)
+        ops = [('latest_written', UpdateOne(query, {'$set': new_fetch}, upsert=True), (visa_type, embassy_code))]
 
-        if available_date is not None:
-            cls.visa_status.update_one(visa_status_query, {'$push': {'available_dates': new_fetch}}, upsert=True)
+        if available_date is None:
+            return ops
 
-            if cls.overview.find_one(overview_query) is None:  # $(update) of array can't work with upsert
-                cls.overview.update_one(
-                    query,
-                    {
-                        '$push': {
-                            'overview': {
-                                'write_date': write_date_emb,
-                                'earliest_date': available_date,
-                                'latest_date': available_date
-                            }
+        if cls.storage == 'bucket':
+            ops.append(('visa_status_bucket', UpdateOne(
+                {**query, 'bucket_start': cls.get_bucket_start(write_time_utc)},
+                {
+                    '$push': {'available_dates': {'$each': [new_fetch], '$sort': {'write_time': pymongo.ASCENDING}}},
+                    '$min': {'first_write_time': write_time_utc, 'earliest_date': available_date},
+                    '$max': {'last_write_time': write_time_utc, 'latest_date': available_date},
+                    '$inc': {'count': 1},
+                },
+                upsert=True,
+            ), None))
+        else:
+            ops.append((
+                'visa_status',
+                UpdateOne(visa_status_query, {'$push': {'available_dates': new_fetch}}, upsert=True),
+                None,
+            ))
+
+        ops.extend(cls.overview_ops(visa_type, embassy_code, write_date_emb, available_date, available_date))
+        return ops
+
+    @staticmethod
+    def embassy_write_date(embassy_code: EmbassyCode, write_time: datetime) -> datetime:
+        """ Return the embassy-local date (naive) of a write time, the `write_date` of the overview.
+            A naive `write_time` is in UTC.
+        """
+        if write_time.tzinfo is None:
+            write_time = write_time.replace(tzinfo=timezone.utc)
+        embassy = USEmbassy.get_embassy_by_code(embassy_code)
+        return write_time.astimezone(embassy.timezone).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+    @classmethod
+    def overview_ops(
+        cls,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        write_date_emb: datetime,
+        earliest_date: datetime,
+        latest_date: datetime,
+        storage: Optional[str] = None,
+    ) -> List[WriteOp]:
+        """ Return the write operations merging `earliest_date` and `latest_date` into the overview
+            of an embassy-local write date, for the `storage` layout (`cls.overview_storage` by default).
+
+            The `'daily'` layout takes a single `$min`/`$max` upsert. The `'array'` layout pushes the
+            entry of the day only when it's missing and then `$min`/`$max`-es it, since `$(update)` of
+            array can't work with upsert.
+        """
+        query = {'visa_type': visa_type, 'embassy_code': embassy_code}
+        if (storage or cls.overview_storage) == 'daily':
+            return [('overview_daily', UpdateOne(
+                {**query, 'write_date': write_date_emb},
+                {'$min': {'earliest_date': earliest_date}, '$max': {'latest_date': latest_date}},
+                upsert=True,
+            ), None)]
+
+        return [
+            ('overview', UpdateOne(query, {'$setOnInsert': {'overview': []}}, upsert=True), None),
+            ('overview', UpdateOne(
+                {**query, 'overview.write_date': {'$ne': write_date_emb}},
+                {
+                    '$push': {
+                        'overview': {
+                            'write_date': write_date_emb,
+                            'earliest_date': earliest_date,
+                            'latest_date': latest_date
                         }
-                    },
-                    upsert=True
-                )
-            else:
-                cls.overview.update_one(
-                    overview_query,
-                    {
-                        '$min': {'overview.$.earliest_date': available_date},
-                        '$max': {'overview.$.latest_date': available_date},
                     }
-                )
+                },
+            ), None),
+            ('overview', UpdateOne(
+                {**query, 'overview.write_date': write_date_emb},
+                {
+                    '$min': {'overview.$.earliest_date': earliest_date},
+                    '$max': {'overview.$.latest_date': latest_date},
+                }
+            ), None),
+        ]
+
+    @classmethod
+    def write_ops(cls, ops: List[WriteOp]) -> None:
+        """ Execute write operations right away, with one ordered `bulk_write` per collection."""
+        ops_by_collection = defaultdict(list)
+        for collection_name, op, _ in ops:
+            ops_by_collection[collection_name].append(op)
+        for collection_name, collection_ops in ops_by_collection.items():
+            getattr(cls, collection_name).bulk_write(collection_ops, ordered=True)
+
+    @classmethod
+    def create_overview_daily_index(cls) -> None:
+        """ The unique index `'overview_daily'` upserts rely on, creating it again is a no-op."""
+        indexes.ensure_indexes({'overview_daily': cls.overview_daily})
+
+    @classmethod
+    def migrate_overview_to_daily(cls, batch_size: int = 1000) -> None:
+        """ Rewrite the `'overview'` array layout into `'overview_daily'`. The array entries are
+            streamed with `$unwind` and upserted with `$min`/`$max` in unordered batches, so the
+            migration can be run again after switching `OVERVIEW_STORAGE` to catch up on the
+            entries written in the meantime.
+        """
+        cls.create_overview_daily_index()
+
+        cursor = cls.overview.aggregate(
+            [
+                {'$unwind': '$overview'},
+                {
+                    '$project': {
+                        '_id': False,
+                        'visa_type': True,
+                        'embassy_code': True,
+                        'write_date': '$overview.write_date',
+                        'earliest_date': '$overview.earliest_date',
+                        'latest_date': '$overview.latest_date',
+                    }
+                },
+            ],
+            allowDiskUse=True,
+            batchSize=batch_size,
+        )
+
+        migrated, batch = 0, []
+        for entry in cursor:
+            ops = cls.overview_ops(
+                entry['visa_type'],
+                entry['embassy_code'],
+                entry['write_date'],
+                entry['earliest_date'],
+                entry['latest_date'],
+                storage='daily',
+            )
+            batch.extend(op for _, op, _ in ops)
+            if len(batch) >= batch_size:
+                cls.overview_daily.bulk_write(batch, ordered=False)
+                migrated += len(batch)
+                batch = []
+                print('Migrated: {} overview entries in total'.format(migrated), end='\r')
+
+        if len(batch) > 0:
+            cls.overview_daily.bulk_write(batch, ordered=False)
+            migrated += len(batch)
+        print('Migrated: {} overview entries in total'.format(migrated))
+
+    @classmethod
+    def save_fetched_visa_status(
+        cls,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        write_time: datetime,
+        available_date: Optional[datetime],
+    ) -> None:
+        """ The method called when a new fetched result is obtained from crawler backend. The
+            `'latest_written'` collection will always be modified, whereas the `'available_dates'`
+            collection will only be modified when available date is not None
+
+            `cls.latest_written_table` is updated first and written through to MongoDB. The writes
+            are handed to `cls.write_behind` if it's enabled, otherwise every collection is written
+            with one `bulk_write`.
+        """
+        ops = cls.fetched_visa_status_ops(visa_type, embassy_code, write_time, available_date)
+        if available_date is not None:
+            ops.extend(cls.turning_point_ops(visa_type, embassy_code, write_time, available_date))
+
+        cls.latest_written_table[(visa_type, embassy_code)] = {  # stored as what MongoDB returns: naive UTC
+            'visa_type': visa_type,
+            'embassy_code': embassy_code,
+            'write_time': write_time.astimezone(tz=None).astimezone(tz=timezone.utc).replace(tzinfo=None),
+            'available_date': available_date,
+        }
+
+        if cls.write_behind is not None:
+            for collection_name, op, coalesce_key in ops:
+                cls.write_behind.put(collection_name, op, coalesce_key, tag=(visa_type, embassy_code))
+            return
+
+        cls.write_ops(ops)
+
+    @classmethod
+    def enable_write_behind(
+        cls,
+        flush_interval: float,
+        max_batch_size: int = 1000,
+        logger: Optional[logging.Logger] = None,
+    ) -> WriteBehindQueue:
+        """ Queue the writes of `cls.save_fetched_visa_status` and flush them in batches."""
+        if cls.write_behind is None:
+            cls.write_behind = WriteBehindQueue(get_collection, flush_interval, max_batch_size, logger)
+            cls.write_behind.start()
+        return cls.write_behind
+
+    @classmethod
+    def after_written(cls, func: Callable[[], Any], pair: Optional[Tuple[VisaType, EmbassyCode]] = None) -> None:
+        """ Call `func` once the fetched results saved so far are written to MongoDB, not at all if a
+            write of `pair` failed.
+        """
+        if cls.write_behind is not None:
+            cls.write_behind.call_after_flush(func, tag=pair)
+        else:
+            func()
+
+    @classmethod
+    def disable_write_behind(cls) -> None:
+        """ Flush whatever is queued and go back to synchronous writes."""
+        write_behind, cls.write_behind = cls.write_behind, None
+        if write_behind is not None:
+            write_behind.close()
 
     @classmethod
     def find_visa_status_overview(
@@ -582,6 +941,34 @@ class VisaStatus:
         # ensure date list is unique and ascendingly sorted and each date is at mid-night
         date = sorted(set([datetime.combine(d.date(), datetime.min.time()) for d in date]))
 
+        if cls.overview_storage == 'daily':
+            cursor = cls.overview_daily.aggregate([
+                {
+                    '$match': {
+                        'visa_type': {'$in': visa_type},
+                        'embassy_code': {'$in': embassy_code},
+                        'write_date': {'$in': date},
+                    }
+                },
+                {
+                    '$group': {
+                        '_id': '$write_date',
+                        'date': {'$first': '$write_date'},
+                        'overview': {
+                            '$push': {
+                                'visa_type': '$visa_type',
+                                'embassy_code': '$embassy_code',
+                                'earliest_date': '$earliest_date',
+                                'latest_date': '$latest_date',
+                            }
+                        }
+                    }
+                },
+                {'$project': {'_id': False}},
+                {'$sort': {'date': pymongo.DESCENDING}},  # today first
+            ])
+            return list(cursor)
+
         cursor = cls.overview.aggregate([
             {'$match': {'visa_type': {'$in': visa_type}, 'embassy_code': {'$in': embassy_code}}},
             {
@@ -618,6 +1005,141 @@ class VisaStatus:
 
         return list(cursor)  # tabular data on the fly
 
+    @staticmethod
+    def plan_overview_query(
+        visa_type: List[VisaType],
+        embassy_code: List[EmbassyCode],
+        since_utc: datetime,
+        to_utc: datetime,
+    ) -> Tuple[List[dict], Dict[EmbassyCode, datetime]]:
+        """ Turn the UTC date range into the embassy-local date range of every embassy. Embassies
+            sharing a range, i.e. a UTC offset, are merged into one `{'embassy_code': {'$in': ...},
+            'write_date': {'$gte': ..., '$lte': ...}}` branch of a `$or`, so that the whole query is
+            one index scan per distinct offset instead of one pipeline per embassy.
+
+            Return the `$or` branches and the first local date of every embassy. The n-th local
+            date of an embassy stands for the n-th UTC date of the range.
+        """
+        def dt_to_date(dt: datetime) -> datetime:
+            return dt.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+        utc_days = (dt_to_date(to_utc) - dt_to_date(since_utc)).days + 1
+        codes_by_range = defaultdict(list)
+        local_since_by_code = {}
+        for ec in embassy_code:
+            embassy = USEmbassy.get_embassy_by_code(ec)
+            if embassy is None:
+                continue
+
+            local_since = dt_to_date(since_utc.astimezone(embassy.timezone))
+            local_days = (dt_to_date(to_utc.astimezone(embassy.timezone)) - local_since).days + 1
+            local_to = local_since + timedelta(days=min(utc_days, local_days) - 1)
+            codes_by_range[(local_since, local_to)].append(ec)
+            local_since_by_code[ec] = local_since
+
+        branches = [
+            {
+                'visa_type': {'$in': visa_type},
+                'embassy_code': {'$in': codes},
+                'write_date': {'$gte': local_since, '$lte': local_to},
+            } for (local_since, local_to), codes in codes_by_range.items()
+        ]
+        return branches, local_since_by_code
+
+    @classmethod
+    def find_overview_entries(cls, branches: List[dict]) -> Iterable[dict]:
+        """ Return the overview entries `{'visa_type', 'embassy_code', 'write_date', 'earliest_date',
+            'latest_date'}` matching any of the `$or` branches, whatever the overview layout. A branch
+            matches `'visa_type'`, `'embassy_code'` with `$in` and `'write_date'` with either `$in` or
+            `$gte`/`$lte`.
+        """
+        projection = {
+            '_id': False,
+            'visa_type': True,
+            'embassy_code': True,
+            'write_date': True,
+            'earliest_date': True,
+            'latest_date': True,
+        }
+        if cls.overview_storage == 'daily':
+            return cls.overview_daily.find({'$or': branches}, projection=projection)
+
+        # the array layout can only be narrowed down to the covering date range before `$unwind`
+        visa_types = list({vt for branch in branches for vt in branch['visa_type']['$in']})
+        embassy_codes = list({ec for branch in branches for ec in branch['embassy_code']['$in']})
+        date_conds = [branch['write_date'] for branch in branches]
+        first_date = min(min(cond['$in']) if '$in' in cond else cond['$gte'] for cond in date_conds)
+        last_date = max(max(cond['$in']) if '$in' in cond else cond['$lte'] for cond in date_conds)
+        return cls.overview.aggregate([
+            {'$match': {'visa_type': {'$in': visa_types}, 'embassy_code': {'$in': embassy_codes}}},
+            {
+                '$project': {
+                    'visa_type': True,
+                    'embassy_code': True,
+                    'overview': {
+                        '$filter': {
+                            'input': '$overview',
+                            'as': 'ov',
+                            'cond': {
+                                '$and': [
+                                    {'$gte': ['$$ov.write_date', first_date]},
+                                    {'$lte': ['$$ov.write_date', last_date]},
+                                ]
+                            },
+                        }
+                    },
+                }
+            },
+            {'$unwind': '$overview'},
+            {
+                '$project': {
+                    'visa_type': True,
+                    'embassy_code': True,
+                    'write_date': '$overview.write_date',
+                    'earliest_date': '$overview.earliest_date',
+                    'latest_date': '$overview.latest_date',
+                }
+            },
+            {'$match': {'$or': branches}},
+            {'$project': projection},
+        ])
+
+    @classmethod
+    def find_overview_fragments(
+        cls,
+        keys: List[Tuple[VisaType, EmbassyCode, datetime]],
+    ) -> Dict[Tuple[VisaType, EmbassyCode, datetime], Optional[dict]]:
+        """ Return the overview entry `{'visa_type', 'embassy_code', 'earliest_date', 'latest_date'}`
+            of every `(visa_type, embassy_code, write_date)` key, None if nothing was fetched on that
+            embassy-local date. All the keys are read in one query: the pairs asking for the same
+            dates share one `$or` branch.
+        """
+        dates_by_pair = defaultdict(set)
+        for visa_type, embassy_code, write_date in keys:
+            dates_by_pair[(visa_type, embassy_code)].add(write_date)
+
+        pairs_by_dates = defaultdict(list)
+        for pair, dates in dates_by_pair.items():
+            pairs_by_dates[frozenset(dates)].append(pair)
+
+        branches = [
+            {
+                'visa_type': {'$in': list({vt for vt, _ in pairs})},
+                'embassy_code': {'$in': list({ec for _, ec in pairs})},
+                'write_date': {'$in': sorted(dates)},
+            } for dates, pairs in pairs_by_dates.items()
+        ]
+
+        fragments = {key: None for key in keys}
+        if len(branches) == 0:
+            return fragments
+
+        for overview in cls.find_overview_entries(branches):
+            key = (overview['visa_type'], overview['embassy_code'], overview.pop('write_date'))
+            if key in fragments:  # a branch matches the cross product of its visa types and embassies
+                fragments[key] = overview
+        return fragments
+
     @classmethod
     def find_visa_status_overview_embtz(
         cls,
@@ -628,96 +1150,48 @@ class VisaStatus:
     ):
         """ This method fix the problem of `cls.find_visa_status_overview` as the previous method doesn't
             convert the querying date into the embassy timezone.
-        """
-
-        def dt_to_date(dt: datetime) -> datetime:
-            return dt.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
-
-        def utc_to_embtz(dt: datetime, embtz: timezone) -> datetime:
-            return dt_to_date(dt.astimezone(embtz))
-
-        def single_target_query(visa_type: str, embassy_code: str, date_range: List[datetime]) -> List[dict]:
-            """ construct the sub-pipeline for mongodb aggregation `facet` stage."""
-            return [
-                {'$match': {'visa_type': visa_type, 'embassy_code': embassy_code}},
-                {
-                    '$project': {
-                        'visa_type': '$visa_type',
-                        'embassy_code': '$embassy_code',
-                        'overview': {
-                            '$filter': {
-                                'input': '$overview',
-                                'as': 'ov',
-                                'cond': {'$in': ['$$ov.write_date', date_range]}
-                            }
-                        }
-                    }
-                },
-                {'$unwind': '$overview'},
-                {
-                    '$project': {
-                        '_id': False,
-                        'visa_type': '$visa_type',
-                        'embassy_code': '$embassy_code',
-                        'write_date': '$overview.write_date',
-                        'earliest_date': '$overview.earliest_date',
-                        'latest_date': '$overview.latest_date',
-                    }
-                },
-            ]
 
+            The query is planned by `cls.plan_overview_query` and the result is grouped by UTC date
+            in one pass over the cursor.
+        """
         if not isinstance(visa_type, list):
             visa_type = [visa_type]
         if not isinstance(embassy_code, list):
             embassy_code = [embassy_code]
 
-        overview_target = [
-            {
-                'visa_type': vt,
-                'embassy_code': emb.code,
-                'date_range': [
-                    utc_to_embtz(since_utc, emb.timezone) + timedelta(days=d)
-                    for d in range(
-                        (utc_to_embtz(to_utc, emb.timezone) - utc_to_embtz(since_utc, emb.timezone)).days + 1
-                    )
-                ],
-            } for vt in visa_type for emb in [USEmbassy.get_embassy_by_code(ec) for ec in embassy_code]
-        ]
-
-        utc_date_range = [
-            dt_to_date(since_utc) + timedelta(days=d)
-            for d in range((dt_to_date(to_utc) - dt_to_date(since_utc)).days + 1)
-        ]
+        branches, local_since_by_code = cls.plan_overview_query(visa_type, embassy_code, since_utc, to_utc)
+        if len(branches) == 0:
+            return []
 
-        embtz_utc_map = {tgt['embassy_code']: dict(zip(tgt['date_range'], utc_date_range)) for tgt in overview_target}
+        return cls.group_overview_by_utc_date(cls.find_overview_entries(branches), since_utc, local_since_by_code)
 
-        query = [
-            {
-                '$facet': {
-                    '{}{}'.format(tgt['visa_type'], tgt['embassy_code']): single_target_query(**tgt)
-                    for tgt in overview_target
-                },
-            },
-            {
-                '$project': {
-                    'facet_result': {
-                        '$setUnion': ['${}{}'.format(tgt['visa_type'], tgt['embassy_code']) for tgt in overview_target]
-                    }
-                },
-            },
-            {'$unwind': '$facet_result'},
-            {'$replaceRoot': {'newRoot': '$facet_result'}}
+    @staticmethod
+    def overview_fragment_keys(branches: List[dict]) -> List[Tuple[VisaType, EmbassyCode, datetime]]:
+        """ Return the `(visa_type, embassy_code, write_date)` keys covered by the branches of
+            `cls.plan_overview_query`.
+        """
+        return [
+            (vt, ec, branch['write_date']['$gte'] + timedelta(days=d))
+            for branch in branches
+            for d in range((branch['write_date']['$lte'] - branch['write_date']['$gte']).days + 1)
+            for vt in branch['visa_type']['$in']
+            for ec in branch['embassy_code']['$in']
         ]
-        overview_embtz = list(cls.overview.aggregate(query))
-        overview_utc = [{
-            **ov,
-            'write_date': embtz_utc_map[ov['embassy_code']][ov['write_date']],
-        } for ov in overview_embtz if ov['write_date'] in embtz_utc_map[ov['embassy_code']]]
 
+    @staticmethod
+    def group_overview_by_utc_date(
+        overview_entries: Iterable[dict],
+        since_utc: datetime,
+        local_since_by_code: Dict[EmbassyCode, datetime],
+    ) -> List[dict]:
+        """ Group the overview entries of embassy-local dates by the UTC dates they stand for, see
+            `cls.plan_overview_query`. The `'write_date'` of the entries is popped.
+        """
+        utc_since = since_utc.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
         ov_groupby_date = defaultdict(list)
-        for overview in overview_utc:
+        for overview in overview_entries:
             write_date = overview.pop('write_date')
-            ov_groupby_date[write_date].append(overview)
+            ov_groupby_date[utc_since + (write_date - local_since_by_code[overview['embassy_code']])].append(overview)
 
         return sorted(
             [{'date': write_date, 'overview': overview} for write_date, overview in ov_groupby_date.items()],
@@ -753,6 +1227,20 @@ class VisaStatus:
 
         return list(cursor)
 
+    @classmethod
+    def find_latest_written_visa_status_in_memory(cls, visa_type: VisaType, embassy_code: EmbassyCode) -> List[dict]:
+        """ Same as `cls.find_latest_written_visa_status` for one `(visa_type, embassy_code)` pair but
+            read from `cls.latest_written_table`, without a database round trip.
+        """
+        latest_written = cls.latest_written_table.get((visa_type, embassy_code))
+        if latest_written is None:
+            return []
+
+        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        if latest_written['write_time'] < today_start:
+            return []
+        return [dict(latest_written)]
+
     @classmethod
     def find_visa_status_past24h(
         cls,
@@ -764,9 +1252,10 @@ class VisaStatus:
         """ Return historical data of a given `visa_type`-`embassy_cde` pair for the past 24 hours"""
         ts_start, ts_end = timestamp - timedelta(minutes=minutes), timestamp
 
-        today = datetime.combine(timestamp.date(), datetime.min.time())
-        yesterday = today - timedelta(days=1)
-        dates = list({today, yesterday})
+        if cls.storage == 'bucket':
+            return cls.find_visa_status_past24h_bucket(visa_type, embassy_code, ts_start, ts_end)
+
+        dates = cls.write_dates(ts_start, ts_end)
 
         cursor = cls.visa_status.aggregate([
             {'$match': {'visa_type': visa_type, 'embassy_code': embassy_code, 'write_date': {'$in': dates}}},
@@ -820,6 +1309,161 @@ class VisaStatus:
         else:
             return None
 
+    @staticmethod
+    def write_dates(ts_start: datetime, ts_end: datetime) -> List[datetime]:
+        """ Return the (UTC) `write_date` of the daily documents overlapping `[ts_start, ts_end]`."""
+        def utc_date(dt: datetime) -> date:
+            return dt.date() if dt.tzinfo is None else dt.astimezone(timezone.utc).date()
+
+        write_date = datetime.combine(utc_date(ts_start), datetime.min.time())
+        dates = []
+        while write_date.date() <= utc_date(ts_end):
+            dates.append(write_date)
+            write_date += timedelta(days=1)
+        return dates
+
+    @classmethod
+    def find_visa_status_past24h_bucket(
+        cls,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        ts_start: datetime,
+        ts_end: datetime,
+    ) -> Optional[dict]:
+        """ `cls.find_visa_status_past24h` for the `'bucket'` storage. The fetches come in
+            `write_time` order so the per-minute grouping is done in one pass.
+        """
+        def naive_utc(dt: datetime) -> datetime:
+            return dt if dt.tzinfo is None else dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+        since_utc, to_utc = naive_utc(ts_start), naive_utc(ts_end)
+        available_dates = cls.find_fetched_visa_status(
+            visa_type, embassy_code, since_utc, to_utc + timedelta(minutes=1)
+        )
+        if available_dates is None:
+            return None
+
+        return {
+            'visa_type': visa_type,
+            'embassy_code': embassy_code,
+            'time_range': [ts_start, ts_end],
+            'available_dates': cls.min_per_minute(available_dates, since_utc, to_utc),
+        }
+
+    @staticmethod
+    def min_per_minute(available_dates: List[dict], since_utc: datetime, to_utc: datetime) -> List[dict]:
+        """ Keep the earliest available date of every minute among fetches in `write_time` order,
+            and drop the minutes out of `[since_utc, to_utc]`.
+        """
+        per_minute = []
+        for fetch in available_dates:
+            minute = fetch['write_time'].replace(second=0, microsecond=0)
+            if len(per_minute) > 0 and per_minute[-1][0] == minute:
+                per_minute[-1][1]['available_date'] = min(per_minute[-1][1]['available_date'], fetch['available_date'])
+            else:
+                per_minute.append((minute, dict(fetch)))
+
+        return [fetch for _, fetch in per_minute if since_utc <= fetch['write_time'] <= to_utc]
+
+    @classmethod
+    def find_visa_status_past24h_batch(
+        cls,
+        visa_type: VisaType,
+        embassy_code: List[EmbassyCode],
+        timestamp: datetime,
+        minutes: int = 1440,
+    ) -> Dict[EmbassyCode, Optional[dict]]:
+        """ `cls.find_visa_status_past24h` of several embassies in one query."""
+        ts_start, ts_end = timestamp - timedelta(minutes=minutes), timestamp
+        result = {ec: None for ec in embassy_code}
+        if len(embassy_code) == 0:
+            return result
+
+        if cls.storage == 'bucket':
+            def naive_utc(dt: datetime) -> datetime:
+                return dt if dt.tzinfo is None else dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+            since_utc, to_utc = naive_utc(ts_start), naive_utc(ts_end)
+            cursor = cls.visa_status_bucket.find(
+                {
+                    'visa_type': visa_type,
+                    'embassy_code': {'$in': embassy_code},
+                    'bucket_start': {'$gte': cls.get_bucket_start(since_utc), '$lt': to_utc + timedelta(minutes=1)},
+                },
+                projection={'_id': False, 'embassy_code': True, 'available_dates': True},
+                sort=[('embassy_code', pymongo.ASCENDING), ('bucket_start', pymongo.ASCENDING)],
+            )
+
+            available_dates = defaultdict(list)
+            for bucket in cursor:
+                available_dates[bucket['embassy_code']].extend(bucket['available_dates'])
+
+            for ec, adt in available_dates.items():
+                result[ec] = {
+                    'visa_type': visa_type,
+                    'embassy_code': ec,
+                    'time_range': [ts_start, ts_end],
+                    'available_dates': cls.min_per_minute(adt, since_utc, to_utc),
+                }
+            return result
+
+        dates = cls.write_dates(ts_start, ts_end)
+
+        cursor = cls.visa_status.aggregate([
+            {'$match': {'visa_type': visa_type, 'embassy_code': {'$in': embassy_code}, 'write_date': {'$in': dates}}},
+            {'$unwind': '$available_dates'},
+            {
+                '$group': {
+                    '_id': {
+                        'embassy_code': '$embassy_code',
+                        'minute': {
+                            '$dateToString': {'format': '%Y-%m-%dT%H:%M', 'date': '$available_dates.write_time'}
+                        },
+                    },
+                    'visa_type': {'$first': '$visa_type'},
+                    'embassy_code': {'$first': '$embassy_code'},
+                    'write_time': {'$first': '$available_dates.write_time'},
+                    'available_date': {'$min': '$available_dates.available_date'}
+                }
+            },
+            {'$sort': {'embassy_code': pymongo.ASCENDING, 'write_time': pymongo.ASCENDING}},
+            {
+                '$group': {
+                    '_id': '$embassy_code',
+                    'visa_type': {'$first': '$visa_type'},
+                    'embassy_code': {'$first': '$embassy_code'},
+                    'available_dates': {
+                        '$push': {
+                            '$cond': [
+                                {
+                                    '$and': [
+                                        {'$gte': ['$write_time', ts_start]},
+                                        {'$lte': ['$write_time', ts_end]},
+                                    ],
+                                },
+                                {
+                                    'write_time': '$write_time',
+                                    'available_date': '$available_date',
+                                },
+                                None
+                            ]
+                        },
+                    },
+                }
+            },
+            {'$project': {
+                '_id': False,
+                'visa_type': '$visa_type',
+                'embassy_code': '$embassy_code',
+                'time_range': [ts_start, ts_end],
+                'available_dates': {'$setDifference': ['$available_dates', [None]]},
+            }}
+        ], allowDiskUse=True)
+
+        for visa_status in cursor:
+            result[visa_status['embassy_code']] = visa_status
+        return result
+
     @classmethod
     def find_visa_status_past24h_turning_point(
         cls,
@@ -828,48 +1472,246 @@ class VisaStatus:
         timestamp: datetime,
     ):
         """ Fill in the missing minute and return the visa status detail with consecutive duplicate removed"""
-        visa_status = cls.find_visa_status_past24h(visa_type, embassy_code, timestamp)
-        if visa_status is None or len(visa_status['available_dates']) == 0:
+        return cls.to_turning_points_batch([cls.find_visa_status_past24h(visa_type, embassy_code, timestamp)])[0]
+
+    @classmethod
+    def find_visa_status_past24h_turning_point_batch(
+        cls,
+        visa_type: VisaType,
+        embassy_code: List[EmbassyCode],
+        timestamp: datetime,
+    ) -> Dict[EmbassyCode, Optional[dict]]:
+        """ `cls.find_visa_status_past24h_turning_point` of several embassies in one query, read from
+            the `'turning_point'` series if it's the `DETAIL_SOURCE`.
+        """
+        if cls.detail_source == 'turning_point':
+            return cls.find_turning_point_series_batch(visa_type, embassy_code, timestamp)
+        visa_statuses = cls.find_visa_status_past24h_batch(visa_type, embassy_code, timestamp)
+        return dict(zip(visa_statuses, cls.to_turning_points_batch(list(visa_statuses.values()))))
+
+    @classmethod
+    def to_turning_points_batch(cls, visa_statuses: List[Optional[dict]]) -> List[Optional[dict]]:
+        """ `cls.to_turning_points` of several results of `cls.find_visa_status_past24h` at once, on
+            NumPy arrays, see turning_points.py.
+        """
+        return turning_points.to_turning_points_batch(visa_statuses, [
+            cls.gap_seconds(visa_status['visa_type'], visa_status['embassy_code']) * 1000 if visa_status else 0
+            for visa_status in visa_statuses
+        ])
+
+    @classmethod
+    def to_turning_points(cls, visa_status: Optional[dict]) -> Optional[dict]:
+        """ Turn the result of `cls.find_visa_status_past24h` into the visa status detail, see
+            `turning_points.to_turning_points`. This is the reference of the vectorized
+            `cls.to_turning_points_batch`.
+        """
+        if visa_status is None:
             return
+        gap_seconds = cls.gap_seconds(visa_status['visa_type'], visa_status['embassy_code'])
+        return turning_points.to_turning_points(visa_status, gap_seconds * 1000)
+
+    @staticmethod
+    def gap_seconds(visa_type: VisaType, embassy_code: EmbassyCode) -> int:
+        """ Return the seconds between two fetches above which the detail shows a gap: the fetch interval
+            with 1 minute of tolerance, like `cls.to_turning_points`.
+        """
         embassy = USEmbassy.get_embassy_by_code(embassy_code)
         interval = CGI_FETCH_TIME_INTERVAL[visa_type] if embassy.sys == 'cgi' else AIS_FETCH_TIME_INTERVAL[visa_type]
-        interval = (interval + 60) * 1000  # add 1min tolerance
-
-        def convert(dt: datetime):
-            return dt_to_utc(dt, remove_second=True)
-
-        available_dates = [{
-            'write_time': convert(i['write_time']),
-            'available_date': i['available_date'],
-        } for i in visa_status['available_dates']]
-        ts_start, ts_end = list(map(convert, visa_status['time_range']))
-        purified_available_dates = []
-
-        first_dp = available_dates[0]
-        if first_dp['write_time'] - ts_start > 1:
-            purified_available_dates = [{'write_time': ts_start, 'available_date': None}]
-
-        for i, (prev_dp, next_dp) in enumerate(zip(available_dates[:-1], available_dates[1:])):
-            if i == 0:
-                purified_available_dates.append(prev_dp)
-            if next_dp['write_time'] - prev_dp['write_time'] <= interval:
-                if prev_dp['available_date'] == next_dp['available_date']:
-                    continue
-                else:
-                    purified_available_dates.append(next_dp)
-            else:
-                purified_available_dates.append({'write_time': prev_dp['write_time'] + 60000, 'available_date': None})
-                purified_available_dates.append(next_dp)
+        return interval + 60
 
-        last_dp = available_dates[-1]
-        if ts_end - last_dp['write_time'] > interval:
-            purified_available_dates.append({'write_time': last_dp['write_time'] + 60000, 'available_date': None})
+    @classmethod
+    def turning_point_step(
+        cls,
+        state: Optional[Tuple[datetime, datetime]],
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        minute: datetime,
+        available_date: datetime,
+    ) -> Tuple[Tuple[datetime, datetime], List[dict]]:
+        """ Advance the turning-point series by a successful fetch in `minute` (naive UTC), see
+            `turning_points.series_step`. The gaps are above `cls.gap_seconds`.
+        """
+        return turning_points.series_step(state, minute, available_date, cls.gap_seconds(visa_type, embassy_code))
 
-        return {
-            **visa_status,
-            'time_range': [ts_start, ts_end],
-            'available_dates': purified_available_dates,
-        }
+    @staticmethod
+    def turning_point_update(minute: datetime, points: List[dict]) -> dict:
+        """ Return the update of a `'turning_point'` document marking `minute` as fetched and appending `points`."""
+        return turning_points.series_update(minute, points)
+
+    @classmethod
+    def turning_point_ops(
+        cls,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        write_time: datetime,
+        available_date: datetime,
+    ) -> List[WriteOp]:
+        """ Return the write operation appending a successful fetch to the `'turning_point'` series.
+            The state of the series is kept in `cls.turning_point_state`, nothing is read.
+        """
+        minute = write_time.astimezone(tz=None).astimezone(tz=timezone.utc)\
+            .replace(second=0, microsecond=0, tzinfo=None)
+        with cls.turning_point_lock:
+            state, points = cls.turning_point_step(
+                cls.turning_point_state.get((visa_type, embassy_code)), visa_type, embassy_code, minute, available_date
+            )
+            cls.turning_point_state[(visa_type, embassy_code)] = state
+
+        minute = state[0]
+        query = {'visa_type': visa_type, 'embassy_code': embassy_code, 'date': minute.replace(hour=0, minute=0)}
+        return [('turning_point', UpdateOne(query, cls.turning_point_update(minute, points), upsert=True), None)]
+
+    @classmethod
+    def create_turning_point_index(cls) -> None:
+        """ The unique index `'turning_point'` upserts rely on, creating it again is a no-op."""
+        indexes.ensure_indexes({'turning_point': cls.turning_point})
+
+    @classmethod
+    def initiate_turning_point_state(cls, days: int = 2) -> None:
+        """ Load `cls.turning_point_state` from the last `'turning_point'` document of every pair
+            written in the last `days` UTC dates, so that a restarted fetcher continues the series.
+        """
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+        cursor = cls.turning_point.aggregate([
+            {'$match': {'date': {'$gte': since}}},
+            {'$sort': {'date': pymongo.ASCENDING}},
+            {
+                '$group': {
+                    '_id': {'visa_type': '$visa_type', 'embassy_code': '$embassy_code'},
+                    'date': {'$last': '$date'},
+                    'fetched': {'$last': '$fetched'},
+                    'last_point': {'$last': {'$arrayElemAt': ['$points', -1]}},
+                }
+            },
+        ])
+
+        with cls.turning_point_lock:
+            for doc in cursor:
+                _, last_minute = cls.fetched_minute_range(
+                    [doc], doc['date'] - timedelta(minutes=1), doc['date'] + timedelta(days=1)
+                )
+                if last_minute is not None and doc.get('last_point') is not None:
+                    key = (doc['_id']['visa_type'], doc['_id']['embassy_code'])
+                    cls.turning_point_state[key] = (last_minute, doc['last_point']['available_date'])
+
+    @staticmethod
+    def fetched_minute_range(
+        docs: List[dict],
+        since_minute: datetime,
+        to_minute: datetime,
+    ) -> Tuple[Optional[datetime], Optional[datetime]]:
+        """ Return the first and the last fetched minute of `(since_minute, to_minute]` in the bitmaps
+            of `'turning_point'` documents.
+        """
+        return turning_points.fetched_minute_range(docs, since_minute, to_minute)
+
+    @classmethod
+    def series_to_turning_points(
+        cls,
+        visa_type: VisaType,
+        embassy_code: EmbassyCode,
+        docs: List[dict],
+        since_minute: datetime,
+        to_minute: datetime,
+    ) -> Optional[dict]:
+        """ Cut the visa status detail of the fetches in `(since_minute, to_minute]` out of the
+            `'turning_point'` documents of the dates of the range, see `turning_points.series_to_turning_points`.
+        """
+        return turning_points.series_to_turning_points(
+            visa_type, embassy_code, docs, since_minute, to_minute, cls.gap_seconds(visa_type, embassy_code)
+        )
+
+    @classmethod
+    def find_turning_point_series_batch(
+        cls,
+        visa_type: VisaType,
+        embassy_code: List[EmbassyCode],
+        timestamp: datetime,
+        minutes: int = 1440,
+    ) -> Dict[EmbassyCode, Optional[dict]]:
+        """ The visa status detail of the `minutes` minutes ending at the minute of `timestamp`, read
+            from the `'turning_point'` series with one range read. It's the result of
+            `cls.find_visa_status_past24h_turning_point` for the last instant of that minute.
+        """
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        to_minute = timestamp.replace(second=0, microsecond=0)
+        since_minute = to_minute - timedelta(minutes=minutes)
+        since_date = since_minute.replace(hour=0, minute=0)
+        dates = [since_date + timedelta(days=d) for d in range((to_minute - since_date).days + 1)]
+
+        result = {ec: None for ec in embassy_code}
+        if len(embassy_code) == 0:
+            return result
+
+        cursor = cls.turning_point.find(
+            {'visa_type': visa_type, 'embassy_code': {'$in': embassy_code}, 'date': {'$in': dates}},
+            projection={'_id': False, 'embassy_code': True, 'date': True, 'fetched': True, 'points': True},
+            sort=[('embassy_code', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+        )
+        docs = defaultdict(list)
+        for doc in cursor:
+            docs[doc['embassy_code']].append(doc)
+
+        for ec, ec_docs in docs.items():
+            result[ec] = cls.series_to_turning_points(visa_type, ec, ec_docs, since_minute, to_minute)
+        return result
+
+    @classmethod
+    def migrate_turning_points(cls, batch_size: int = 1000) -> None:
+        """ Build the `'turning_point'` series from the fetches stored so far, in the current `storage`.
+            The documents are replaced, run it while the fetcher is stopped.
+        """
+        cls.create_turning_point_index()
+        if cls.storage == 'bucket':
+            cursor = cls.visa_status_bucket.aggregate(
+                [{'$sort': {'visa_type': 1, 'embassy_code': 1, 'bucket_start': 1}}],
+                allowDiskUse=True,
+                batchSize=batch_size,
+            )
+        else:
+            cursor = cls.visa_status.aggregate(
+                [{'$sort': {'visa_type': 1, 'embassy_code': 1, 'write_date': 1}}],
+                allowDiskUse=True,
+                batchSize=batch_size,
+            )
+
+        migrated, batch = 0, []
+        state, series = None, {}  # series of the current pair: date -> document
+
+        def flush_series():
+            nonlocal migrated, batch
+            for doc in series.values():
+                query = {k: doc[k] for k in ('visa_type', 'embassy_code', 'date')}
+                batch.append(ReplaceOne(query, doc, upsert=True))
+            if len(batch) >= batch_size:
+                cls.turning_point.bulk_write(batch, ordered=False)
+                migrated += len(batch)
+                batch = []
+                print('Migrated: {} turning point documents in total'.format(migrated), end='\r')
+
+        pair = None
+        for visa_status in cursor:
+            if pair != (visa_status['visa_type'], visa_status['embassy_code']):
+                flush_series()
+                pair, state, series = (visa_status['visa_type'], visa_status['embassy_code']), None, {}
+
+            for fetch in sorted(visa_status['available_dates'], key=lambda adt: adt['write_time']):
+                minute = fetch['write_time'].replace(second=0, microsecond=0)
+                state, points = cls.turning_point_step(state, *pair, minute, fetch['available_date'])
+                day = state[0].replace(hour=0, minute=0)
+                doc = series.setdefault(day, {
+                    'visa_type': pair[0], 'embassy_code': pair[1], 'date': day, 'fetched': {}, 'points': []
+                })
+                word, bit = divmod(state[0].hour * 60 + state[0].minute, TURNING_POINT_WORD_BITS)
+                doc['fetched'][str(word)] = doc['fetched'].get(str(word), 0) | (1 << bit)
+                doc['points'].extend(points)
+
+        flush_series()
+        if len(batch) > 0:
+            cls.turning_point.bulk_write(batch, ordered=False)
+            migrated += len(batch)
+        print('Migrated: {} turning point documents in total'.format(migrated))
 
     @classmethod
     def find_historical_visa_status(
@@ -882,6 +1724,19 @@ class VisaStatus:
             If we sort the available dates in the guranularity of minutes, it will be too heavy a
             work load for backend servers, so sort by date and leave the other work to front end.
         """
+        if cls.storage == 'bucket':
+            available_dates = cls.find_fetched_visa_status(
+                visa_type, embassy_code, write_date, write_date + timedelta(days=1)
+            )
+            if available_dates is None:
+                return None
+            return {
+                'visa_type': visa_type,
+                'embassy_code': embassy_code,
+                'write_date': write_date,
+                'available_dates': available_dates,
+            }
+
         cursor = cls.visa_status.aggregate([
             {'$match': {'visa_type': visa_type, 'embassy_code': embassy_code, 'write_date': write_date}},
             {'$unwind': '$available_dates'},
@@ -916,6 +1771,7 @@ class Subscription:
             based TuixueDB, the difference is that to represent 'subscribe with no end date'
             we use the `datetime.max` instead of a special string. It helps to simplify the
             logic here as suggested by @n+e.
+        2. Email outbox - the emails waiting to be posted to the mail relay, see email_outbox.py.
 
         The schema of email susbcriber is as following:
 
@@ -929,6 +1785,41 @@ class Subscription:
         ```
     """
     email = get_collection('email_subscription')
+    outbox = get_collection('email_outbox')
+    index: Optional[SubscriptionIndex] = None  # answers `get_email_list` once enabled
+    index_lock = Lock()  # a rebuild doesn't overwrite the reloads of the emails edited meanwhile
+
+    @classmethod
+    def enable_index(cls, logger: Optional[logging.Logger] = None) -> SubscriptionIndex:
+        """ Build the in-memory index of the subscriptions from MongoDB, `get_email_list` is
+            answered by it from now on, see subscription_index.py.
+        """
+        if cls.index is None:
+            index = SubscriptionIndex(logger)
+            index.rebuild(cls.email.find({}, projection={'_id': False}))
+            cls.index = index
+        return cls.index
+
+    @classmethod
+    def rebuild_index(cls) -> None:
+        """ Reload the whole index from MongoDB, e.g. after missed subscription events."""
+        if cls.index is not None:
+            with cls.index_lock:
+                cls.index.rebuild(cls.email.find({}, projection={'_id': False}))
+
+    @classmethod
+    def reload_index(cls, emails: List[str]) -> None:
+        """ Reload the subscriptions of the given emails into the index, an email without any
+            subscriber document left is removed from it.
+        """
+        if cls.index is not None:
+            with cls.index_lock:
+                documents = {
+                    document['email']: document
+                    for document in cls.email.find({'email': {'$in': list(set(emails))}}, projection={'_id': False})
+                }
+                for email in set(emails):
+                    cls.index.update(email, documents.get(email, {}).get('subscription', []))
 
     @classmethod
     def get_subscriptions_by_email(cls, email: str) -> list:
@@ -960,6 +1851,9 @@ class Subscription:
         if not isinstance(new_visa_status, list):
             new_visa_status = [new_visa_status]
 
+        if cls.index is not None:
+            return cls.index.get_email_list(new_visa_status, inclusion)
+
         email_list = defaultdict(list)
         for visa_type, embassy_code, available_date in new_visa_status:
             all_subs = cls.email.find(
@@ -1009,6 +1903,7 @@ class Subscription:
                 })
             if till > datetime.now() and len(subscription) > 0:
                 cls.email.update_one({'email': email}, {'$set': {'subscription': subscription}}, upsert=True)
+        cls.rebuild_index()
 
     @classmethod
     def add_email_subscription(
@@ -1031,6 +1926,7 @@ class Subscription:
         ]
 
         cls.email.update_one({'email': email}, {'$set': {'subscription': new_subscription}}, upsert=True)
+        cls.reload_index([email])
 
         return cls.email.find_one({'email': email}, projection={'_id': False})
 
@@ -1060,3 +1956,30 @@ class Subscription:
             cls.email.update_one({'email': email}, {'$set': {'subscription': updated_subscription}})
         else:
             cls.email.find_one_and_delete({'email': email})
+        cls.reload_index([email])
+
+
+def all_collections() -> Dict[str, collection.Collection]:
+    """ Return the collections of `VisaStatus` and `Subscription` by name."""
+    return {
+        'visa_status': VisaStatus.visa_status,
+        'visa_status_bucket': VisaStatus.visa_status_bucket,
+        'overview': VisaStatus.overview,
+        'overview_daily': VisaStatus.overview_daily,
+        'latest_written': VisaStatus.latest_written,
+        'turning_point': VisaStatus.turning_point,
+        'email_subscription': Subscription.email,
+        'email_outbox': Subscription.outbox,
+    }
+
+
+def create_indexes(logger: Optional[logging.Logger] = None) -> List[str]:
+    """ Create the indexes of all the collections, see indexes.py. It's a no-op for the indexes
+        already there, so it's called at every startup.
+    """
+    return indexes.ensure_indexes(all_collections(), logger)
+
+
+def explain_hot_queries() -> List[dict]:
+    """ Return the plans of the hot queries for the first embassy, see indexes.py."""
+    return indexes.explain_hot_queries(all_collections(), VISA_TYPES[0], USEmbassy.get_embassy_lst()[0].code)
@@ -0,0 +1,314 @@
+""" The visa status detail computed on NumPy arrays, for many embassies at once.
+    `VisaStatus.to_turning_points` walks the fetches of one embassy pair by pair. Here the fetches
+    of all the requested embassies are concatenated into one array of write times (ms since the
+    epoch, at the minute) and one array of date codes, with the `offsets` of every embassy in
+    them. The gaps and the date changes are found with whole-array comparisons, and only the
+    points kept in the detail are turned back into dicts. The result is exactly the one of
+    `to_turning_points`, the reference.
+    The `'turning_point'` series, maintained on write, is advanced by `series_step` and cut into
+    the same detail by `series_to_turning_points`. None of these read the database or the config.
+"""
+import itertools
+from datetime import datetime, timedelta
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from util import dt_to_utc
+
+MINUTE_MS = 60000
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+WORD_BITS = 32  # minutes per word of the `'turning_point'` bitmaps, BSON integers are signed
+
+
+def minute_ms(datetimes: Sequence[datetime]) -> np.ndarray:
+    """ `dt_to_utc(dt, remove_second=True)` of every datetime. Like `dt_to_utc`, the timezone of an
+        aware datetime is ignored. The fields are read with C-level `map`s, converting the datetime
+        objects themselves with `np.array` is several times slower.
+    """
+    def field(getter: Callable) -> np.ndarray:
+        return np.fromiter(map(getter, datetimes), dtype=np.int64, count=len(datetimes))
+
+    days = field(datetime.toordinal) - EPOCH_ORDINAL
+    return ((days * 24 + field(attrgetter('hour'))) * 60 + field(attrgetter('minute'))) * MINUTE_MS
+
+
+def turning_points_of_arrays(
+    write_ms: np.ndarray,
+    date_codes: np.ndarray,
+    offsets: np.ndarray,
+    ts_start_ms: np.ndarray,
+    ts_end_ms: np.ndarray,
+    gap_ms: np.ndarray,
+    date_of: Callable[[int], Any],
+) -> List[Optional[List[dict]]]:
+    """ Return the `available_dates` of the detail of every series, None for an empty series.
+        The series `i` is made of the fetches `offsets[i]:offsets[i + 1]`, in `write_time` order, and
+        its detail spans `[ts_start_ms[i], ts_end_ms[i]]`. Two fetches more than `gap_ms[i]` apart
+        are separated by a gap. The fetches of equal `date_codes` have the same date, which is
+        `date_of(code)`.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    size = int(offsets[-1])
+    if size == 0:
+        return [None] * len(lengths)
+    series = np.repeat(np.arange(len(lengths)), lengths)  # the series of every fetch
+
+    first = np.zeros(size, dtype=bool)
+    first[offsets[:-1][lengths > 0]] = True
+    gap = np.zeros(size, dtype=bool)
+    gap[1:] = write_ms[1:] - write_ms[:-1] > gap_ms[series[1:]]
+    gap &= ~first
+    changed = np.zeros(size, dtype=bool)
+    changed[1:] = date_codes[1:] != date_codes[:-1]
+    changed &= ~first
+    # the first fetch is only kept if another one follows, like in the pairwise loop
+    kept = gap | changed | (first & (lengths[series] >= 2))
+
+    # in detail order: the end of the gap before a fetch, then the fetch
+    emitted = np.empty(2 * size, dtype=bool)
+    emitted[0::2], emitted[1::2] = gap, kept
+    emitted_idx = np.flatnonzero(emitted)
+    bounds = np.searchsorted(emitted_idx, 2 * offsets).tolist()
+
+    nonempty = lengths > 0
+    first_ms = write_ms[np.minimum(offsets[:-1], size - 1)]  # meaningless for the empty series
+    last_ms = write_ms[np.maximum(offsets[1:] - 1, 0)]
+    lead = (first_ms - ts_start_ms > 1).tolist()
+    tail = (ts_end_ms - last_ms > gap_ms).tolist()
+
+    write_times, codes = write_ms.tolist(), date_codes.tolist()
+    dates: Dict[Any, Any] = {}
+    result = []
+    for i, is_nonempty in enumerate(nonempty.tolist()):
+        if not is_nonempty:
+            result.append(None)
+            continue
+
+        available_dates = []
+        if lead[i]:
+            available_dates.append({'write_time': int(ts_start_ms[i]), 'available_date': None})
+        for j in emitted_idx[bounds[i]:bounds[i + 1]].tolist():
+            k = j >> 1
+            if j & 1:
+                code = codes[k]
+                if code not in dates:
+                    dates[code] = date_of(code)
+                available_dates.append({'write_time': write_times[k], 'available_date': dates[code]})
+            else:
+                available_dates.append({'write_time': write_times[k - 1] + MINUTE_MS, 'available_date': None})
+        if tail[i]:
+            available_dates.append({'write_time': write_times[offsets[i + 1] - 1] + MINUTE_MS, 'available_date': None})
+        result.append(available_dates)
+    return result
+
+
+def to_turning_points_batch(visa_statuses: Sequence[Optional[dict]], gap_ms: Sequence[int]) -> List[Optional[dict]]:
+    """ `VisaStatus.to_turning_points` of every result of `VisaStatus.find_visa_status_past24h`, the
+        gaps of the i-th one being above `gap_ms[i]` milliseconds.
+    """
+    fetches = [fetch for visa_status in visa_statuses if visa_status for fetch in visa_status['available_dates']]
+    offsets = np.zeros(len(visa_statuses) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(vs['available_dates']) if vs else 0 for vs in visa_statuses])
+
+    # equal dates share the code of their first occurrence
+    codes: Dict[Any, int] = {}
+    date_codes = np.fromiter(
+        map(codes.setdefault, map(itemgetter('available_date'), fetches), itertools.count()),
+        dtype=np.int64,
+        count=len(fetches),
+    )
+    date_lookup = {code: available_date for available_date, code in codes.items()}
+
+    time_ranges = [
+        [dt_to_utc(dt, remove_second=True) for dt in visa_status['time_range']] if visa_status else [0, 0]
+        for visa_status in visa_statuses
+    ]
+    available_dates = turning_points_of_arrays(
+        minute_ms(list(map(itemgetter('write_time'), fetches))),
+        date_codes,
+        offsets,
+        np.array([ts_start for ts_start, _ in time_ranges], dtype=np.int64),
+        np.array([ts_end for _, ts_end in time_ranges], dtype=np.int64),
+        np.asarray(gap_ms, dtype=np.int64),
+        date_lookup.__getitem__,
+    )
+    return [
+        None if adt is None else {**visa_status, 'time_range': time_range, 'available_dates': adt}
+        for visa_status, time_range, adt in zip(visa_statuses, time_ranges, available_dates)
+    ]
+
+
+def to_turning_points(visa_status: Optional[dict], gap_ms: int) -> Optional[dict]:
+    """ Turn the result of `VisaStatus.find_visa_status_past24h` into the visa status detail: the
+        missing minutes are filled in and the consecutive duplicates are removed. Two fetches more
+        than `gap_ms` milliseconds apart are separated by a gap. This is the reference of the
+        vectorized `to_turning_points_batch`.
+    """
+    if visa_status is None or len(visa_status['available_dates']) == 0:
+        return
+
+    def convert(dt: datetime):
+        return dt_to_utc(dt, remove_second=True)
+
+    available_dates = [{
+        'write_time': convert(i['write_time']),
+        'available_date': i['available_date'],
+    } for i in visa_status['available_dates']]
+    ts_start, ts_end = list(map(convert, visa_status['time_range']))
+    purified_available_dates = []
+
+    first_dp = available_dates[0]
+    if first_dp['write_time'] - ts_start > 1:
+        purified_available_dates = [{'write_time': ts_start, 'available_date': None}]
+
+    for i, (prev_dp, next_dp) in enumerate(zip(available_dates[:-1], available_dates[1:])):
+        if i == 0:
+            purified_available_dates.append(prev_dp)
+        if next_dp['write_time'] - prev_dp['write_time'] <= gap_ms:
+            if prev_dp['available_date'] == next_dp['available_date']:
+                continue
+            else:
+                purified_available_dates.append(next_dp)
+        else:
+            purified_available_dates.append({'write_time': prev_dp['write_time'] + 60000, 'available_date': None})
+            purified_available_dates.append(next_dp)
+
+    last_dp = available_dates[-1]
+    if ts_end - last_dp['write_time'] > gap_ms:
+        purified_available_dates.append({'write_time': last_dp['write_time'] + 60000, 'available_date': None})
+
+    return {
+        **visa_status,
+        'time_range': [ts_start, ts_end],
+        'available_dates': purified_available_dates,
+    }
+
+
+def series_step(
+    state: Optional[Tuple[datetime, datetime]],
+    minute: datetime,
+    available_date: datetime,
+    gap_seconds: int,
+) -> Tuple[Tuple[datetime, datetime], List[dict]]:
+    """ Advance the turning-point series by a successful fetch in `minute` (naive UTC). `state` is
+        the `(minute, earliest available date)` of the previous fetch, or None if it's unknown.
+        Return the new state and the points to append to the series:
+        - the earliest available date of the minute if it differs from the previous fetch,
+        - a gap `{minute after the previous fetch: None}` and the date if the previous fetch is
+          more than `gap_seconds` ago,
+        - the date of the first fetch of a UTC date or after an unknown state, so that the
+          document of every date knows the date in effect from its first fetch on.
+        A fetch older than the previous one is counted in the minute of the previous one.
+    """
+    new_point = {'write_time': minute, 'available_date': available_date}
+    if state is None:
+        return (minute, available_date), [new_point]
+
+    last_minute, last_date = state
+    if minute <= last_minute:  # another fetch of the same minute, keep the earliest date
+        available_date = min(last_date, available_date)
+        if available_date == last_date:
+            return state, []
+        return (last_minute, available_date), [{'write_time': last_minute, 'available_date': available_date}]
+
+    if (minute - last_minute).total_seconds() > gap_seconds:
+        return (minute, available_date), [
+            {'write_time': last_minute + timedelta(minutes=1), 'available_date': None},
+            new_point,
+        ]
+
+    if available_date != last_date or minute.date() != last_minute.date():
+        return (minute, available_date), [new_point]
+    return (minute, available_date), []
+
+
+def series_update(minute: datetime, points: List[dict]) -> dict:
+    """ Return the update of a `'turning_point'` document marking `minute` as fetched and appending `points`."""
+    minute_of_day = minute.hour * 60 + minute.minute
+    word, bit = divmod(minute_of_day, WORD_BITS)
+    update = {'$bit': {f'fetched.{word}': {'or': 1 << bit}}}
+    if len(points) > 0:
+        update['$push'] = {'points': {'$each': points}}
+    return update
+
+
+def fetched_minute_range(
+    docs: List[dict],
+    since_minute: datetime,
+    to_minute: datetime,
+) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """ Return the first and the last fetched minute of `(since_minute, to_minute]` in the bitmaps
+        of `'turning_point'` documents.
+    """
+    first = last = None
+    for doc in docs:
+        for word, bits in doc.get('fetched', {}).items():
+            word_start = doc['date'] + timedelta(minutes=int(word) * WORD_BITS)
+            low = max(0, int((since_minute - word_start).total_seconds() // 60) + 1)
+            high = min(WORD_BITS - 1, int((to_minute - word_start).total_seconds() // 60))
+            if low > high:
+                continue
+            bits &= ((1 << (high + 1)) - 1) & ~((1 << low) - 1)
+            if bits == 0:
+                continue
+
+            first_bit = word_start + timedelta(minutes=(bits & -bits).bit_length() - 1)
+            last_bit = word_start + timedelta(minutes=bits.bit_length() - 1)
+            first = first_bit if first is None else min(first, first_bit)
+            last = last_bit if last is None else max(last, last_bit)
+    return first, last
+
+
+def series_to_turning_points(
+    visa_type: str,
+    embassy_code: str,
+    docs: List[dict],
+    since_minute: datetime,
+    to_minute: datetime,
+    gap_seconds: int,
+) -> Optional[dict]:
+    """ Cut the visa status detail of the fetches in `(since_minute, to_minute]` out of the
+        `'turning_point'` documents of the dates of the range, in `date` order. The result is the
+        one of `to_turning_points` for the same fetches.
+    """
+    first, last = fetched_minute_range(docs, since_minute, to_minute)
+    if first is None:
+        return None
+
+    points = []  # the last point of a minute wins, it holds the earliest date of the minute
+    for doc in docs:
+        for point in doc.get('points', []):
+            if len(points) > 0 and points[-1]['write_time'] == point['write_time']:
+                points[-1] = point
+            else:
+                points.append(point)
+
+    available_date = None
+    for point in points:
+        if point['write_time'] > first:
+            break
+        available_date = point['available_date']
+
+    ts_start, ts_end = dt_to_utc(since_minute), dt_to_utc(to_minute)
+    available_dates = [{'write_time': ts_start, 'available_date': None}]  # the range starts after `since_minute`
+    if first < last:  # a lone fetch is not kept, like in the pairwise loop of `to_turning_points`
+        available_dates.append({'write_time': dt_to_utc(first), 'available_date': available_date})
+    for point in points:
+        if first < point['write_time'] <= last and point['available_date'] != available_date:
+            available_date = point['available_date']
+            available_dates.append(
+                {'write_time': dt_to_utc(point['write_time']), 'available_date': available_date}
+            )
+
+    if (to_minute - last).total_seconds() > gap_seconds:
+        available_dates.append({'write_time': dt_to_utc(last) + 60000, 'available_date': None})
+
+    return {
+        'visa_type': visa_type,
+        'embassy_code': embassy_code,
+        'time_range': [ts_start, ts_end],
+        'available_dates': available_dates,
+    }
@@ -6,8 +6,6 @@ from typing import Tuple
 from datetime import datetime, timezone
 from logging.handlers import TimedRotatingFileHandler
 
-import global_var as G
-
 CAMEL_CASE_REGEX = re.compile(r'(?<!^)(?=[A-Z])')
 
 
@@ -41,6 +39,8 @@ def construct_data_file_path(
     dt_str: str = datetime.now().strftime('%Y/%m/%d'),
 ) -> str:
     """ Construct data file path."""
+    import global_var as G  # the other helpers don't need the config files
+
     return os.path.join(G.DATA_PATH, visa_type, location, dt_str)
 
 
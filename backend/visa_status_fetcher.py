@@ -5,12 +5,14 @@
 import os
 import json
 import time
+import asyncio
+import signal
 import argparse
+import functools
 import traceback
 import threading
-from typing import List
-from queue import Queue
-from datetime import datetime
+from typing import Any, Callable, List, Optional
+from datetime import datetime, timezone
 
 import requests
 
@@ -18,7 +20,15 @@ import util
 import global_var as G
 import tuixue_mongodb as DB
 from notifier import Notifier
+from cache_events import CacheEvent, CacheEventListener, connect_publisher, connect_subscriber
+from scheduler import Job, Scheduler, ScheduleRule
 from session_operation import Session, SessionCache
+from subscription_index import SubscriptionEvent
+
+
+SCHEDULER = None
+CACHE_EVENTS = None
+SUBSCRIPTION_LISTENER = None
 
 
 def init():
@@ -37,8 +47,38 @@ def init():
         default=False,
         help='whether not to initiate the latest_written'
     )
+    parser.add_argument('--engine', type=str, default='thread', choices=['thread', 'async'], help='fetching engine')
+    parser.add_argument('--workers', type=int, default=128, help='number of threads running the fetching jobs')
+    parser.add_argument(
+        '--limit_per_node',
+        type=int,
+        default=32,
+        help='maximum concurrent requests per crawler node of the async engine'
+    )
+    parser.add_argument(
+        '--session_consumers',
+        type=int,
+        default=4,
+        help='number of threads requesting new sessions for the expired ones'
+    )
+    parser.add_argument(
+        '--flush_interval',
+        type=float,
+        default=0,
+        help='seconds between write-behind flushes of fetched results, 0 writes synchronously'
+    )
+    parser.add_argument(
+        '--cache_events',
+        type=str,
+        default=G.CACHE_EVENTS_TRANSPORT,
+        choices=['unix', 'none'],
+        help='how the API processes are told about the new fetched results'
+    )
     args = parser.parse_args()
 
+    if args.engine == 'async' and args.proxy is not None:
+        parser.error('the async engine doesn\'t support the socks5 --proxy')
+
     if not os.path.exists(args.log_dir):
         os.mkdir(args.log_dir)
 
@@ -53,6 +93,10 @@ def init():
         } if args.proxy is not None else None
     )
     G.assign('log_dir', args.log_dir)
+    G.assign('fetching_engine', args.engine)
+    G.assign('fetching_workers', args.workers)
+    G.assign('limit_per_node', args.limit_per_node)
+    G.assign('session_consumers', args.session_consumers)
     G.assign('log_name', f'{args.target}_{args.log_name}')
 
     if args.target.lower() == 'ais':
@@ -61,52 +105,116 @@ def init():
             for k, v in ais_accounts.items():
                 G.assign(k, v)
 
+    DB.create_indexes()
     if not args.noinit_lw:
         DB.VisaStatus.initiate_latest_written_sequential(args.target)
+    else:
+        DB.VisaStatus.load_latest_written_table(args.target)
+    DB.VisaStatus.initiate_turning_point_state()
 
     global LOGGER
     global SESSION_CACHE
     LOGGER = util.init_logger(f'{args.target}_{args.log_name}', args.log_dir, args.debug)
     SESSION_CACHE = SessionCache()
 
+    global CACHE_EVENTS
+    CACHE_EVENTS = connect_publisher(args.cache_events, G.CACHE_EVENTS_SOCKET_DIR, G.CACHE_EVENTS_HEARTBEAT, LOGGER)
+    index_subscriptions(args.cache_events)
+    if G.EMAIL_OUTBOX:
+        Notifier.enable_outbox(LOGGER)
+
+    if args.flush_interval > 0:
+        DB.VisaStatus.enable_write_behind(args.flush_interval, logger=LOGGER)
+        LOGGER.info('Write-behind enabled, flushing every %.1f seconds', args.flush_interval)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
     LOGGER.info('FETCHING TARGET: %s', args.target.upper())
 
 
-def set_fetching_interval(
-    visa_type: str,
-    location: str,
-    sys: str,
-    interval_sec: int,
-    first_run: bool = True
-):
-    """ Execute the fetching function every `interval` seconds
-        https://stackoverflow.com/questions/2697039/python-equivalent-of-setinterval
+def index_subscriptions(transport: str) -> None:
+    """ Find the subscribers to notify in memory, the index is kept current by the subscription
+        events of the API. Listening starts before the index is built, and the index is rebuilt
+        when the first datagram of an API process arrives: the edits it published before finding
+        the socket of this fetcher are unknown.
     """
-    def function_wrapper():
-        set_fetching_interval(visa_type, location, sys, interval_sec, first_run=False)
-        VisaFetcher.fetch_visa_status(
-            visa_type,
-            location,
-            G.value(f'{visa_type}_requests_Session', requests.Session())
+    global SUBSCRIPTION_LISTENER
+    subscriber = connect_subscriber(transport, G.SUBSCRIPTION_EVENTS_SOCKET_DIR, SubscriptionEvent)
+    DB.Subscription.enable_index(LOGGER)
+    if subscriber is not None:
+        SUBSCRIPTION_LISTENER = CacheEventListener(
+            subscriber,
+            lambda events: DB.Subscription.reload_index([event.email for event in events]),
+            DB.Subscription.rebuild_index,
+            logger=LOGGER,
         )
+        SUBSCRIPTION_LISTENER.start()
 
-    emb = G.USEmbassy.get_embassy_by_loc(location)
-    now_minute = datetime.now().minute
-    if sys == 'cgi' and visa_type == "F" and 47 <= now_minute < 49 and emb.region == 'DOMESTIC' and emb.code not in ['hk', 'hkr', 'tp']:
-        interval = 5
-    else:
-        interval = interval_sec
 
-    fetching_thread = threading.Timer(interval, function_wrapper)
-    fetching_thread.start()
+def rebuild_subscription_index() -> None:
+    """ Reload the subscription index periodically when the API can't tell about the edits."""
+    while True:
+        time.sleep(G.SUBSCRIPTION_INDEX_REBUILD_INTERVAL)
+        try:
+            DB.Subscription.rebuild_index()
+        except Exception:
+            LOGGER.exception('Failed to rebuild the subscription index')
+
+
+def shutdown(signum, frame):
+    """ Flush the queued writes before exiting, the fetching timers never finish by themselves."""
+    LOGGER.warning('Receive signal %d, shutting down...', signum)
+    if SCHEDULER is not None:
+        SCHEDULER.stop(wait=False)
+    DB.VisaStatus.disable_write_behind()
+    os._exit(0)
+
+
+def in_f_visa_burst(now: datetime) -> bool:
+    """ Domestic posts release F visa slots around the top of the hour."""
+    return 47 <= now.minute < 49
 
-    if first_run:  # execute fecthing without waiting for the first time.
-        VisaFetcher.fetch_visa_status(
-            visa_type,
-            location,
-            G.value(f'{visa_type}_requests_Session', requests.Session())
-        )
-    return fetching_thread
+
+def is_f_visa_burst_target(job: Job) -> bool:
+    """ CGI F visa of domestic posts, except Hong Kong and Taipei."""
+    emb = G.USEmbassy.get_embassy_by_loc(job.attrs['location'])
+    return (
+        job.attrs['sys'] == 'cgi' and job.attrs['visa_type'] == 'F' and
+        emb.region == 'DOMESTIC' and emb.code not in ['hk', 'hkr', 'tp']
+    )
+
+
+SCHEDULE_RULES = [
+    ScheduleRule('F visa burst', interval_sec=5, match=is_f_visa_burst_target, active=in_f_visa_burst),
+]
+
+
+def fetch_visa_status_job(visa_type: str, location: str):
+    """ The job scheduled for every (visa_type, location) pair."""
+    VisaFetcher.fetch_visa_status(
+        visa_type,
+        location,
+        G.value(f'{visa_type}_requests_Session', requests.Session())
+    )
+
+
+def fetching_jobs(sys: str, fetch: Callable[[str, str], Any]) -> List[Job]:
+    """ Return a job calling `fetch(visa_type, location)` for every (visa_type, location) pair."""
+    jobs = []
+    for visa_type, interval_sec in G.FETCH_TIME_INTERVAL[sys].items():
+        for location in G.SYS_LOCATION[sys]:
+            if location[-1] == 'u' and sys == 'cgi' and visa_type != 'F':
+                continue
+            jobs.append(Job(
+                f'{visa_type}-{location}',
+                functools.partial(fetch, visa_type, location),
+                interval_sec,
+                visa_type=visa_type,
+                location=location,
+                sys=sys,
+            ))
+    return jobs
 
 
 def start_threads():
@@ -115,22 +223,39 @@ def start_threads():
     VisaFetcher.check_crawler_server_connection()
 
     LOGGER.info('Starting threads...')
-    LOGGER.info('Setting up session update consumer...')
-    session_update_consumer = threading.Thread(target=VisaFetcher.consume_new_session_request)
-    session_update_consumer.start()
+    LOGGER.info('Setting up session update consumers...')
+    for i in range(G.value('session_consumers', 4)):
+        session_update_consumer = threading.Thread(
+            target=VisaFetcher.consume_new_session_request,
+            name=f'session_update_{i}',
+        )
+        session_update_consumer.start()
+
+    if SUBSCRIPTION_LISTENER is None:
+        threading.Thread(target=rebuild_subscription_index, name='subscription_index', daemon=True).start()
 
     LOGGER.info('Setting interval for fetching visa status...')
     sys = G.value('target_system', None)
-    thread_pool = []
-    for visa_type, interval_sec in G.FETCH_TIME_INTERVAL[sys].items():
-        for location in G.SYS_LOCATION[sys]:
-            if location[-1] == 'u' and sys == 'cgi' and visa_type != 'F':
-                continue
-            thread_pool.append(set_fetching_interval(visa_type, location, sys, interval_sec))
-    LOGGER.info('Fetching threads start, %s threads in total', len(thread_pool))
-
-    for thread in thread_pool:
-        thread.join()
+    global SCHEDULER
+    if G.value('fetching_engine', 'thread') == 'async':
+        from async_fetcher import AsyncFetchEngine  # aiohttp is only needed by the async engine
+
+        SCHEDULER = AsyncFetchEngine(
+            VisaFetcher,
+            SESSION_CACHE,
+            SCHEDULE_RULES,
+            limit_per_node=G.value('limit_per_node', 32),
+            logger=LOGGER,
+        )
+        jobs = fetching_jobs(sys, SCHEDULER.fetch_visa_status)
+        threading.Thread(target=asyncio.run, args=(SCHEDULER.run(jobs),), name='async_fetching').start()
+        LOGGER.info('Async fetching engine starts, %s jobs in total', len(jobs))
+    else:
+        SCHEDULER = Scheduler(G.value('fetching_workers', 128), SCHEDULE_RULES, LOGGER)
+        for job in fetching_jobs(sys, fetch_visa_status_job):
+            SCHEDULER.add_job(job)
+        SCHEDULER.start()
+        LOGGER.info('Fetching scheduler starts, %s jobs in total', len(SCHEDULER.heap))
 
 
 def change_crawler_server():
@@ -138,6 +263,19 @@ def change_crawler_server():
     while True:
         time.sleep(600)
         VisaFetcher.check_crawler_server_connection()
+        LOGGER.info('Fetching stats: %s', SCHEDULER.stats())
+        LOGGER.info('Session update stats: %s', SESSION_CACHE.update_queue.stats())
+        if DB.VisaStatus.write_behind is not None:
+            LOGGER.info('Write-behind stats: %s', DB.VisaStatus.write_behind.stats())
+        if CACHE_EVENTS is not None:
+            LOGGER.info('Cache event stats: %s', CACHE_EVENTS.stats())
+        if SUBSCRIPTION_LISTENER is not None:
+            LOGGER.info('Subscription event stats: %s', SUBSCRIPTION_LISTENER.stats())
+        LOGGER.info('Subscription index stats: %s', DB.Subscription.index.stats())
+        if Notifier.outbox is not None:
+            LOGGER.info('Email outbox stats: %s', Notifier.outbox.stats())
+        if Notifier.chat_notifier is not None:
+            LOGGER.info('Chat notifier stats: %s', Notifier.chat_notifier.stats())
 
 
 class VisaFetcher:
@@ -151,7 +289,7 @@ class VisaFetcher:
         embassy = G.USEmbassy.get_embassy_by_loc(location)
 
         # decide if a notification should be send BEFORE writing the new data into file
-        latest_written_lst = DB.VisaStatus.find_latest_written_visa_status(visa_type, embassy.code)
+        latest_written_lst = DB.VisaStatus.find_latest_written_visa_status_in_memory(visa_type, embassy.code)
 
         try:
             LOGGER.debug(
@@ -161,11 +299,11 @@ class VisaFetcher:
                 location,
                 available_date
             )
-            writting_start = datetime.now()
+            writting_start = write_time = datetime.now()
             DB.VisaStatus.save_fetched_visa_status(
                 visa_type=visa_type,
                 embassy_code=embassy.code,
-                write_time=datetime.now(),
+                write_time=write_time,
                 available_date=available_date
             )
             writting_finish = datetime.now()
@@ -180,6 +318,10 @@ class VisaFetcher:
                 available_date
             )
             LOGGER.debug('WRITTING TAKES %f seconds', (writting_finish - writting_start).total_seconds())
+            if CACHE_EVENTS is not None:
+                VisaFetcher.publish_cache_event(
+                    visa_type, embassy.code, write_time, available_date, latest_written_lst
+                )
 
         sent_notification = Notifier.notify_visa_status_change(visa_type, embassy, available_date, latest_written_lst)
         if sent_notification:
@@ -191,6 +333,28 @@ class VisaFetcher:
                 available_date
             )
 
+    @staticmethod
+    def publish_cache_event(
+        visa_type: str,
+        embassy_code: str,
+        write_time: datetime,
+        available_date: Optional[datetime],
+        latest_written_lst: List[dict],
+    ):
+        """ Tell the API processes about a fetched result once it's written to the database. The
+            overview is unchanged if the same date was written last time on the same embassy-local date,
+            or if no date was fetched.
+        """
+        write_time = write_time.astimezone(tz=timezone.utc).replace(tzinfo=None)  # naive UTC like in MongoDB
+        overview_changed = available_date is not None
+        if available_date is not None and len(latest_written_lst) > 0 \
+                and latest_written_lst[0]['available_date'] == available_date:
+            previous_write_date = DB.VisaStatus.embassy_write_date(embassy_code, latest_written_lst[0]['write_time'])
+            overview_changed = previous_write_date != DB.VisaStatus.embassy_write_date(embassy_code, write_time)
+
+        event = CacheEvent(visa_type, embassy_code, write_time, overview_changed, available_date)
+        DB.VisaStatus.after_written(functools.partial(CACHE_EVENTS.publish, event), (visa_type, embassy_code))
+
     @staticmethod
     def check_crawler_server_connection():
         """ Check the connection of all the crawler server.
@@ -242,7 +406,7 @@ class VisaFetcher:
         else:
             embassyLst = [embassy]
         for embassy in embassyLst:
-            latest_written = DB.VisaStatus.find_latest_written_visa_status(visa_type, embassy.code)
+            latest_written = DB.VisaStatus.find_latest_written_visa_status_in_memory(visa_type, embassy.code)
             avai_dt = None if len(latest_written) < 1 else latest_written[0]['available_date']
             cls.save_fetched_data(
                 visa_type,
@@ -250,6 +414,82 @@ class VisaFetcher:
                 [0, 0, 0] if avai_dt is None else [avai_dt.year, avai_dt.month, avai_dt.day]
             )
 
+    @staticmethod
+    def refresh_endpoint(location: str, session: Session) -> str:
+        """ Return the crawler endpoint refreshing a session."""
+        if session.sys == 'ais':
+            return G.CRAWLER_API['refresh']['ais'].format(location, session.schedule_id, session.session)
+        elif session.sys == 'cgi':
+            return G.CRAWLER_API['refresh']['cgi'].format(session.session)
+
+    @classmethod
+    def handle_refresh_timeout(cls, visa_type: str, location: str, now: str):
+        """ The crawler server doesn't answer in `WAIT_TIME['refresh']` seconds."""
+        LOGGER.warning('%s, %s, %s, FAILED - Endpoint Timeout.', now, visa_type, location)
+        cls.save_placeholder_at_exception(visa_type, location)
+        cls.check_crawler_server_connection()
+
+    @classmethod
+    def handle_refresh_connection_error(cls, visa_type: str, location: str, now: str):
+        """ The connection to the crawler server is aborted."""
+        LOGGER.warning('%s, %s, %s, FAILED - Endpoint Connection Aborted.', now, visa_type, location)
+        cls.check_crawler_server_connection()
+
+    @classmethod
+    def handle_refresh_response(
+        cls,
+        visa_type: str,
+        location: str,
+        session: Session,
+        endpoint: str,
+        now: str,
+        status_code: int,
+        result: Optional[dict],
+    ):
+        """ Save the fetched result, or request a new session if the current one is expired.
+            `result` is the parsed JSON body, it's only read when `status_code` is 200.
+        """
+        if status_code != 200:
+            LOGGER.warning('%s, %s, %s, FAILED - %d', now, visa_type, location, status_code)
+            cls.check_crawler_server_connection()
+            return
+
+        LOGGER.debug('fetch_visa_status - Endpoint: %s | Response json: %s', endpoint, json.dumps(result))
+
+        if result['code'] != 0:  # code == 0 stands for success in crawler api code
+            LOGGER.warning('%s, %s, %s, FAILED - Session Expired', now, visa_type, location)
+
+            # session expired will trigger database update using the last successful fetch result
+            cls.save_placeholder_at_exception(visa_type, location)
+
+            SESSION_CACHE.produce_new_session_request(visa_type, location, session)
+            return
+
+        if session.sys == 'cgi':
+            dt_segments = [int(dt_seg) for dt_seg in result['msg'].split('-')]
+            cls.save_fetched_data(visa_type, location, dt_segments)
+            LOGGER.info('%s, %s, %s, SUCCESS - %d/%d/%d', now, visa_type, location, *dt_segments)
+
+        elif session.sys == 'ais':
+            date_lst = result['msg']
+            for city, dt_segments in date_lst:
+                if city in G.AIS_MONITORING_CITY:
+                    cls.save_fetched_data(visa_type, city, dt_segments)
+                    LOGGER.info(
+                        '%s, %s, %s, %s, SUCCESS - %d/%d/%d',
+                        now,
+                        visa_type,
+                        location,
+                        city,
+                        *dt_segments
+                    )
+
+            new_session = Session(
+                session=(result['session'], session.schedule_id),
+                sys=session.sys
+            )
+            SESSION_CACHE.replace_session(visa_type, location, session, new_session)
+
     @classmethod
     def fetch_visa_status(cls, visa_type: str, location: str, req: requests.Session):
         """ Fetch the latest visa status available from crawler server."""
@@ -260,75 +500,28 @@ class VisaFetcher:
                 LOGGER.warning('%s, %s, %s, FAILED - No Session', now, visa_type, location)
                 return
 
-            if session.sys == 'ais':
-                endpoint = G.CRAWLER_API['refresh']['ais'].format(location, session.schedule_id, session.session)
-            elif session.sys == 'cgi':
-                endpoint = G.CRAWLER_API['refresh']['cgi'].format(session.session)
-
+            endpoint = cls.refresh_endpoint(location, session)
             url = '{}{}'.format(G.value('current_crawler_node', ''), endpoint)
             try:
                 res = req.get(url, timeout=G.WAIT_TIME['refresh'], proxies=G.value('proxies', None))
             except requests.exceptions.Timeout:
-                LOGGER.warning('%s, %s, %s, FAILED - Endpoint Timeout.', now, visa_type, location)
-                cls.save_placeholder_at_exception(visa_type, location)
-                cls.check_crawler_server_connection()
-                return
+                cls.handle_refresh_timeout(visa_type, location, now)
             except requests.exceptions.ConnectionError:
-                LOGGER.warning('%s, %s, %s, FAILED - Endpoint Connection Aborted.', now, visa_type, location)
-                cls.check_crawler_server_connection()
-                return
+                cls.handle_refresh_connection_error(visa_type, location, now)
             else:
-                if res.status_code != 200:
-                    LOGGER.warning('%s, %s, %s, FAILED - %d', now, visa_type, location, res.status_code)
-                    cls.check_crawler_server_connection()
-                    return
-
-                result = res.json()
-                LOGGER.debug('fetch_visa_status - Endpoint: %s | Response json: %s', endpoint, json.dumps(result))
-
-                if result['code'] != 0:  # code == 0 stands for success in crawler api code
-                    LOGGER.warning('%s, %s, %s, FAILED - Session Expired', now, visa_type, location)
-
-                    # session expired will trigger database update using the last successful fetch result
-                    cls.save_placeholder_at_exception(visa_type, location)
-
-                    SESSION_CACHE.produce_new_session_request(visa_type, location, session)
-                    return
-
-                if session.sys == 'cgi':
-                    dt_segments = [int(dt_seg) for dt_seg in result['msg'].split('-')]
-                    cls.save_fetched_data(visa_type, location, dt_segments)
-                    LOGGER.info('%s, %s, %s, SUCCESS - %d/%d/%d', now, visa_type, location, *dt_segments)
-
-                elif session.sys == 'ais':
-                    date_lst = result['msg']
-                    for city, dt_segments in date_lst:
-                        if city in G.AIS_MONITORING_CITY:
-                            cls.save_fetched_data(visa_type, city, dt_segments)
-                            LOGGER.info(
-                                '%s, %s, %s, %s, SUCCESS - %d/%d/%d',
-                                now,
-                                visa_type,
-                                location,
-                                city,
-                                *dt_segments
-                            )
-
-                    new_session = Session(
-                        session=(result['session'], session.schedule_id),
-                        sys=session.sys
-                    )
-                    SESSION_CACHE.replace_session(visa_type, location, session, new_session)
+                result = res.json() if res.status_code == 200 else None
+                cls.handle_refresh_response(visa_type, location, session, endpoint, now, res.status_code, result)
 
         except Exception:
             LOGGER.error(traceback.format_exc())
 
     @classmethod
-    def consume_new_session_request(cls, task_queue: Queue = G.SESSION_UPDATE_QUEUE):
+    def consume_new_session_request(cls):
         """ Consume the session update event in the task queue to request new session
-            from crawler server.
+            from crawler server. Several consumers run concurrently, see `--session_consumers`.
         """
         LOGGER.info('Listening to session update request task queue...')
+        task_queue = SESSION_CACHE.update_queue
         while True:
             visa_type, location, session = task_queue.get()
             LOGGER.debug(
@@ -337,84 +530,92 @@ class VisaFetcher:
                 location,
                 task_queue.qsize()
             )
+            try:
+                cls.request_new_session(visa_type, location, session)
+            finally:
+                task_queue.done(visa_type, location, session)
 
-            if session is None:
-                LOGGER.error('A session object from %s-%s is NoneType', visa_type, location)  # just in case
+    @classmethod
+    def request_new_session(cls, visa_type: str, location: str, session: Session):
+        """ Request a new session from crawler server to replace an expired one."""
+        if session is None:
+            LOGGER.error('A session object from %s-%s is NoneType', visa_type, location)  # just in case
 
-            if not SESSION_CACHE.contain_session(visa_type, location, session):
-                LOGGER.debug('Session %s is no longer in the %s-%s session list.', session, visa_type, location)
-                continue
+        if not SESSION_CACHE.contain_session(visa_type, location, session):
+            LOGGER.debug('Session %s is no longer in the %s-%s session list.', session, visa_type, location)
+            return
+
+        try:
+            if session.sys == 'ais':
+                email = G.value(f'ais_email_{visa_type}', None)
+                password = G.value(f'ais_pswd_{visa_type}', None)
 
+                LOGGER.debug('Fetching new session for AIS: %s, %s, %s', location, email, password)
+                endpoint = G.CRAWLER_API['register']['ais'].format(location, email, password)
+                if email is None or password is None:
+                    return
+            elif session.sys == 'cgi':
+                endpoint = G.CRAWLER_API['register']['cgi'].format(visa_type, location)
+
+            url = '{}{}'.format(G.value('current_crawler_node', ''), endpoint)
+            res = requests.get(url, timeout=G.WAIT_TIME['register'], proxies=G.value('proxies', None))
             try:
-                if session.sys == 'ais':
-                    email = G.value(f'ais_email_{visa_type}', None)
-                    password = G.value(f'ais_pswd_{visa_type}', None)
-
-                    LOGGER.debug('Fetching new session for AIS: %s, %s, %s', location, email, password)
-                    endpoint = G.CRAWLER_API['register']['ais'].format(location, email, password)
-                    if email is None or password is None:
-                        continue
-                elif session.sys == 'cgi':
-                    endpoint = G.CRAWLER_API['register']['cgi'].format(visa_type, location)
-
-                url = '{}{}'.format(G.value('current_crawler_node', ''), endpoint)
-                res = requests.get(url, timeout=G.WAIT_TIME['register'], proxies=G.value('proxies', None))
-                try:
-                    result = res.json()
-                except ValueError:
-                    content = res.content.decode()
-                    if 'Server Error (500)' in content:
-                        SESSION_CACHE.mark_unavailable(visa_type, location)
-                    else:
-                        print(time.asctime(), visa_type, location, content)
-                    continue
-                LOGGER.debug(
-                    'consume_new_session_request - Endpoint: %s | Response json: %s',
-                    endpoint,
-                    json.dumps(result)
+                result = res.json()
+            except ValueError:
+                content = res.content.decode()
+                if 'Server Error (500)' in content:
+                    SESSION_CACHE.mark_unavailable(visa_type, location)
+                else:
+                    LOGGER.warning('%s, %s, %s, FAILED - Not a JSON response: %s',
+                                   datetime.now().strftime('%H:%M:%S'), visa_type, location, content[:200])
+                return
+            LOGGER.debug(
+                'consume_new_session_request - Endpoint: %s | Response json: %s',
+                endpoint,
+                json.dumps(result)
+            )
+
+            if result['code'] != 0:
+                LOGGER.warning(
+                    '%s, %s, %s, FAILED - %s',
+                    datetime.now().strftime('%H:%M:%S'),
+                    visa_type,
+                    location,
+                    result['msg']
                 )
+                if result['msg'] == "Network Error":
+                    SESSION_CACHE.mark_unavailable(visa_type, location)
+                else:
+                    cls.check_crawler_server_connection()
+                return
 
-                if result['code'] != 0:
-                    LOGGER.warning(
-                        '%s, %s, %s, FAILED - %s',
-                        datetime.now().strftime('%H:%M:%S'),
-                        visa_type,
-                        location,
-                        result['msg']
-                    )
-                    if result['msg'] == "Network Error":
-                        SESSION_CACHE.mark_unavailable(visa_type, location)
-                    else:
-                        cls.check_crawler_server_connection()
-                    continue
-
-                # Generate new session object and update cache
-                if session.sys == 'ais':
-                    new_session = Session((result['session'], result['id']), sys='ais')
-                    date_available = bool(len(result['msg']))
-                elif session.sys == 'cgi':
-                    new_session = Session(result['session'], sys='cgi')
-                    date_available = bool(tuple([dt_seg for dt_seg in result['msg'].split('-')]))  # Always True
-
-                if date_available:  # why this flag is needed?
-                    LOGGER.info(
-                        'consume_new_session_request - %s, %s, %s, SUCCESS - %s',
-                        datetime.now().strftime('%H:%M:%S'),
-                        visa_type,
-                        location,
-                        result['msg']
-                    )
-                    SESSION_CACHE.replace_session(visa_type, location, session, new_session)
-            except requests.exceptions.ReadTimeout:
-                LOGGER.debug(
-                    'consume_new_session_request - request time out for endpoint: %s | %s-%s',
-                    endpoint,
+            # Generate new session object and update cache
+            if session.sys == 'ais':
+                new_session = Session((result['session'], result['id']), sys='ais')
+                date_available = bool(len(result['msg']))
+            elif session.sys == 'cgi':
+                new_session = Session(result['session'], sys='cgi')
+                date_available = bool(tuple([dt_seg for dt_seg in result['msg'].split('-')]))  # Always True
+
+            if date_available:  # why this flag is needed?
+                LOGGER.info(
+                    'consume_new_session_request - %s, %s, %s, SUCCESS - %s',
+                    datetime.now().strftime('%H:%M:%S'),
                     visa_type,
-                    location
+                    location,
+                    result['msg']
                 )
-                cls.check_crawler_server_connection()
-            except Exception:
-                LOGGER.error('an unexpected error occured', traceback.format_exc())
+                SESSION_CACHE.replace_session(visa_type, location, session, new_session)
+        except requests.exceptions.ReadTimeout:
+            LOGGER.debug(
+                'consume_new_session_request - request time out for endpoint: %s | %s-%s',
+                endpoint,
+                visa_type,
+                location
+            )
+            cls.check_crawler_server_connection()
+        except Exception:
+            LOGGER.error('an unexpected error occured', traceback.format_exc())
 
 
 if __name__ == "__main__":
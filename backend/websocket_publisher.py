@@ -0,0 +1,130 @@
+""" A long-lived WebSocket connection from the fetcher to the websocket service, sending the
+    status changes in batches.
+"""
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Deque, List, Optional, Tuple
+
+import websockets
+
+
+class WebSocketPublisher:
+    """ Send the published JSON-able objects to `url` in batches of at most `batch_size`, after
+        waiting `linger` seconds for a burst to complete. At most `max_buffer` objects wait to be
+        sent.
+    """
+    def __init__(
+        self,
+        url: str,
+        max_buffer: int = 1024,
+        batch_size: int = 128,
+        linger: float = 0.05,
+        reconnect_delay: Tuple[float, float] = (1, 60),
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.url = url
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.linger = linger
+        self.reconnect_delay = reconnect_delay
+        self.logger = logger or logging.getLogger('websocket_publisher')
+
+        self.buffer: Deque[Any] = deque(maxlen=max_buffer)
+        self.loop = asyncio.new_event_loop()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.ws = None
+
+        # metrics
+        self.published_cnt = 0
+        self.sent_cnt = 0
+        self.batch_cnt = 0
+        self.dropped_cnt = 0
+        self.connect_cnt = 0
+        self.connect_failure_cnt = 0
+
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='websocket_publisher', daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def publish(self, data: Any) -> None:
+        """ Queue a JSON-able object, from any thread. Never blocks."""
+        if len(self.buffer) == self.max_buffer:  # the append pushes out the oldest one
+            self.dropped_cnt += 1
+        self.buffer.append(data)
+        self.published_cnt += 1
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.wakeup = asyncio.Event()
+        self.loop.call_soon(self.started.set)
+        self.loop.run_until_complete(self.send_forever())
+
+    async def connect(self) -> None:
+        """ Connect, retrying with exponential backoff until it succeeds."""
+        delay, longest = self.reconnect_delay
+        while self.ws is None:
+            try:
+                self.ws = await websockets.connect(self.url)
+                self.connect_cnt += 1
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                self.connect_failure_cnt += 1
+                self.logger.warning('Failed to connect the websocket service, retry in %.0fs: %r', delay, e)
+                await asyncio.sleep(delay)
+                delay = min(longest, delay * 2)
+
+    async def send_forever(self) -> None:
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await asyncio.sleep(self.linger)  # the rest of the burst
+            while len(self.buffer) > 0:
+                await self.connect()
+                batch = self.take_batch()
+                try:
+                    await self.ws.send(json.dumps(batch))
+                except (OSError, websockets.exceptions.WebSocketException) as e:
+                    self.logger.warning('Lost the websocket connection: %r', e)
+                    # back in front of the newer ones, the oldest are dropped if there's no room left
+                    kept = batch[len(batch) - min(len(batch), self.max_buffer - len(self.buffer)):]
+                    self.dropped_cnt += len(batch) - len(kept)
+                    self.buffer.extendleft(reversed(kept))
+                    self.ws = None
+                    continue
+                self.sent_cnt += len(batch)
+                self.batch_cnt += 1
+
+    def take_batch(self) -> List[Any]:
+        batch = []
+        while len(self.buffer) > 0 and len(batch) < self.batch_size:
+            batch.append(self.buffer.popleft())
+        return batch
+
+    def close(self, timeout: float = 5) -> None:
+        """ Send what is buffered within `timeout` seconds, then close the connection."""
+        async def closing():
+            if self.ws is not None:
+                ws, self.ws = self.ws, None
+                await ws.close()
+
+        deadline = time.monotonic() + timeout
+        while len(self.buffer) > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        asyncio.run_coroutine_threadsafe(closing(), self.loop).result(timeout)
+
+    def stats(self) -> dict:
+        return {
+            'connected': self.ws is not None,
+            'buffered': len(self.buffer),
+            'published_cnt': self.published_cnt,
+            'sent_cnt': self.sent_cnt,
+            'batch_cnt': self.batch_cnt,
+            'dropped_cnt': self.dropped_cnt,
+            'connect_cnt': self.connect_cnt,
+            'connect_failure_cnt': self.connect_failure_cnt,
+        }
@@ -1,13 +1,19 @@
 """ Test suite for websocket feature in the FastAPI backend."""
 import json
+import time
 import enum
+import random
+import socket
 import asyncio
 import logging
 import argparse
+import requests
 import websockets
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple
+from urllib.parse import urlparse
 from fastapi.encoders import jsonable_encoder
-from global_var import SECRET
+from global_var import SECRET, VISA_TYPES, WEBSOCKET_SEND_TIMEOUT, USEmbassy
 from util import init_logger
 
 LOGGER: logging.Logger = init_logger('websocket_test', './logs', True)
@@ -16,6 +22,7 @@ LOGGER: logging.Logger = init_logger('websocket_test', './logs', True)
 class Role(str, enum.Enum):
     client: str = 'client'
     notifier: str = 'notifier'
+    querier: str = 'querier'
 
 
 async def connect_ws(role: Role):
@@ -43,6 +50,244 @@ async def connect_ws(role: Role):
                 LOGGER.debug('[role: client] Websocket %s received msg | Timestamp: %s', str(ws.local_address), msg)
 
 
+async def query_ws(alive_time: float, round_trips: list):
+    """ Query the newest visa status over and over, record the round trip time of every query."""
+    ws_url = SECRET['websocket_url']
+    embassy_codes = [emb.code for emb in USEmbassy.get_embassy_lst()]
+    deadline = time.monotonic() + alive_time
+    async with websockets.connect(ws_url, ssl=True) as ws:
+        LOGGER.debug('[role: querier] Websocket connected: %s', str(ws.local_address))
+        while time.monotonic() < deadline:
+            query = [random.choice(VISA_TYPES), random.sample(embassy_codes, 4)]
+            start = time.monotonic()
+            await ws.send(json.dumps(query))
+            while json.loads(await ws.recv()).get('type') != 'newest':  # skip the notifications
+                pass
+            round_trips.append(time.monotonic() - start)
+
+
+async def load_test_query(load: int, alive_time: float):
+    """ Load test with `load` websockets querying concurrently. Print the round trip time of the
+        queries and the lag of the event loop of the server, which should stay flat whatever the
+        load if the queries don't block the loop.
+    """
+    round_trips = []
+    await asyncio.gather(
+        *[asyncio.wait_for(query_ws(alive_time, round_trips), alive_time + 30) for _ in range(load)],
+        return_exceptions=True,
+    )
+    round_trips.sort()
+    if len(round_trips) > 0:
+        print('{} queries, round trip mean/p95/max: {:.4f}/{:.4f}/{:.4f} seconds'.format(
+            len(round_trips),
+            sum(round_trips) / len(round_trips),
+            round_trips[int(0.95 * (len(round_trips) - 1))],
+            round_trips[-1],
+        ))
+
+    # the recent samples of the loop lag, i.e. the ones taken during the test
+    loop_lag_url = SECRET['websocket_url'].replace('ws', 'http', 1)\
+        .replace('/visastatus/latest', '/visastatus/loop_lag')
+    print('Server event loop lag:', requests.get(loop_lag_url).json())
+
+
+async def interested_client(
+    interest: Tuple[str, List[str]],
+    received: list,
+    ready: list,
+    done: asyncio.Event,
+    handshakes: asyncio.Semaphore,
+):
+    """ Register an interest, then record the notifications received until `done`."""
+    ws_url = SECRET['websocket_url']
+    visa_type, embassy_codes = interest
+    async with handshakes:  # thousands of simultaneous handshakes time out
+        ws = await websockets.connect(ws_url, max_queue=None)
+        await ws.send(json.dumps({'type': 'interest', 'visa_type': [visa_type], 'embassy_code': embassy_codes}))
+        while json.loads(await ws.recv()).get('type') != 'interest':
+            pass
+    async with ws:
+        ready.append(True)
+        while not done.is_set():
+            try:
+                msg = json.loads(await asyncio.wait_for(ws.recv(), 0.5))
+            except asyncio.TimeoutError:
+                continue
+            if msg.get('type') == 'notification':
+                received.append((time.monotonic(), msg['data']))
+
+
+async def load_test_interest(load: int, events: int, embassies_per_client: int = 4):
+    """ Load test of the filtered fan-out: `load` clients register an interest in one visa type at
+        `embassies_per_client` embassies, then a notifier publishes `events` status changes of random
+        embassies in batches. Check that every client gets exactly the changes it's interested in,
+        and print the delivery latency and the lag of the event loop of the server.
+    """
+    embassy_codes = [emb.code for emb in USEmbassy.get_embassy_lst()]
+    interests = [(random.choice(VISA_TYPES), random.sample(embassy_codes, embassies_per_client)) for _ in range(load)]
+    received = [[] for _ in range(load)]
+    ready, done, handshakes = [], asyncio.Event(), asyncio.Semaphore(128)
+    clients = [
+        asyncio.create_task(interested_client(interest, received[i], ready, done, handshakes))
+        for i, interest in enumerate(interests)
+    ]
+    while len(ready) < load and not all(client.done() for client in clients):
+        await asyncio.sleep(0.1)
+    print(f'{len(ready)} clients registered')
+
+    ws_url, ws_token = SECRET['websocket_url'], SECRET['websocket_token']
+    changes, sent_at = [], {}
+    start_date = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    async with websockets.connect(f'{ws_url}?token={ws_token}') as ws:
+        for i in range(events):
+            changes.append({
+                'visa_type': random.choice(VISA_TYPES),
+                'embassy_code': random.choice(embassy_codes),
+                'prev_avai_date': None,
+                'curr_avai_date': start_date + timedelta(days=i),  # identifies the change
+            })
+        for i in range(0, events, 16):
+            batch = jsonable_encoder(changes[i:i + 16])
+            for change in batch:
+                sent_at[change['curr_avai_date']] = time.monotonic()
+            await ws.send(json.dumps(batch))
+            await asyncio.sleep(0.05)
+
+    await asyncio.sleep(5)
+    done.set()
+    await asyncio.gather(*clients, return_exceptions=True)
+
+    latencies, mismatched = [], 0
+    for (visa_type, embassy_codes_of_client), client_received in zip(interests, received):
+        expected = [
+            change for change in jsonable_encoder(changes)
+            if change['visa_type'] == visa_type and change['embassy_code'] in embassy_codes_of_client
+        ]
+        mismatched += [data for _, data in client_received] != expected
+        latencies.extend(at - sent_at[data['curr_avai_date']] for at, data in client_received)
+    latencies.sort()
+    print(f'{len(latencies)} notifications, {mismatched} clients not getting exactly their changes')
+    if len(latencies) > 0:
+        print('delivery latency mean/p95/max: {:.4f}/{:.4f}/{:.4f} seconds'.format(
+            sum(latencies) / len(latencies),
+            latencies[int(0.95 * (len(latencies) - 1))],
+            latencies[-1],
+        ))
+    stats_url = ws_url.replace('ws', 'http', 1).replace('/visastatus/latest', '/visastatus/{}')
+    print('Server event loop lag:', requests.get(stats_url.format('loop_lag')).json())
+    print('Broadcast:', requests.get(stats_url.format('broadcast')).json())
+
+
+async def slow_client(ready: list, done: asyncio.Event, handshakes: asyncio.Semaphore) -> str:
+    """ A client that stops reading after the handshake, with a tiny receive buffer, until `done`.
+        Return how its connection ended: the code of the close frame received, `'aborted'` when
+        the server closed it without one (the frame can't get through a stalled connection) or
+        `'open'`.
+    """
+    url = urlparse(SECRET['websocket_url'])
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    async with handshakes:
+        await asyncio.get_running_loop().sock_connect(sock, (url.hostname, url.port or 80))
+        reader, writer = await asyncio.open_connection(sock=sock, limit=1024)
+        writer.write((
+            f'GET {url.path} HTTP/1.1\r\nHost: {url.netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n'
+        ).encode())
+        await reader.readuntil(b'\r\n\r\n')
+    ready.append(True)
+    await done.wait()
+    try:
+        tail = b''
+        while True:  # the close frame is the last one sent, 0x88 is never in the JSON texts
+            data = await asyncio.wait_for(reader.read(65536), 5)
+            tail = (tail + data)[-4:]
+            if tail[:2] == b'\x88\x02':
+                return str(int.from_bytes(tail[2:], 'big'))
+            if len(data) == 0:
+                return 'aborted'
+    except ConnectionError:
+        return 'aborted'
+    except asyncio.TimeoutError:
+        return 'open'
+    finally:
+        writer.close()
+
+
+async def fast_client(received: list, ready: list, done: asyncio.Event, handshakes: asyncio.Semaphore):
+    """ Record every notification received until `done`."""
+    async with handshakes:
+        ws = await websockets.connect(SECRET['websocket_url'], max_queue=None)
+    async with ws:
+        ready.append(True)
+        while not done.is_set():
+            try:
+                msg = json.loads(await asyncio.wait_for(ws.recv(), 0.5))
+            except asyncio.TimeoutError:
+                continue
+            if msg.get('type') == 'notification':
+                received.append((time.monotonic(), msg['data']['curr_avai_date']))
+
+
+async def load_test_slow(load: int, slow: int, events: int):
+    """ Load test with `slow` clients that stop reading among `load` clients notified of every change.
+        Publish `events` changes: the fast clients should get all of them in time while the queues
+        of the slow ones stay bounded and they get evicted. Print the delivery latency of the fast
+        clients, how the slow ones were closed and the queue metrics of the server.
+        A send only blocks once the socket buffers are full, a few MB on the loopback, hence the
+        many changes. Run the server with a `--ws-ping-interval` longer than the test, or the
+        keepalive pings the slow clients don't answer may close them first.
+    """
+    ready, done, handshakes = [], asyncio.Event(), asyncio.Semaphore(128)
+    received = [[] for _ in range(load - slow)]
+    fast = [asyncio.create_task(fast_client(received[i], ready, done, handshakes)) for i in range(load - slow)]
+    slow_clients = [asyncio.create_task(slow_client(ready, done, handshakes)) for _ in range(slow)]
+    while len(ready) < load and not all(client.done() for client in fast + slow_clients):
+        await asyncio.sleep(0.1)
+    print(f'{len(ready)} clients connected, {slow} of them slow')
+
+    ws_url, ws_token = SECRET['websocket_url'], SECRET['websocket_token']
+    embassy_codes = [emb.code for emb in USEmbassy.get_embassy_lst()]
+    start_date = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    sent_at = {}
+    async with websockets.connect(f'{ws_url}?token={ws_token}') as ws:
+        for i in range(0, events, 16):
+            batch = jsonable_encoder([
+                {
+                    'visa_type': random.choice(VISA_TYPES),
+                    'embassy_code': random.choice(embassy_codes),
+                    'prev_avai_date': None,
+                    'curr_avai_date': start_date + timedelta(minutes=j),  # identifies the change
+                }
+                for j in range(i, min(i + 16, events))
+            ])
+            for change in batch:
+                sent_at[change['curr_avai_date']] = time.monotonic()
+            await ws.send(json.dumps(batch))
+            await asyncio.sleep(0.03)
+
+    await asyncio.sleep(WEBSOCKET_SEND_TIMEOUT + 2)  # the slow clients time out
+    stats_url = ws_url.replace('ws', 'http', 1).replace('/visastatus/latest', '/visastatus/{}')
+    print('Broadcast:', requests.get(stats_url.format('broadcast')).json())
+    done.set()
+    await asyncio.gather(*fast, return_exceptions=True)
+    endings = await asyncio.gather(*slow_clients)
+
+    latencies = sorted(at - sent_at[date] for client_received in received for at, date in client_received)
+    complete = sum(len(client_received) == events for client_received in received)
+    print(f'{complete} of {load - slow} fast clients got all the {events} changes, '
+          f'the others at least {min(map(len, received), default=0)}')
+    if len(latencies) > 0:
+        print('delivery latency mean/p95/max: {:.4f}/{:.4f}/{:.4f} seconds'.format(
+            sum(latencies) / len(latencies),
+            latencies[int(0.95 * (len(latencies) - 1))],
+            latencies[-1],
+        ))
+    print('Slow clients:', {ending: endings.count(ending) for ending in set(endings)})
+    print('Server event loop lag:', requests.get(stats_url.format('loop_lag')).json())
+
+
 async def keep_ws_alive(alive_time: float, role: Role):
     """ Keep websocket alive for `for` seconds."""
     await asyncio.wait([asyncio.create_task(connect_ws(role))], timeout=alive_time)
@@ -69,10 +314,38 @@ def init():
         type=float,
         help='Number of seconds for running the test.'
     )
+    parser.add_argument(
+        '-i', '--interest',
+        dest='interest',
+        type=int,
+        default=0,
+        help='Register interests, then publish this number of changes and check the filtered fan-out.'
+    )
+    parser.add_argument(
+        '-s', '--slow',
+        dest='slow',
+        type=int,
+        default=0,
+        help='Number of clients that stop reading, among the load, while 30000 changes are published.'
+    )
+    parser.add_argument(
+        '-q', '--query',
+        dest='query',
+        action='store_true',
+        default=False,
+        help='Query the newest visa status instead of waiting for the notifications.'
+    )
 
     args = parser.parse_args()
     print(args)
-    asyncio.run(load_test_ws(args.load, args.alive_for))
+    if args.slow > 0:
+        asyncio.run(load_test_slow(args.load, args.slow, 30000))
+    elif args.interest > 0:
+        asyncio.run(load_test_interest(args.load, args.interest))
+    elif args.query:
+        asyncio.run(load_test_query(args.load, args.alive_for))
+    else:
+        asyncio.run(load_test_ws(args.load, args.alive_for))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+""" An in-process write-behind queue for MongoDB.
+    Write operations are queued per collection and flushed by a single thread with one
+    `bulk_write` per collection, either every `flush_interval` seconds or as soon as
+    `max_batch_size` operations are waiting. Whatever is left is flushed on `close`.
+    Callbacks can be run once the operations queued before them are written, e.g. to tell
+    the readers about the new data. An operation rejected by MongoDB is dropped, and so are the
+    callbacks of the same tag: they'd announce a write that never happened.
+"""
+import time
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from pymongo import collection
+from pymongo.errors import BulkWriteError, PyMongoError
+
+WriteOp = Tuple[str, Any, Optional[Hashable]]  # (collection_name, pymongo write operation, coalesce_key)
+
+
+class WriteBehindQueue:
+    """ Coalesce the write operations into periodic `bulk_write` batches per collection.
+        Operations queued with the same `coalesce_key` on the same collection replace each
+        other in place, so only the last one is written.
+    """
+    def __init__(
+        self,
+        get_collection: Callable[[str], collection.Collection],
+        flush_interval: float = 1.0,
+        max_batch_size: int = 1000,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.get_collection = get_collection
+        self.logger = logger or logging.getLogger('write_behind')
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = threading.Event()
+        self.flush_thread: Optional[threading.Thread] = None
+
+        self.pending: Dict[str, List[Any]] = defaultdict(list)
+        self.pending_tags: Dict[str, List[Optional[Hashable]]] = defaultdict(list)
+        self.coalesce_idx: Dict[str, Dict[Hashable, int]] = defaultdict(dict)
+        self.pending_cnt = 0
+        self.after_flush: List[Tuple[Callable[[], Any], Optional[Hashable]]] = []
+
+        # metrics
+        self.flush_cnt = 0
+        self.written_cnt = 0
+        self.coalesced_cnt = 0
+        self.failed_cnt = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        """ Number of operations waiting to be flushed."""
+        return self.pending_cnt
+
+    def stats(self) -> dict:
+        """ Return the queue depth and flush metrics."""
+        return {
+            'depth': self.depth,
+            'flush_cnt': self.flush_cnt,
+            'written_cnt': self.written_cnt,
+            'coalesced_cnt': self.coalesced_cnt,
+            'failed_cnt': self.failed_cnt,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
+
+    def start(self) -> None:
+        """ Start the flushing thread and make sure the queue is flushed at interpreter exit."""
+        self.flush_thread = threading.Thread(target=self.run, name='write_behind', daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.close)
+
+    def put(
+        self,
+        collection_name: str,
+        op: Any,
+        coalesce_key: Optional[Hashable] = None,
+        tag: Optional[Hashable] = None,
+    ) -> None:
+        """ Queue a write operation. If it fails, the callbacks of the same `tag` are dropped."""
+        if self.closed.is_set():  # nobody will flush it any more
+            self.get_collection(collection_name).bulk_write([op])
+            return
+
+        with self.lock:
+            ops = self.pending[collection_name]
+            if coalesce_key is not None and coalesce_key in self.coalesce_idx[collection_name]:
+                idx = self.coalesce_idx[collection_name][coalesce_key]
+                ops[idx] = op
+                self.pending_tags[collection_name][idx] = tag
+                self.coalesced_cnt += 1
+                return
+
+            if coalesce_key is not None:
+                self.coalesce_idx[collection_name][coalesce_key] = len(ops)
+            ops.append(op)
+            self.pending_tags[collection_name].append(tag)
+            self.pending_cnt += 1
+
+        if self.pending_cnt >= self.max_batch_size:
+            self.wakeup.set()
+
+    def call_after_flush(self, func: Callable[[], Any], tag: Optional[Hashable] = None) -> None:
+        """ Call `func` once everything queued so far is written, unless an operation of the same
+            `tag` failed.
+        """
+        if self.closed.is_set():  # the writes are synchronous already
+            func()
+            return
+
+        with self.lock:
+            self.after_flush.append((func, tag))
+
+    def run(self) -> None:
+        """ Flush periodically until the queue is closed."""
+        while not self.closed.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """ Write everything queued so far, one ordered `bulk_write` per collection."""
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+            pending_tags, self.pending_tags = self.pending_tags, defaultdict(list)
+            self.coalesce_idx = defaultdict(dict)
+            self.pending_cnt = 0
+            after_flush, self.after_flush = self.after_flush, []
+
+        if len(pending) == 0:
+            self.call(after_flush)
+            return
+
+        requeued = False
+        failed_tags = set()
+
+        flush_start = time.monotonic()
+        for collection_name, ops in pending.items():
+            tags = pending_tags[collection_name]
+            try:
+                self.get_collection(collection_name).bulk_write(ops, ordered=True)
+            except BulkWriteError as e:
+                # the operations before the failed one are written, retrying the failed one won't help,
+                # the ones after it are tried again with the next flush
+                failed = e.details['writeErrors'][0]['index']
+                self.logger.error('Bulk write to %s failed, re-queue %d operations: %s',
+                                  collection_name, len(ops) - failed - 1, e.details['writeErrors'][0])
+                self.written_cnt += failed
+                self.failed_cnt += 1
+                failed_tags.add(tags[failed])
+                self.requeue(collection_name, ops[failed + 1:], tags[failed + 1:])
+                requeued = requeued or failed + 1 < len(ops)
+            except PyMongoError:  # e.g. the server is unreachable, keep the batch ahead of the new writes
+                self.logger.exception('Bulk write to %s failed, re-queue %d operations', collection_name, len(ops))
+                self.requeue(collection_name, ops, tags)
+                requeued = True
+            else:
+                self.written_cnt += len(ops)
+
+        failed_tags.discard(None)
+        if len(failed_tags) > 0:
+            self.logger.warning('Drop the callbacks of the failed writes of %s', sorted(failed_tags, key=str))
+            after_flush = [(func, tag) for func, tag in after_flush if tag not in failed_tags]
+
+        if requeued:  # wait for the next flush to retry
+            with self.lock:
+                self.after_flush[:0] = after_flush
+        else:
+            self.call(after_flush)
+
+        self.flush_cnt += 1
+        self.last_flush_latency = time.monotonic() - flush_start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.logger.debug(
+            'Flushed %d collections in %.3f seconds | queue depth: %d',
+            len(pending),
+            self.last_flush_latency,
+            self.depth,
+        )
+
+    def requeue(self, collection_name: str, ops: List[Any], tags: List[Optional[Hashable]]) -> None:
+        """ Put operations back ahead of the ones queued meanwhile."""
+        if len(ops) == 0:
+            return
+        with self.lock:
+            self.pending[collection_name][:0] = ops
+            self.pending_tags[collection_name][:0] = tags
+            self.coalesce_idx[collection_name] = {}  # indexes are shifted, stop coalescing this batch
+            self.pending_cnt += len(ops)
+
+    def call(self, callbacks: List[Tuple[Callable[[], Any], Optional[Hashable]]]) -> None:
+        for func, _ in callbacks:
+            try:
+                func()
+            except Exception:
+                self.logger.exception('Callback after flush raised an exception')
+
+    def close(self) -> None:
+        """ Stop the flushing thread and flush what's left."""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.wakeup.set()
+        if self.flush_thread is not None and self.flush_thread is not threading.current_thread():
+            self.flush_thread.join()
+        self.flush()